@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import orjson
+import requests
+
+import aiohttp
+
+from extract import DataExtractor, shutdown_decoders
+from mock_rpc import add_mock_arguments, mock_from_arguments
+
+
+class BenchExtractor(DataExtractor):
+    """
+    A DataExtractor that writes to a scratch directory and times every request it sends.
+    """
+
+    def __init__(self, *args, output_root=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.output_root = output_root
+        self.latencies = []
+        self.pages = 0
+        self.bytes_received = 0
+
+    def data_directory(self):
+        return f"{self.output_root}/{self.network}/{self.protocol}"
+
+    def make_session(self):
+        """
+        Create the HTTP session with a trace recording the latency, status and size of every response.
+        """
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            # time until the response headers are in, the body follows straight after from the mock
+            self.latencies.append(time.perf_counter() - context.start)
+            if params.response.status == 200 and 'search' in params.url.path:
+                self.pages += 1
+
+        async def on_response_chunk_received(session, context, params):
+            self.bytes_received += len(params.chunk)
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_response_chunk_received.append(on_response_chunk_received)
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency), trace_configs=[trace])
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_scenario(scenario):
+    """
+    Extract one scenario against the mock and measure it. Runs in a fresh process so peak RSS is its own.
+
+    Args:
+        scenario (dict): The DataExtractor arguments of the scenario.
+
+    Returns:
+        dict: The scenario and its measurements.
+    """
+    output_root = tempfile.mkdtemp(prefix='bread-bench-')
+    extractor = BenchExtractor(protocol='rpc', network='bench', output_root=output_root, **scenario)
+    start = time.perf_counter()
+    try:
+        asyncio.run(extractor.async_extract())
+    finally:
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(output_root, ignore_errors=True)
+        shutdown_decoders()
+
+    return dict(
+        scenario,
+        seconds=elapsed,
+        pages=extractor.pages,
+        requests=len(extractor.latencies),
+        pages_per_second=extractor.pages / elapsed,
+        mb_per_second=extractor.bytes_received / elapsed / 1e6,
+        p50_latency=percentile(extractor.latencies, 0.50),
+        p99_latency=percentile(extractor.latencies, 0.99),
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KB on Linux
+        records=extractor.records or {'blocks': len(getattr(extractor, 'blocks', [])), 'txs': len(getattr(extractor, 'txs', []))},
+    )
+
+
+def serve_mock(args, port):
+    mock_from_arguments(args).run(port=port)
+
+
+def wait_for_mock(api_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return requests.get(f'{api_url}/stats').json()
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f'The mock RPC at {api_url} did not come up.')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',')]
+
+
+def semaphore_value(value):
+    return value if value == 'auto' else int(value)
+
+
+def percentile_value(value):
+    return None if value == 'none' else float(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark DataExtractor against a mock Tendermint RPC node.')
+    parser.add_argument('--heights', type=int, default=5000, help='The number of heights to extract per scenario.')
+    parser.add_argument('--per-page', type=str, default='100', help='Page sizes to compare, comma-separated.')
+    parser.add_argument('--semaphore', type=str, default='4', help='Semaphores to compare, comma-separated, ints or auto.')
+    parser.add_argument('--max-semaphore', type=int, default=64)
+    parser.add_argument('--stream', type=str, default='false', help='Stream modes to compare, comma-separated true/false.')
+    parser.add_argument('--compression-level', type=str, default='0', help='zstd levels to compare, comma-separated.')
+    parser.add_argument('--decode-workers', type=str, default='0', help='Decoder process counts to compare, comma-separated.')
+    parser.add_argument('--hedge-percentile', type=str, default='none', help='Hedge percentiles to compare, comma-separated, none turns hedging off.')
+    parser.add_argument('--endpoints', type=int, default=1, help='The number of mock nodes to spread the requests over.')
+    parser.add_argument('--repeat', type=int, default=1, help='The number of runs of each scenario.')
+    parser.add_argument('--port', type=int, default=26700, help='The port of the first mock node.')
+    parser.add_argument('--output', type=str, default=None, help='Append the results to this NDJSON file.')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    ports = [args.port + i for i in range(args.endpoints)]
+    servers = [multiprocessing.Process(target=serve_mock, args=(args, port), daemon=True) for port in ports]
+    for server in servers:
+        server.start()
+    api_url = ','.join(f'http://127.0.0.1:{port}' for port in ports)
+    for url in api_url.split(','):
+        wait_for_mock(url)
+
+    scenarios = [
+        {'api_url': api_url, 'start_height': args.start_height, 'end_height': args.start_height + args.heights - 1,
+         'per_page': per_page, 'semaphore': semaphore, 'max_semaphore': args.max_semaphore,
+         'stream': stream == 'true', 'compression_level': level, 'decode_workers': decode_workers, 'hedge_percentile': hedge}
+        for per_page, semaphore, stream, level, decode_workers, hedge in itertools.product(
+            parse_list(args.per_page, int), parse_list(args.semaphore, semaphore_value),
+            parse_list(args.stream), parse_list(args.compression_level, int), parse_list(args.decode_workers, int),
+            parse_list(args.hedge_percentile, percentile_value))
+    ]
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    try:
+        for scenario in scenarios:
+            for run in range(args.repeat):
+                # not a multiprocessing.Pool, its daemonic workers can not start the extractor's decoder processes
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_scenario, scenario).result()
+                result.update(run=run, revision=git_revision(), mock={
+                    key: getattr(args, key) for key in ('latency', 'jitter', 'txs_per_block', 'tx_bytes', 'rate_limit_rate',
+                                                        'failure_rate', 'max_response_bytes', 'max_in_flight', 'recorded', 'page_cost', 'tx_every', 'slow_rate', 'slow_latency')})
+                results.append(result)
+                if args.output is not None:
+                    with open(args.output, 'ab') as f:
+                        f.write(orjson.dumps(result) + b'\n')
+    finally:
+        mock_stats = [wait_for_mock(url) for url in api_url.split(',')]
+        for server in servers:
+            server.terminate()
+
+    print()
+    print(f"{'per_page':>8} {'semaphore':>9} {'stream':>6} {'zstd':>4} {'decoders':>8} {'hedge':>5} {'seconds':>8} {'pages/s':>8} {'MB/s':>7} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'rss MB':>7}")
+    for result in results:
+        print(f"{result['per_page']:>8} {str(result['semaphore']):>9} {str(result['stream']):>6} {result['compression_level']:>4} {result['decode_workers']:>8} {str(result['hedge_percentile']):>5} "
+              f"{result['seconds']:>8.2f} {result['pages_per_second']:>8.1f} {result['mb_per_second']:>7.2f} "
+              f"{result['p50_latency'] * 1000:>7.1f} {result['p99_latency'] * 1000:>7.1f} {result['peak_rss_mb']:>7.1f}")
+    for url, stats in zip(api_url.split(','), mock_stats):
+        print(f"{url}: {stats}")
@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import random
+import re
+import orjson
+
+from aiohttp import web
+
+from segments import list_raw_files, read_segment
+
+
+class MockRPC:
+    """
+    A local stand-in for a Tendermint RPC node, serving block_search, tx_search, block and abci_info.
+
+    The chain is either synthetic, every height holding `txs_per_block` txs of about `tx_bytes` bytes each,
+    or recorded, served from a raw data directory written by an earlier extraction. Latency, 429s, failures
+    and responses too large to come back can be injected to see how the extractor copes with them.
+    """
+
+    def __init__(self, start_height=1, end_height=100_000, txs_per_block=2, tx_bytes=512, latency=0.05, jitter=0.5,
+                 rate_limit_rate=0.0, failure_rate=0.0, max_response_bytes=None, max_in_flight=None, recorded=None,
+                 seed=0, retry_after=None, page_cost=0.0, tx_every=1, slow_rate=0.0, slow_latency=2.0, pretty=False) -> None:
+        """
+        Initialize the MockRPC.
+
+        Args:
+            start_height (int): The lowest height the node has.
+            end_height (int): The height of the head of the chain.
+            txs_per_block (int): The number of txs at every height of the synthetic chain.
+            tx_bytes (int): The size of the raw tx payload of each synthetic tx.
+            latency (float): The mean time in seconds before a response is sent.
+            jitter (float): How much the latency varies, as a fraction of it.
+            rate_limit_rate (float): The share of requests answered with a 429.
+            failure_rate (float): The share of requests answered with a 500.
+            max_response_bytes (int): Cut responses larger than this in half, like a node or proxy giving up on them.
+            max_in_flight (int): Answer with a 429 once this many requests are being served.
+            recorded (str): A raw data directory, e.g. ./data/akash/rpc, to serve recorded blocks and txs from.
+            seed (int): The seed of the injected latencies and errors.
+            retry_after (str): The Retry-After header sent with 429s, none if not given.
+            page_cost (float): The extra latency of a search per page it skips, like a node re-scanning its index.
+            tx_every (int): Only every tx_every-th height of the synthetic chain holds txs, the others are empty.
+            slow_rate (float): The share of requests that take slow_latency instead, like pages stuck on a busy node.
+            slow_latency (float): The latency of the slow requests in seconds.
+            pretty (bool): Indent the JSON of the responses, like Tendermint does.
+        """
+        self.start_height = start_height
+        self.end_height = end_height
+        self.txs_per_block = txs_per_block
+        self.tx_bytes = tx_bytes
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.max_response_bytes = max_response_bytes
+        self.max_in_flight = max_in_flight
+        self.random = random.Random(seed)
+        self.retry_after = retry_after
+        self.page_cost = page_cost
+        self.tx_every = tx_every
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.pretty = pretty
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'failed': 0, 'truncated': 0, 'slow': 0, 'bytes': 0}
+        self.blocks = None
+        self.txs = None
+        if recorded is not None:
+            self.load_recorded(recorded)
+
+    def load_recorded(self, directory):
+        """
+        Load the blocks and txs of a raw data directory, indexed by height.
+        """
+        self.blocks = {}
+        self.txs = {}
+        for prefix, index in (('blocks', self.blocks), ('txs', self.txs)):
+            for file in list_raw_files(f"{directory}/{prefix}"):
+                if file.endswith('.json'):
+                    with open(file, 'rb') as f:
+                        records = orjson.loads(f.read())
+                else:
+                    records = read_segment(file)
+                for record in records:
+                    height = int(record['height'] if prefix == 'txs' else record['block']['header']['height'])
+                    index.setdefault(height, []).append(record)
+        for txs in self.txs.values():
+            txs.sort(key=lambda tx: tx.get('index', 0))
+        if self.blocks:
+            self.start_height = min(self.blocks)
+            self.end_height = max(self.blocks)
+        print(f"Serving {len(self.blocks)} recorded blocks and {sum(map(len, self.txs.values()))} txs, "
+              f"heights {self.start_height}-{self.end_height}.")
+
+    def block(self, height):
+        if self.blocks is not None:
+            return self.blocks[height][0]
+        tx_hashes = [self.tx_hash(height, index) for index in range(self.txs_per_block if height % self.tx_every == 0 else 0)]
+        return {
+            'block_id': {'hash': hashlib.sha256(str(height).encode()).hexdigest().upper(), 'parts': {'total': 1, 'hash': ''}},
+            'block': {
+                'header': {
+                    'chain_id': 'mock-1',
+                    'height': str(height),
+                    'time': f'2023-07-01T{height // 3600 % 24:02d}:{height // 60 % 60:02d}:{height % 60:02d}.123456789Z',
+                    'proposer_address': 'ABCDEF',
+                },
+                'data': {'txs': [base64.b64encode(tx_hash.encode()).decode() for tx_hash in tx_hashes]},
+                'evidence': {'evidence': []},
+                'last_commit': {'height': str(height - 1), 'round': 0, 'signatures': []},
+            },
+        }
+
+    @staticmethod
+    def tx_hash(height, index):
+        return hashlib.sha256(f'{height}:{index}'.encode()).hexdigest().upper()
+
+    def tx(self, height, index):
+        def attribute(key, value):
+            return {'key': base64.b64encode(key.encode()).decode(), 'value': base64.b64encode(value.encode()).decode(), 'index': True}
+
+        log = [{'msg_index': 0, 'events': [{'type': 'message', 'attributes': [{'key': 'action', 'value': '/cosmos.bank.v1beta1.MsgSend'}]}]}]
+        return {
+            'hash': self.tx_hash(height, index),
+            'height': str(height),
+            'index': index,
+            'tx_result': {
+                'code': 0,
+                'data': '',
+                'log': orjson.dumps(log).decode('utf-8'),
+                'info': '',
+                'gas_wanted': '200000',
+                'gas_used': '100000',
+                'events': [
+                    {'type': 'message', 'attributes': [attribute('action', '/cosmos.bank.v1beta1.MsgSend'), attribute('sender', f'addr{index}')]},
+                    {'type': 'transfer', 'attributes': [attribute('recipient', f'addr{height}'), attribute('amount', f'{height}uakt')]},
+                ],
+                'codespace': '',
+            },
+            'tx': base64.b64encode(bytes(self.tx_bytes)).decode(),
+        }
+
+    @staticmethod
+    def parse_heights(query, key):
+        """
+        Read the height range out of a block_search or tx_search query.
+        """
+        exact = re.search(rf'{key}=(\d+)', query)
+        if exact:
+            return int(exact.group(1)), int(exact.group(1))
+        low = re.search(rf'{key}>=(\d+)', query)
+        high = re.search(rf'{key}<=(\d+)', query)
+        return int(low.group(1)) if low else 0, int(high.group(1)) if high else 2 ** 62
+
+    def respond(self, result):
+        body = orjson.dumps({'jsonrpc': '2.0', 'id': -1, 'result': result}, option=orjson.OPT_INDENT_2 if self.pretty else None)
+        if self.max_response_bytes is not None and len(body) > self.max_response_bytes:
+            self.stats['truncated'] += 1
+            body = body[:len(body) // 2]
+        self.stats['bytes'] += len(body)
+        return web.Response(body=body, content_type='application/json')
+
+    def search(self, request, kind):
+        query = request.query.get('query', '').strip('"')
+        page = int(request.query.get('page', '1').strip('"'))
+        per_page = int(request.query.get('per_page', '30').strip('"'))
+        low, high = self.parse_heights(query, 'block.height' if kind == 'blocks' else 'tx.height')
+        low, high = max(low, self.start_height), min(high, self.end_height)
+
+        if kind == 'blocks':
+            total_count = max(0, high - low + 1)
+            first = low + (page - 1) * per_page
+            items = [self.block(height) for height in range(first, min(first + per_page - 1, high) + 1)]
+        elif self.txs is None:
+            first = -(-low // self.tx_every) * self.tx_every  # the first height holding txs
+            total_count = max(0, (high - first) // self.tx_every + 1) * self.txs_per_block
+            offset = (page - 1) * per_page
+            items = []
+            for position in range(offset, min(offset + per_page, total_count)):
+                height, index = divmod(position, self.txs_per_block)
+                items.append(self.tx(first + height * self.tx_every, index))
+        else:
+            txs = [tx for height in range(low, high + 1) for tx in self.txs.get(height, [])]
+            total_count = len(txs)
+            items = txs[(page - 1) * per_page:page * per_page]
+        return self.respond({kind: items, 'total_count': str(total_count)})
+
+    def single_block(self, request):
+        height = int(request.query.get('height', str(self.end_height)).strip('"'))
+        if height < self.start_height or height > self.end_height:
+            body = {'jsonrpc': '2.0', 'id': -1, 'error': {'code': -32603, 'message': 'Internal error',
+                                                          'data': f'height {height} is not available, lowest height is {self.start_height}'}}
+            return web.Response(body=orjson.dumps(body), content_type='application/json')
+        return self.respond(self.block(height))
+
+    def abci_info(self, request):
+        return self.respond({'response': {'data': 'mock', 'last_block_height': str(self.end_height)}})
+
+    def handler(self, route):
+        async def handle(request):
+            self.stats['requests'] += 1
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight or self.random.random() < self.rate_limit_rate:
+                self.stats['rate_limited'] += 1
+                return web.Response(status=429, headers={'Retry-After': self.retry_after} if self.retry_after else None)
+            self.in_flight += 1
+            try:
+                skipped_pages = int(request.query.get('page', '1').strip('"')) - 1
+                latency = self.latency * (1 + self.jitter * (2 * self.random.random() - 1)) + self.page_cost * skipped_pages
+                if self.random.random() < self.slow_rate:
+                    self.stats['slow'] += 1
+                    latency = self.slow_latency
+                await asyncio.sleep(latency)
+            finally:
+                self.in_flight -= 1
+            if self.random.random() < self.failure_rate:
+                self.stats['failed'] += 1
+                return web.Response(status=500)
+            return route(request)
+        return handle
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/block_search', self.handler(lambda request: self.search(request, 'blocks')))
+        app.router.add_get('/tx_search', self.handler(lambda request: self.search(request, 'txs')))
+        app.router.add_get('/block', self.handler(self.single_block))
+        app.router.add_get('/abci_info', self.handler(self.abci_info))
+        app.router.add_get('/stats', lambda request: web.json_response(self.stats))
+        return app
+
+    def run(self, host='127.0.0.1', port=26657):
+        print(f"Mock RPC listening on http://{host}:{port}")
+        web.run_app(self.make_app(), host=host, port=port, print=None)
+
+
+def add_mock_arguments(parser):
+    """
+    Add the MockRPC settings to an argument parser.
+    """
+    parser.add_argument('--start-height', type=int, default=1, help='The lowest height the node has.')
+    parser.add_argument('--end-height', type=int, default=100_000, help='The height of the head of the chain.')
+    parser.add_argument('--txs-per-block', type=int, default=2, help='The number of txs at every height.')
+    parser.add_argument('--tx-bytes', type=int, default=512, help='The size of the raw payload of each tx.')
+    parser.add_argument('--latency', type=float, default=0.05, help='The mean response latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.5, help='The latency spread, as a fraction of the latency.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='The share of requests answered with a 429.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='The share of requests answered with a 500.')
+    parser.add_argument('--max-response-bytes', type=int, default=None, help='Cut responses larger than this in half.')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Answer with a 429 beyond this many requests at once.')
+    parser.add_argument('--recorded', type=str, default=None, help='A raw data directory to serve recorded data from.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the injected latencies and errors.')
+    parser.add_argument('--retry-after', type=str, default=None, help='The Retry-After header to send with 429s.')
+    parser.add_argument('--page-cost', type=float, default=0.0, help='The extra latency of a search per page it skips.')
+    parser.add_argument('--tx-every', type=int, default=1, help='Only every tx-every-th height holds txs.')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='The share of requests that take --slow-latency.')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='The latency of the slow requests in seconds.')
+    parser.add_argument('--pretty', action='store_true', help='Indent the JSON of the responses, like Tendermint does.')
+
+
+def mock_from_arguments(args):
+    return MockRPC(start_height=args.start_height, end_height=args.end_height, txs_per_block=args.txs_per_block,
+                   tx_bytes=args.tx_bytes, latency=args.latency, jitter=args.jitter, rate_limit_rate=args.rate_limit_rate,
+                   failure_rate=args.failure_rate, max_response_bytes=args.max_response_bytes,
+                   max_in_flight=args.max_in_flight, recorded=args.recorded, seed=args.seed, retry_after=args.retry_after,
+                   page_cost=args.page_cost, tx_every=args.tx_every, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                   pretty=args.pretty)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a mock Tendermint RPC node.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=26657)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    mock_from_arguments(args).run(args.host, args.port)
@@ -0,0 +1,148 @@
+import glob
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlsplit
+
+
+class ResponseCache:
+    """
+    A content-addressed disk cache of RPC responses, bounded in size with least recently used eviction.
+
+    Committed heights never change, so the block_search, tx_search and block responses for a range are the
+    same on every run and can be served from disk instead of the node. Responses are keyed by the hash of
+    the normalized request, its endpoint, height range, page and page size, so a page is found again
+    whichever node served it and however its query string was written. Anything else, like abci_info,
+    is never cached.
+
+    Entries are stored as `{directory}/{key[:2]}/{key}`. How recently an entry was used is kept in its
+    modification time, so the eviction order survives restarts.
+    """
+
+    CACHEABLE_PATHS = ('/block_search', '/tx_search', '/block')
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """
+        Initialize the ResponseCache, indexing the entries already on disk.
+
+        Args:
+            directory (str): The directory to keep the responses in.
+            max_bytes (int): The size the cache is kept under, the least recently used responses are evicted past it.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self) -> None:
+        paths = [path for path in glob.glob(f"{self.directory}/*/*") if not path.endswith('.tmp')]
+        for mtime, size, path in sorted((os.path.getmtime(path), os.path.getsize(path), path) for path in paths):
+            self.entries[os.path.basename(path)] = size
+            self.size += size
+        self.evict()
+
+    @classmethod
+    def normalize(cls, url: str):
+        """
+        Reduce a request to the parts that decide its response.
+
+        Args:
+            url (str): The URL of the request, absolute or relative to the endpoint.
+
+        Returns:
+            str: The normalized request, or None if its response can not be cached.
+        """
+        parts = urlsplit(url)
+        if parts.path not in cls.CACHEABLE_PATHS:
+            return None
+        params = []
+        for name, value in parse_qsl(parts.query, keep_blank_values=True):
+            value = value.strip().strip('"')
+            if name == 'query':
+                conditions = (re.sub(r'\s+', '', condition) for condition in re.split(r'\s+AND\s+', value))
+                value = ' AND '.join(sorted(conditions))
+            params.append(f'{name}={value}')
+        return f"{parts.path}?{'&'.join(sorted(params))}"
+
+    def key(self, url: str):
+        request = self.normalize(url)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest() if request is not None else None
+
+    def path(self, key: str) -> str:
+        return f"{self.directory}/{key[:2]}/{key}"
+
+    def get(self, url: str):
+        """
+        Look up the response to a request.
+
+        Args:
+            url (str): The URL of the request.
+
+        Returns:
+            bytes: The body of the response, or None if it is not cached.
+        """
+        key = self.key(url)
+        if key is None:
+            return None
+        if key in self.entries:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    body = f.read()
+                os.utime(self.path(key))
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+            except FileNotFoundError:
+                # evicted by another process sharing the directory
+                self.size -= self.entries.pop(key)
+        self.misses += 1
+        return None
+
+    def put(self, url: str, body: bytes) -> None:
+        """
+        Store the response to a request, evicting the least recently used responses if the cache grows too large.
+
+        Args:
+            url (str): The URL of the request.
+            body (bytes): The body of the response.
+        """
+        key = self.key(url)
+        if key is None or len(body) > self.max_bytes:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}.tmp", 'wb') as f:
+            f.write(body)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+        self.size += len(body) - self.entries.pop(key, 0)
+        self.entries[key] = len(body)
+        self.evict()
+
+    def discard(self, url: str) -> None:
+        """
+        Remove the response to a request, e.g. because it could not be decoded.
+        """
+        key = self.key(url)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> None:
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def report(self) -> str:
+        return (f"response cache: {self.hits} hits, {self.misses} misses, "
+                f"{len(self.entries)} responses in {self.size / 1e6:.1f} of {self.max_bytes / 1e6:.1f} MB")
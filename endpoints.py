@@ -0,0 +1,146 @@
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+
+@dataclass
+class EndpointStats:
+    """
+    Live statistics for one RPC endpoint, in the spirit of the hit/miss/times bookkeeping of the old indexer.
+    """
+    hit: int = 0
+    miss: int = 0
+    in_flight: int = 0
+    ewma_latency: float = None
+    total_time: float = 0.0
+    consecutive_failures: int = 0
+    recent_failures: List[float] = field(default_factory=list)
+    benched_until: float = 0.0
+
+
+class EndpointPool:
+    """
+    A pool of RPC endpoints that routes each request to the endpoint expected to answer it soonest.
+
+    The expected cost of an endpoint is its EWMA latency scaled by the requests already queued on it
+    and by its recent failures. Endpoints that fail several times in a row are benched for a while,
+    so throughput follows whichever nodes are healthy.
+    """
+
+    def __init__(self, api_urls: List[str], alpha: float = 0.2, failure_window: float = 30.0,
+                 max_consecutive_failures: int = 5, bench_seconds: float = 30.0) -> None:
+        """
+        Initialize the EndpointPool.
+
+        Args:
+            api_urls (list): The base URLs of the RPC endpoints.
+            alpha (float): The smoothing factor of the latency moving average.
+            failure_window (float): How long a failure counts against an endpoint, in seconds.
+            max_consecutive_failures (int): Bench an endpoint after this many failures in a row.
+            bench_seconds (float): How long a benched endpoint is skipped, in seconds.
+        """
+        self.apis: Dict[str, EndpointStats] = {api_url.rstrip('/'): EndpointStats() for api_url in api_urls}
+        self.alpha = alpha
+        self.failure_window = failure_window
+        self.max_consecutive_failures = max_consecutive_failures
+        self.bench_seconds = bench_seconds
+
+    def __len__(self) -> int:
+        return len(self.apis)
+
+    def expected_cost(self, stats: EndpointStats, now: float) -> float:
+        """
+        The expected time until an endpoint answers a new request.
+
+        Endpoints with no measurements yet get the best known latency, so they are tried early.
+        """
+        known = [s.ewma_latency for s in self.apis.values() if s.ewma_latency is not None]
+        latency = stats.ewma_latency if stats.ewma_latency is not None else (min(known) if known else 0.0)
+        stats.recent_failures = [t for t in stats.recent_failures if now - t < self.failure_window]
+        return (latency + 1e-3) * (stats.in_flight + 1) * (1 + len(stats.recent_failures)) ** 2
+
+    def choose(self) -> str:
+        """
+        Pick the endpoint to send the next request to.
+
+        Returns:
+            str: The base URL of the chosen endpoint.
+        """
+        now = time.time()
+        candidates = {api: stats for api, stats in self.apis.items() if stats.benched_until <= now}
+        if not candidates:
+            # everything is benched, fall back to the one that comes back first
+            return min(self.apis, key=lambda api: self.apis[api].benched_until)
+        costs = {api: self.expected_cost(stats, now) for api, stats in candidates.items()}
+        best = min(costs.values())
+        return random.choice([api for api, cost in costs.items() if cost == best])
+
+    def start(self, api: str) -> None:
+        self.apis[api].in_flight += 1
+
+    def cancel(self, api: str) -> None:
+        """
+        Record a request that was given up on before it finished, e.g. the slower copy of a hedged request.
+        It says nothing about the endpoint.
+        """
+        self.apis[api].in_flight -= 1
+
+    def finish(self, api: str, start_time: float, ok: bool) -> None:
+        """
+        Record the outcome of a request.
+
+        Args:
+            api (str): The endpoint the request was sent to.
+            start_time (float): When the request was sent.
+            ok (bool): Whether the endpoint returned usable data.
+        """
+        stats = self.apis[api]
+        now = time.time()
+        latency = now - start_time
+        stats.in_flight -= 1
+        stats.total_time += latency
+        if ok:
+            stats.hit += 1
+            stats.consecutive_failures = 0
+            if stats.ewma_latency is None:
+                stats.ewma_latency = latency
+            else:
+                stats.ewma_latency += self.alpha * (latency - stats.ewma_latency)
+        else:
+            stats.miss += 1
+            stats.consecutive_failures += 1
+            stats.recent_failures.append(now)
+            if stats.consecutive_failures >= self.max_consecutive_failures:
+                print(f"Benching {api} for {self.bench_seconds} seconds after {stats.consecutive_failures} failures in a row.")
+                self.bench(api, self.bench_seconds)
+                stats.consecutive_failures = 0
+
+    def bench(self, api: str, seconds: float) -> None:
+        """
+        Skip an endpoint for a while, e.g. because it asked us to back off.
+
+        Args:
+            api (str): The endpoint.
+            seconds (float): How long to skip it for.
+        """
+        stats = self.apis[api]
+        stats.benched_until = max(stats.benched_until, time.time() + seconds)
+
+    def get_api_usage(self) -> List[dict]:
+        """
+        Summarize how each endpoint was used.
+        """
+        return [
+            {
+                "api": api,
+                "hit": stats.hit,
+                "miss": stats.miss,
+                "ewma_latency": stats.ewma_latency,
+                "average_time_per_call": stats.total_time / (stats.hit + stats.miss),
+                "total_calls": stats.hit + stats.miss,
+                "hit_rate": stats.hit / (stats.hit + stats.miss),
+            }
+            for api, stats in self.apis.items()
+            if stats.hit + stats.miss > 0
+        ]
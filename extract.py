@@ -1,33 +1,151 @@
 import requests
+import random
 import time
 import pandas as pd
 from requests.exceptions import JSONDecodeError
 import math
 import os
+import re
 import orjson
-import glob
+from functools import partial
 
 import aiohttp
 import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from cache import ResponseCache
+from endpoints import EndpointPool
+from hedging import Hedger
+from heights import HeightIndex, HeightSet
+from journal import ExtractionJournal, get_incomplete_ranges, is_range_complete
+from limiter import AdaptiveLimiter
+from paging import PageSizer, TxPlanner
+from ratelimit import RateLimiter
+from segments import SegmentWriter, encode_lines, list_raw_files, read_segment, write_segment
+
+# responses smaller than this are decoded on the event loop, handing them to a decoder costs more than decoding them
+INLINE_DECODE_BYTES = 64 * 1024
+
+# how a failed request is handled, see DataExtractor.classify_failure
+RETRYABLE = 'retryable'
+SIZE = 'size'
+PERMANENT = 'permanent'
+
+# the sub-range and page size of a tx_search URL planned by get_tx_urls
+TX_PAGE_URL = re.compile(r'tx\.height>=(\d+) AND tx\.height<=(\d+)"&page=\d+&per_page=(\d+)')
+
+# the height of a block or tx_search URL of the backfill, which asks for one height at a time
+HEIGHT_URL = re.compile(r'(?:\?height=|tx\.height=)(\d+)')
+
+_decoders = {}
+
+def get_decoder(workers):
+    """
+    Get the executor response bodies are decoded in, shared by every DataExtractor of the process.
+
+    A worker process has to call shutdown_decoders before it exits, multiprocessing waits for the
+    decoder processes before the executor gets the chance to stop them.
+
+    Args:
+        workers (int): The number of decoder processes, 0 decodes in a thread instead.
+
+    Returns:
+        concurrent.futures.Executor: The decoder.
+    """
+    if workers not in _decoders:
+        _decoders[workers] = ProcessPoolExecutor(max_workers=workers) if workers else ThreadPoolExecutor(max_workers=1)
+    return _decoders[workers]
+
+def shutdown_decoders():
+    for decoder in _decoders.values():
+        decoder.shutdown()
+    _decoders.clear()
+
+def page_lines(body, data_key):
+    """
+    Turn the body of a search response into the NDJSON lines of its items, ready to be appended to a segment.
+
+    Runs in a decoder, so the event loop only ever handles the bytes.
+
+    Args:
+        body (bytes): The body of the response.
+        data_key (str): The key in the response JSON where the data is stored.
+
+    Returns:
+        tuple: The NDJSON lines, the number of items, the number of txs per height, as listed by the block
+            headers for blocks or as found in the page for txs, the total count of the query and the size
+            of the body, or None if the response holds no result.
+    """
+    response = orjson.loads(body)
+    if 'result' not in response:
+        return None
+    items = response['result'][data_key]
+    return (encode_lines(items), len(items), DataExtractor.txs_per_height(items, data_key),
+            int(response['result']['total_count']), len(body))
+
+def sized_loads(body):
+    """
+    Decode the body of a response along with its size, for the page sizer to learn from.
+
+    Nodes may pretty-print their JSON, so the size has to be taken from the body as it came in
+    rather than from the data serialized again.
+
+    Args:
+        body (bytes): The body of the response.
+
+    Returns:
+        tuple: The JSON data of the response and the size of the body, or None if the response holds no result.
+    """
+    response = orjson.loads(body)
+    if 'result' not in response:
+        return None
+    return response, len(body)
 
 class DataExtractor:
     """
     A class used to extract data from the Tendermint blockchain using the RPC endpoints.
     """
 
-    def __init__(self, api_url, start_height, end_height, per_page, protocol, network, semaphore=1) -> None:
+    def __init__(self, api_url, start_height, end_height, per_page, protocol, network, semaphore=1, stream=False, max_semaphore=64, compression_level=0, page_byte_budget=800_000, decode_workers=0, cache_max_bytes=0, requests_per_second=None, bytes_per_second=None, tx_pages_per_range=1, tx_plan_window=10, hedge_percentile=None, hedge_budget=0.05, connect_timeout=10.0, read_timeout=30.0, total_timeout=120.0, max_retries=5, retry_base_delay=1.0, retry_max_delay=30.0) -> None:
         """
         Initialize the DataExtractor object.
 
         Args:
-            api_url (str): The base URL for the RPC API.
+            api_url (str or list): The base URL for the RPC API, or a list (or comma-separated string) of
+                endpoints to spread the requests over.
             start_height (int): The starting block height for the extraction.
             end_height (int): The ending block height for the extraction.
             per_page (int): The number of transactions to extract in each page.
             protocol (str): The protocol to be used ('rpc' or 'lcd').
             network (str): The name of the blockchain
+            semaphore (int or str): The maximum number of simultaneous requests per endpoint, or 'auto' to adapt it to the nodes (AIMD).
+            stream (bool): Write pages to rolling NDJSON segments as they arrive instead of holding the whole range in memory.
+            max_semaphore (int): The upper bound on simultaneous requests per endpoint when semaphore is 'auto'.
+            compression_level (int): The zstd level raw data is written with, 0 writes it uncompressed.
+            page_byte_budget (int): The response size page sizes are chosen to stay under.
+            decode_workers (int): The number of processes decoding responses off the event loop, 0 decodes them in a thread.
+                Processes only pay off when there are cores to spare next to the event loop.
+            cache_max_bytes (int): The size of the on-disk cache of block and tx responses, 0 disables it.
+            requests_per_second (float or dict): The request quota of each endpoint, or a dict of quotas by endpoint.
+            bytes_per_second (float or dict): The download quota of each endpoint, or a dict of quotas by endpoint.
+            tx_pages_per_range (int): The number of tx pages each tx_search height sub-range is sized to.
+            tx_plan_window (int): The number of block pages whose tx pages are planned together.
+            hedge_percentile (float): Send a duplicate of requests slower than this percentile of recent latencies,
+                e.g. 0.95. None turns hedging off.
+            hedge_budget (float): The most duplicates sent per request when hedging.
+            connect_timeout (float): The deadline for connecting to an endpoint, in seconds.
+            read_timeout (float): The longest wait for the next bytes of a response, in seconds.
+            total_timeout (float): The deadline for a whole request, response body included, in seconds.
+            max_retries (int): The retries of a request failing with a retryable error, 429s aside, before it is
+                given up on and left to the backfill.
+            retry_base_delay (float): The backoff before the first retry, doubling with every retry, in seconds.
+            retry_max_delay (float): The longest backoff between retries, in seconds.
         """
-        self.api_url = api_url
+        self.api_urls = api_url.split(',') if isinstance(api_url, str) else list(api_url)
+        self.api_url = self.api_urls[0]  # used by the synchronous queries
+        self.pool = EndpointPool(self.api_urls)
+        self.rate_limiter = RateLimiter(requests_per_second=self.endpoint_quotas(requests_per_second),
+                                        bytes_per_second=self.endpoint_quotas(bytes_per_second))
         self.start_height = start_height
         self.end_height= end_height
         self.end_init = end_height
@@ -38,14 +156,55 @@ class DataExtractor:
         self.protocol = protocol
         self.network = network
         self.semaphore = semaphore
+        self.stream = stream
+        self.max_semaphore = max_semaphore
+        self.compression_level = compression_level
+        self.limiter = None
+        self.concurrency = None
+        self.records = {}
+        self.journals = {}
+        self.failed_pages = {}
+        self.page_byte_budget = page_byte_budget
+        self.page_sizers = {}
+        self.decode_workers = decode_workers
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = None
+        self.tx_pages_per_range = tx_pages_per_range
+        self.tx_plan_window = tx_plan_window
+        self.tx_planner = None
+        self.tx_url_ranges = {}
+        self.tx_url_pages = {}  # tx_search URL -> (first height, page size), for the page sizer to learn from
+        self.tx_range_page_sizes = {}  # (start_height, end_height) -> the page size an earlier run paged it with
+        self.hedger = Hedger(hedge_percentile, hedge_budget) if hedge_percentile else None
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.sync_timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.gaps = []  # the requests given up on
+
+    @staticmethod
+    def endpoint_quotas(quota):
+        """
+        Key a dict of quotas by endpoint the way the endpoint pool does.
+        """
+        if isinstance(quota, dict):
+            return {api_url.rstrip('/'): value for api_url, value in quota.items()}
+        return quota
 
     def query_rpc(self, endpoint_format: str, data_key: str, start_height: int, end_height: int):
         """
         Query the blockchain API.
 
+        Page sizes come from the page sizer, which learns from every response how large pages can get.
+        When even a page of one item is too large, the rest of the height range is split in two and
+        each half is queried on its own.
+
         Args:
             endpoint_format (str): A format string for the API endpoint URL.
             data_key (str): The key in the response JSON where the data is stored.
+            start_height (int): The first height to query.
+            end_height (int): The last height to query.
 
         Returns:
             list: A list of data from the queried blocks or transactions.
@@ -55,14 +214,17 @@ class DataExtractor:
         page = 1
         total_items_processed = 0
         remaining_pages_to_iterate = None
+        self.per_page = self.get_page_sizer(data_key).per_page(start_height)
 
         while remaining_pages_to_iterate is None or page <= remaining_pages_to_iterate:
             print(f'page {page} with {remaining_pages_to_iterate} remaining pages to iterate for data keys: {data_key} | total processed: {total_items_processed}')
-            self.per_page = self.per_page_init  # reset per_page to its initial value at the beginning of each loop
             endpoint = endpoint_format.format(api_url=self.api_url, start=start_height, end=end_height, page=page, per_page=self.per_page)
             while True: # retry loop
                 try:
-                    r = self.session.get(endpoint).json()
+                    reserved = self.rate_limiter.acquire_sync(self.api_url.rstrip('/'))
+                    response = self.session.get(endpoint, timeout=self.sync_timeout)
+                    self.rate_limiter.record_response(self.api_url.rstrip('/'), reserved, len(response.content))
+                    r = response.json()
                     if 'result' in r.keys():
                         total_count = int(r['result']['total_count'])
                         remaining_pages_to_iterate = math.ceil(total_count / self.per_page)
@@ -71,33 +233,93 @@ class DataExtractor:
                         new_data = r['result'][data_key]
                         data.extend(new_data)
                         total_items_processed += len(new_data)
+                        self.get_page_sizer(data_key).record_success(start_height, self.per_page, len(new_data), len(response.content))
                         break
                 except (JSONDecodeError, KeyError) as e:
                     # Handle errors due to large response or missing 'result' key
                     if isinstance(e, JSONDecodeError):
-                        print(f'Response too large. Reducing per_page from {self.per_page} to {self.per_page//2}')
-                        self.per_page //= 2
-                        remaing_pages_to_iterate = None # trying to update this in case the <= remaining_pages_to_iterate is fucked
-                        if self.per_page < 1:
-                            with open(f"./data/{self.network}/{self.protocol}/errors/error_heights.txt", "a") as error_file:
-                                error_file.write(str(self.start_height) + "\n")
-                            print("Warning: per_page has reached zero, can't reduce further. Moving to next block.")
-                            return data
-
-                        # Recalculate remaining pages with new per_page value
-                        # remaining_pages_to_iterate = math.ceil(total_count / self.per_page)
+                        self.get_page_sizer(data_key).record_too_large(start_height, self.per_page)
+                        if self.per_page == 1:
+                            return self.split_query_rpc(endpoint_format, data_key, start_height, end_height, data)
+
+                        # the next page has to start right after the items we already have,
+                        # so the new page size must divide the number of items processed
+                        new_per_page = self.per_page // 2
+                        while total_items_processed % new_per_page:
+                            new_per_page -= 1
+                        print(f'Response too large. Reducing per_page from {self.per_page} to {new_per_page}')
+                        self.per_page = new_per_page
+                        remaining_pages_to_iterate = None
 
                         # Recalculate the current page based on the total number of items processed
                         page = total_items_processed // self.per_page + 1
+                        endpoint = endpoint_format.format(api_url=self.api_url, start=start_height, end=end_height, page=page, per_page=self.per_page)
                         
                     else:  # KeyError
                         print(f"Unexpected response format, retrying. Error: {e}")
                     time.sleep(1)
             
             page += 1
-            
+
+        self.get_page_sizer(data_key).save()
+        return data
+
+    def get_page_sizer(self, data_key: str):
+        """
+        Get the page sizer for blocks or txs, loading what earlier runs learned.
+
+        Args:
+            data_key (str): The key in the response JSON where the data is stored.
+
+        Returns:
+            PageSizer: The page sizer.
+        """
+        if data_key not in self.page_sizers:
+            self.page_sizers[data_key] = PageSizer(max_per_page=self.per_page_init, byte_budget=self.page_byte_budget,
+                                                   path=f"{self.data_directory()}/page_sizes_{data_key}.json")
+        return self.page_sizers[data_key]
+
+    def split_query_rpc(self, endpoint_format: str, data_key: str, start_height: int, end_height: int, data: list):
+        """
+        Finish a query whose items are too large to page through, by splitting its remaining height range.
+
+        Items of the last height already received may be incomplete, so that height is queried again.
+
+        Args:
+            endpoint_format (str): A format string for the API endpoint URL.
+            data_key (str): The key in the response JSON where the data is stored.
+            start_height (int): The first height of the query.
+            end_height (int): The last height of the query.
+            data (list): The items received so far, in ascending height order.
+
+        Returns:
+            list: A list of data from the queried blocks or transactions.
+        """
+        self.get_page_sizer(data_key).save()
+        heights = [self.item_height(item) for item in data]
+        resume_height = heights[-1] if heights else start_height
+        data = [item for item, height in zip(data, heights) if height < resume_height]
+
+        if resume_height == end_height:
+            os.makedirs(self.output_directory('errors'), exist_ok=True)
+            with open(f"{self.output_directory('errors')}/error_heights.txt", "a") as error_file:
+                error_file.write(str(resume_height) + "\n")
+            print(f"Warning: a single item at height {resume_height} is too large to query. Moving on.")
+            return data
+
+        middle_height = (resume_height + end_height) // 2
+        print(f'Response too large even with per_page=1. Splitting {resume_height}-{end_height} at {middle_height}.')
+        data.extend(self.query_rpc(endpoint_format, data_key, resume_height, middle_height))
+        data.extend(self.query_rpc(endpoint_format, data_key, middle_height + 1, end_height))
         return data
 
+    @staticmethod
+    def item_height(item):
+        """
+        The height of a block or tx returned by the RPC API.
+        """
+        return int(item['height']) if 'height' in item else int(item['block']['header']['height'])
+
     def query_api(self, endpoint_format: str, data_key: str):
         """
         Query the blockchain API.
@@ -118,7 +340,7 @@ class DataExtractor:
 
         while remaining_pages_to_iterate is None or page <= remaining_pages_to_iterate:
             endpoint = endpoint_format.format(api_url=self.api_url, start=self.start_height, end=self.end_height, page=page, per_page=self.per_page)
-            r = self.session.get(endpoint).json()
+            r = self.session.get(endpoint, timeout=self.sync_timeout).json()
             self.test = r
             remaining_pages_to_iterate = int(r['pagination']['total'])
             
@@ -142,7 +364,9 @@ class DataExtractor:
         if self.protocol == 'rpc':
             txs = self.query_rpc(
                 endpoint_format='{api_url}/tx_search?query="tx.height>={start} AND tx.height<={end}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true',
-                data_key='txs'
+                data_key='txs',
+                start_height=self.start_height,
+                end_height=self.end_height
             )
             if mode == 'backfill':
                 self.backfilled_txs.append(txs)
@@ -161,7 +385,9 @@ class DataExtractor:
     def query_blocks(self):
         blocks = self.query_rpc(
             endpoint_format='{api_url}/block_search?query="block.height>={start} AND block.height<={end}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true',
-            data_key='blocks'
+            data_key='blocks',
+            start_height=self.start_height,
+            end_height=self.end_height
         )
         self.blocks = blocks
         self.blocks_df = pd.DataFrame(blocks)
@@ -177,122 +403,203 @@ class DataExtractor:
         # I'm assuming here that 'height' is a key in each dictionary in your data list. 
         # Adjust this if that's not the case.
        
-        directory = f"/app/data/{self.network}/{self.protocol}/{prefix}"
+        directory = self.output_directory(prefix)
         os.makedirs(directory, exist_ok=True)
         
+        if self.compression_level:
+            filename = f"{directory}/{self.start_height}_{self.end_height}.ndjson.zst"
+            write_segment(filename, data, self.start_height, self.end_height, self.compression_level)
+            return
+
         filename = f"{directory}/{self.start_height}_{self.end_height}.json"
 
         with open(filename, 'wb') as f:
             f.write(orjson.dumps(data))
 
-    async def async_query_txs(self, blocks, session):
+    async def async_query_txs(self, tx_counts, session, semaphore):
         """
-        Asynchronously query transactions for a list of blocks.
+        Asynchronously query the transactions of a set of heights, one tx_search per height and page.
+
+        Pages are sized by the page sizer, so a height whose txs did not fit in a page of the range is
+        asked for in pages small enough to come back.
 
         Args:
-            blocks (list): The list of block heights to query.
+            tx_counts (dict): The heights to query, mapped to the number of transactions in their block.
+            session (aiohttp.ClientSession): The session to use for the requests.
+            semaphore (asyncio.Semaphore): The limiter bounding the number of simultaneous requests.
 
         Returns:
-            list: A list of transactions from the queried blocks.
+            list: A list of transactions from the queried heights.
         """
-
-        tasks = [self.query_rpc(
-            endpoint_format='{api_url}/cosmos/tx/v1beta1/txs?events=tx.height>={start}&events=tx.height<={end}&pagination.offset={page}&pagination.limit={per_page}&pagination.count_total=true&order_by=ORDER_BY_ASC',
-            data_key='txs',
-            start_height=block,
-            end_height=block
-        ) for block in blocks]
-        results = await asyncio.gather(*tasks)
-        return results
+        urls = []
+        for height, count in sorted(tx_counts.items()):
+            per_page = self.get_page_sizer('txs').per_page(height)
+            for page in range(1, math.ceil(count / per_page) + 1):
+                url = f'/tx_search?query="tx.height={height}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true'
+                self.tx_url_pages[url] = (height, per_page)
+                urls.append(url)
+        pages = await self.fetch_all(urls, session, semaphore, decode=sized_loads)
+        responses = []
+        for url, page in zip(urls, pages):
+            if page is not None:
+                response, num_bytes = page
+                self.get_page_sizer('txs').record_success(*self.tx_url_pages[url], len(response['result']['txs']), num_bytes)
+                responses.append(response)
+        return await self.process_responses(responses, 'txs')
     
-    async def async_query_blocks(self, blocks, session):
+    async def async_query_blocks(self, heights, session, semaphore):
         """
-        Asynchronously query blocks,
+        Asynchronously query blocks, one request per height.
 
         Args:
-            blocks (list): The list of block heights to query.
+            heights (set): The block heights to query.
+            session (aiohttp.ClientSession): The session to use for the requests.
+            semaphore (asyncio.Semaphore): The limiter bounding the number of simultaneous requests.
 
         Returns:
-            list: A list of queried blocks.
+            list: A list of queried blocks, shaped like the block_search results.
         """
+        urls = [f'/block?height={height}' for height in sorted(heights)]
+        responses = await self.fetch_all(urls, session, semaphore)
+        return [response['result'] for response in responses if response is not None and 'result' in response.keys()]
 
-        tasks = [self.session.get(f'{self.api_url}/block?height={block}').json() for block in blocks]
-        results = await asyncio.gather(*tasks)
-        return results
-    
-    
-    
+    @staticmethod
+    def block_tx_count(block):
+        """
+        The number of transactions in a block, from its header data.
+        """
+        return len(block['block']['data']['txs'] or [])
+
+    @classmethod
+    def txs_per_height(cls, items, data_key):
+        """
+        The number of txs per height, as listed by block headers or as found among txs.
 
-    async def backfill(self):
+        Args:
+            items (list): Blocks or txs returned by the RPC API.
+            data_key (str): 'blocks' or 'txs'.
         """
-        Backfill the DataFrame with missing blocks and transactions.
+        if data_key == 'blocks':
+            return {cls.item_height(block): cls.block_tx_count(block) for block in items}
+        counts = {}
+        for tx in items:
+            counts[int(tx['height'])] = counts.get(int(tx['height']), 0) + 1
+        return counts
+
+    @staticmethod
+    def tx_key(tx):
+        """
+        The (height, index) pair identifying a transaction.
+        """
+        return int(tx['height']), int(tx['index'])
 
-        This method is useful for when the DataFrame is saved to a file and needs to be updated.
+    async def backfill(self, tx_counts, txs_per_height, present_txs, session, semaphore):
         """
-        # Create a dictionary where the key is the block height and the value is the number of transactions in that block
-        blocks_and_txs = {x['header']['height']: len(x['data']['txs']) for x in self.blocks_df['block'].values}
-        blocks_with_txs = {x:y for x,y in blocks_and_txs.items() if y > 0}
+        Fetch the blocks and transactions missing from the range.
 
-        # Get the total number of transactions logged
-        num_txs_logged = self.tx_df.shape[0]
+        Missing blocks are the heights without a header. Missing transactions are found by comparing
+        the number of transactions each block header lists with the number extracted for that height,
+        and only the heights that come up short are queried again. Nothing is read or requested when
+        nothing is missing.
 
-        # Get the total number of transactions from the blocks
-        total_txs_from_blocks = sum(blocks_and_txs.values())
-        
-        # Check if all blocks are present
-        if self.blocks_df.shape[0] < self.end_init - self.start_init:
-            # If not, backfill missing blocks
-            set_of_expected_blocks = set(range(self.start_init, self.end_init))
-            blocks_present =  set(self.blocks_df['block'].map(lambda x: x['header']['height']).astype(int))
-            missing_blocks = set_of_expected_blocks - blocks_present
+        Args:
+            tx_counts (dict): The number of transactions per height, from the block headers extracted so far.
+            txs_per_height (dict): The number of transactions extracted so far per height.
+            present_txs (callable): Given a set of heights, returns the (height, index) pairs of the transactions
+                extracted so far at them.
+            session (aiohttp.ClientSession): The session to use for the requests.
+            semaphore (asyncio.Semaphore): The limiter bounding the number of simultaneous requests.
+
+        Returns:
+            tuple: The backfilled blocks, the backfilled transactions and the heights still missing blocks or transactions.
+        """
+        tx_counts = dict(tx_counts)
+        txs_per_height = dict(txs_per_height)
+        missing_blocks = set(range(self.start_init, self.end_init + 1)) - set(tx_counts)
+        new_blocks = []
+        if missing_blocks:
             print(f"Backfilling {len(missing_blocks)} blocks...")
-            async with aiohttp.ClientSession() as session:
-                print('backfilling blocks async')
-                self.backfilled_blocks = await self.async_query_blocks(missing_blocks, session)
-            print("Done backfilling blocks.")
-
-            to_be_added = []
-            for data in self.backfilled_blocks:
-                for page in data:
-                    to_be_added.append(page)
-
-            backfilled_blocks_df = pd.DataFrame(to_be_added)
-            self.blocks_df = pd.concat([self.blocks_df, backfilled_blocks_df]).reset_index(drop=True)
-            print(f'{len(to_be_added)} blocks recovered out of {missing_blocks} total missing blocks')
-
-        # Check if all transactions are present
-        if num_txs_logged == total_txs_from_blocks:
-            print("All transactions are present. No need for backfilling.")
-        else:
-            # If not, backfill missing transactions
-            print("Backfilling transactions...")
-            txs_heights = set(self.tx_df['height'])
-            missing_txs_blocks = {x for x,y in blocks_with_txs.items() if x not in txs_heights}
-            print(f'missing txs from {len(missing_txs_blocks)} blocks.')
-            self.backfilled_txs = []
+            new_blocks = await self.async_query_blocks(missing_blocks, session, semaphore)
+            tx_counts.update(self.txs_per_height(new_blocks, 'blocks'))
+            print(f'{len(new_blocks)} blocks recovered out of {len(missing_blocks)} total missing blocks')
+
+        short_heights = {height: count for height, count in tx_counts.items() if txs_per_height.get(height, 0) < count}
+        new_txs = []
+        if short_heights:
+            num_missing = sum(count - txs_per_height.get(height, 0) for height, count in short_heights.items())
+            print(f"Backfilling {num_missing} transactions from {len(short_heights)} blocks...")
+            present = present_txs({height for height in short_heights if txs_per_height.get(height, 0)})
+            new_txs = [tx for tx in await self.async_query_txs(short_heights, session, semaphore) if self.tx_key(tx) not in present]
+            # the same page can come back twice if a request was retried, keep the first copy
+            new_txs = list({self.tx_key(tx): tx for tx in reversed(new_txs)}.values())
+            print(f'{len(new_txs)} txs recovered out of {num_missing} total missing txs')
+
+        for height, count in self.txs_per_height(new_txs, 'txs').items():
+            txs_per_height[height] = txs_per_height.get(height, 0) + count
+        remaining = missing_blocks - {self.item_height(block) for block in new_blocks}
+        remaining.update(height for height, count in tx_counts.items() if txs_per_height.get(height, 0) < count)
+        if remaining:
+            print(f'{len(remaining)} heights are still missing blocks or transactions.')
+        return new_blocks, new_txs, remaining
+
+    async def backfill_records(self, session=None, semaphore=None):
+        """
+        Backfill the blocks and transactions held in memory in self.blocks and self.txs.
 
-            async with aiohttp.ClientSession() as session:
-                print('backfilling txs async')
-                self.backfilled_txs = await self.async_query_txs(missing_txs_blocks, session)
-            print(f'{len(self.backfilled_txs)} recovered, but may still be missing data. Look in errors subdirectory.')
+        Args:
+            session (aiohttp.ClientSession): A session to share with other fetches, a new one is opened if not given.
+            semaphore (asyncio.Semaphore): A limiter to share with other fetches, a new one is made if not given.
 
-            to_be_added = []
-            for data in self.backfilled_txs:
-                for page in data:
-                    to_be_added.append(page)
-            print(f'{len(to_be_added)} txs recovered out of {total_txs_from_blocks - num_txs_logged} total missing txs')
+        Returns:
+            set: The heights still missing blocks or transactions.
+        """
+        if session is None:
+            async with self.make_session() as session:
+                return await self.backfill_records(session, semaphore)
 
-            backfilled_tx_df = pd.DataFrame(to_be_added)
+        def present_txs(heights):
+            return {self.tx_key(tx) for tx in self.txs if int(tx['height']) in heights}
 
-            self.tx_df = pd.concat([self.tx_df, backfilled_tx_df]).reset_index(drop=True)
-            self.tx_df.to_json(f'./data/{self.network}/{self.protocol}/txs/{self.start_init}_{self.end_init}.json', orient='records')
+        new_blocks, new_txs, remaining = await self.backfill(self.txs_per_height(self.blocks, 'blocks'), self.txs_per_height(self.txs, 'txs'),
+                                                             present_txs, session, semaphore or self.get_limiter())
+        self.blocks.extend(new_blocks)
+        self.txs.extend(new_txs)
+        return remaining
+
+    async def backfill_segments(self, session, semaphore):
+        """
+        Backfill the range extracted to segments, appending what was missing as new segments.
 
-            print("Done backfilling transactions.")
+        What is missing is known from the tx planner, the segments are only read back for the
+        (height, index) pairs of heights whose txs came in partly.
+
+        Args:
+            session (aiohttp.ClientSession): The session to use for the requests.
+            semaphore (asyncio.Semaphore): The limiter bounding the number of simultaneous requests.
+
+        Returns:
+            set: The heights still missing blocks or transactions.
+        """
+        def present_txs(heights):
+            present = set()
+            if heights:
+                for segment in self.journals['txs'].segments:
+                    present.update(self.tx_key(tx) for tx in read_segment(f"{self.output_directory('txs')}/{segment}") if int(tx['height']) in heights)
+            return present
+
+        new_blocks, new_txs, remaining = await self.backfill(self.tx_planner.tx_counts, self.tx_planner.extracted, present_txs, session, semaphore)
+        for prefix, records in (('blocks', new_blocks), ('txs', new_txs)):
+            journal = self.journals[prefix]
+            with SegmentWriter(self.output_directory(prefix), self.start_height, self.end_height, journal=journal, compression_level=self.compression_level) as writer:
+                writer.write(records, page=f'backfill:{journal.next_seq}')
+        return remaining
 
     def generate_urls(self, endpoint_format: str, total_pages=None):
         """
         Generate the URLs for the RPC API.
 
+        The URLs are relative to the endpoint, fetch picks the endpoint for each request.
+
         Args:
             endpoint_format (str): A format string for the API endpoint URL.
             total_pages (int): The total number of pages.
@@ -302,12 +609,12 @@ class DataExtractor:
         """
 
         if total_pages:
-            urls = [endpoint_format.format(api_url=self.api_url, start=self.start_height, end=self.end_height, page=page, per_page=self.per_page)
+            urls = [endpoint_format.format(api_url='', start=self.start_height, end=self.end_height, page=page, per_page=self.per_page)
                 for page in range(1, total_pages+1)]
 
         else:
             remaining_pages_to_iterate = (self.end_height - self.start_height) // self.per_page + 1
-            urls = [endpoint_format.format(api_url=self.api_url, start=self.start_height, end=self.end_height, page=page, per_page=self.per_page)
+            urls = [endpoint_format.format(api_url='', start=self.start_height, end=self.end_height, page=page, per_page=self.per_page)
                 for page in range(1, remaining_pages_to_iterate+1)]
             
         return urls
@@ -318,73 +625,446 @@ class DataExtractor:
         """
 
         start = time.time()
+        # opened before the range is written, so a first index is not seeded with a range that has gaps
+        get_height_index(self.data_directory())
         self.query_blocks()
         self.query_txs()
-        self.backfill()
+        remaining = asyncio.run(self.backfill_records())
 
-        self.save_json(self.blocks, 'blocks')
-        self.save_json(self.tx, 'txs')
+        self.save_range(remaining)
         end = time.time()
         print(f"process took {end - start} seconds.")
 
         print("Done.")
 
-    async def fetch(self, url: str, session):
+    def save_range(self, remaining):
+        """
+        Write the blocks and txs held in memory to the raw files of the range, once it has no gaps left but its holes.
+
+        Whole-range files have no journal, and a raw file without one counts as complete, so a range with
+        gaps is not written at all and the next run extracts it again. A range written again is taken out
+        of the parsed and loaded heights, so its new files are parsed even though their names were before.
+
+        Args:
+            remaining (set): The heights still missing blocks or transactions after the backfill.
+        """
+        if not self.record_holes(remaining):
+            print(f'{self.start_height}_{self.end_height} still has gaps, it is not written and will be extracted again.')
+            return
+        self.save_json(self.blocks, 'blocks')
+        self.save_json(self.txs, 'txs')
+        index = get_height_index(self.data_directory())
+        for stage in ('parsed', 'loaded'):
+            index.discard(stage, self.start_height, self.end_height)
+        self.mark_extracted()
+
+    def mark_extracted(self):
+        """
+        Record the range in the height index of the network, and that its extraction is finished.
+
+        Only called once the range has no gaps left but its holes, a range with gaps stays missing from
+        the index so the next run extracts it again.
+        """
+        index = get_height_index(self.data_directory())
+        index.add('extracted', self.start_height, self.end_height)
+        index.finish_range(self.start_height, self.end_height)
+
+    def permanent_heights(self):
+        """
+        The heights the node will never serve: those whose backfill request failed for good or for being too
+        large, and those listed in error_heights.txt as holding a single item too large to query.
+        """
+        heights = set()
+        for gap in self.gaps:
+            match = HEIGHT_URL.search(gap['url'])
+            if match and gap['failure'] in (PERMANENT, SIZE):
+                heights.add(int(match.group(1)))
+        path = f"{self.output_directory('errors')}/error_heights.txt"
+        if os.path.exists(path):
+            with open(path) as f:
+                heights.update(int(line) for line in f if line.strip())
+        return heights
+
+    def record_holes(self, remaining):
+        """
+        Record the heights still missing from the range as holes of the height index, if the node will
+        never serve any of them.
+
+        Without this a range with a permanent gap would never be marked extracted, and every run would
+        extract it again only to fail on the same heights.
+
+        Args:
+            remaining (set): The heights still missing blocks or transactions after the backfill.
+
+        Returns:
+            bool: Whether the range is complete but for its holes.
+        """
+        if not remaining:
+            return True
+        holes = remaining & self.permanent_heights()
+        if holes != remaining:
+            return False
+        heights = HeightSet()
+        for height in holes:
+            heights.add(height, height)
+        get_height_index(self.data_directory()).add_set('holes', heights)
+        print(f'{len(holes)} heights can not be extracted, recorded as holes: {sorted(holes)}')
+        return True
+
+    @property
+    def max_concurrency(self):
+        """
+        The most requests that can ever be in flight at once.
+        """
+        return (self.max_semaphore if self.semaphore == 'auto' else self.semaphore) * len(self.pool)
+
+    def get_limiter(self):
         """
-        Fetch the data from the URL.
+        Get the limiter bounding the number of simultaneous requests.
+
+        With semaphore='auto' the same AdaptiveLimiter is reused across calls, so what it learned
+        from the block pages carries over to the tx pages.
+
+        Returns:
+            asyncio.Semaphore or AdaptiveLimiter: The limiter to use with bounded_fetch.
+        """
+        if self.semaphore != 'auto':
+            return asyncio.Semaphore(self.semaphore * len(self.pool))
+        if self.limiter is None:
+            self.limiter = AdaptiveLimiter(initial=4 * len(self.pool), max_limit=self.max_concurrency)
+        return self.limiter
+
+    def record_outcome(self, request_start, status):
+        """
+        Feed the outcome of a request to the adaptive limiter, if there is one.
+
+        Args:
+            request_start (float): When the request was sent.
+            status (int): The HTTP status of the response, or None if the request failed.
+        """
+        if self.limiter is not None:
+            self.limiter.record(time.time() - request_start, status)
+
+    def get_cache(self):
+        """
+        Get the response cache of the network, or None if caching is off.
+        """
+        if self.cache is None and self.cache_max_bytes:
+            self.cache = ResponseCache(f"{self.data_directory()}/cache", self.cache_max_bytes)
+        return self.cache
+
+    def report_concurrency(self):
+        if self.hedger is not None:
+            print(self.hedger.report())
+        if self.cache is not None:
+            print(self.cache.report())
+        if self.rate_limiter.rate_limited or self.rate_limiter.waited:
+            print(self.rate_limiter.report())
+        if self.limiter is not None:
+            self.concurrency = self.limiter.converged
+            print(self.limiter.report())
+        if len(self.pool) > 1:
+            for usage in self.pool.get_api_usage():
+                print(f"{usage['api']}: {usage['total_calls']} calls, hit rate {usage['hit_rate']:.2f}, ewma latency {usage['ewma_latency'] or 0:.3f}s")
+
+    async def decode(self, decode, body):
+        """
+        Decode a response body, in the decoder unless it is small.
+
+        Args:
+            decode (callable): The function to decode the body with, it must be picklable to run in a decoder process.
+            body (bytes): The body of the response.
+        """
+        if len(body) < INLINE_DECODE_BYTES:
+            return decode(body)
+        return await asyncio.get_running_loop().run_in_executor(get_decoder(self.decode_workers), decode, body)
+
+    async def fetch(self, url: str, session, decode=orjson.loads):
+        """
+        Fetch the data from the URL, hedging the request if it is slow.
+
+        With hedging on, a request still unanswered after the hedge percentile of recent latencies gets a
+        duplicate, routed by the endpoint pool like any other request, and whichever copy answers first wins.
+        The duplicates run in the slot of the original and are capped by the hedge budget, see Hedger.
 
         Args:
             url (str): The URL to fetch the data from.
             session (aiohttp.ClientSession): The session to use for the request.
+            decode (callable): The function to decode the body with, or None to return the raw bytes.
 
         Returns:
-            dict: The JSON data from the response.
+            dict: The JSON data from the response, or whatever decode turned the body into. None if no copy
+                came back, the request is then recorded in self.gaps, once.
         """
-        while True:
-            try:
-                async with session.get(url) as response:
-                    if response.status == 429:
-                        print(f"Rate limit exceeded. Sleeping for 10 seconds.")
-                        await asyncio.sleep(10)  # sleep for 10 seconds
-                        continue
+        if self.hedger is None:
+            return self.settle(url, await self.fetch_direct(url, session, decode))
+
+        self.hedger.start()
+        attempts = [asyncio.create_task(self.fetch_direct(url, session, decode))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedger.delay())
+            if not done and self.hedger.allow():
+                attempts.append(asyncio.create_task(self.fetch_direct(url, session, decode)))
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.result()[0] is not None:
+                        self.hedger.record_win(attempt is not attempts[0])
+                        return attempt.result()[0]
+            # neither copy came back, the one asked first tells what went wrong
+            return self.settle(url, attempts[0].result())
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+
+    async def fetch_direct(self, url: str, session, decode=orjson.loads):
+        """
+        Fetch the data from the URL, without hedging.
 
-                    if response.status != 200:
-                        print(f"Failed to get response from {url}, status code: {response.status}")
-                        return None
+        Relative URLs are routed to the endpoint of the pool expected to answer soonest.
+        The body is read as bytes and decoded off the event loop. With a response cache, cached
+        responses are served from disk and new ones are stored once they decode.
 
-                    if response.content_type != 'application/json':
-                        print(f"Unexpected content type in response from {url}, content type: {response.content_type}")
-                        return None
+        Args:
+            url (str): The URL to fetch the data from.
+            session (aiohttp.ClientSession): The session to use for the request.
+            decode (callable): The function to decode the body with, or None to return the raw bytes.
 
-                    return await response.json()
+        Returns:
+            tuple: The JSON data from the response, or whatever decode turned the body into, and None,
+                or None and the failure the request was given up on with, see settle.
+        """
+        cache = self.get_cache()
+        if cache is not None and decode is not None:
+            body = cache.get(url)
+            if body is not None:
+                try:
+                    return await self.decode(decode, body), None
+                except orjson.JSONDecodeError:
+                    cache.discard(url)
 
+        attempt = 0
+        while True:
+            api_url = self.pool.choose()
+            full_url = url if url.startswith('http') else f'{api_url}{url}'
+            reserved = await self.rate_limiter.acquire(api_url)
+            request_start = time.time()
+            status = None
+            content_type = None
+            retry_after = None
+            body = None
+            error = None
+            self.pool.start(api_url)
+            try:
+                async with session.get(full_url, timeout=self.timeout) as response:
+                    status = response.status
+                    content_type = response.content_type
+                    retry_after = response.headers.get('Retry-After')
+                    if status == 200 and content_type == 'application/json':
+                        body = await response.read()
+            except asyncio.CancelledError:
+                self.pool.cancel(api_url)
+                raise
             except Exception as e:
-                print(f"Failed to get response from {url}")
-                print(f"Error details: {e}")
-                await asyncio.sleep(5)
+                status = None
+                error = e
+            self.pool.finish(api_url, request_start, ok=body is not None)
+            self.record_outcome(request_start, status)
+            if body is not None:
+                self.rate_limiter.record_response(api_url, reserved, len(body))
+                if self.hedger is not None:
+                    self.hedger.record(time.time() - request_start)
+
+            if status == 429:
+                # the pause is shared by every request to the endpoint, the others are routed elsewhere meanwhile
+                delay = self.rate_limiter.record_rate_limited(api_url, request_start, retry_after)
+                self.pool.bench(api_url, delay)
+                print(f"Rate limit exceeded on {api_url}, pausing it for {delay:.1f} seconds.")
                 continue
 
+            if body is not None:
+                if decode is None:
+                    return body, None
+                try:
+                    data = await self.decode(decode, body)
+                except orjson.JSONDecodeError as e:
+                    # a complete body that does not parse was cut short by the node or a proxy, it will be again
+                    error = e
+                else:
+                    if cache is not None and data is not None and (not isinstance(data, dict) or 'result' in data):
+                        cache.put(url, body)
+                    return data, None
+
+            failure = self.classify_failure(status, content_type, error)
+            description = error if error is not None else f"status code {status}, content type {content_type}"
+            if failure == RETRYABLE and attempt < self.max_retries:
+                delay = self.retry_delay(attempt)
+                attempt += 1
+                print(f"Failed to get response from {full_url} ({description}), retry {attempt} of {self.max_retries} in {delay:.1f} seconds.")
+                await asyncio.sleep(delay)
+                continue
+
+            print(f"Giving up on {full_url} after {attempt + 1} attempts, {failure} failure: {description}")
+            return None, {'url': url, 'failure': failure, 'error': str(description)}
+
+    def settle(self, url, result):
+        """
+        Record the gap of a request given up on, once no other copy of it can come back.
+
+        Args:
+            url (str): The URL of the request.
+            result (tuple): What fetch_direct returned for it.
+
+        Returns:
+            dict: The data of the response, or None if there was none.
+        """
+        data, gap = result
+        if gap is not None:
+            if gap['failure'] == SIZE:
+                self.record_tx_page_too_large(url)
+            self.gaps.append(gap)
+        return data
+
+    @staticmethod
+    def classify_failure(status, content_type, error):
+        """
+        Tell whether a failed request is worth retrying.
+
+        Args:
+            status (int): The HTTP status of the response, or None if there was none.
+            content_type (str): The content type of the response.
+            error (Exception): What was raised while sending the request or decoding its response, if anything.
+
+        Returns:
+            str: RETRYABLE for timeouts, dropped connections and overloaded nodes, SIZE for responses too
+                large to come back, which are repaired height by height by the backfill instead, and
+                PERMANENT for requests the node will never answer.
+        """
+        if isinstance(error, orjson.JSONDecodeError) or status == 413:
+            return SIZE
+        if error is not None:
+            if isinstance(error, aiohttp.InvalidURL):
+                return PERMANENT
+            return RETRYABLE
+        if status in (408, 425, 500, 502, 503, 504) or (status == 200 and content_type != 'application/json'):
+            return RETRYABLE
+        return PERMANENT
+
+    def retry_delay(self, attempt):
+        """
+        The jittered exponential backoff before a retry, so the retries of a burst of failures spread out.
+        """
+        return random.uniform(0.5, 1.0) * min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+
+    def save_gaps(self):
+        """
+        Append the requests given up on to the errors directory, with the range they belong to.
+        """
+        if not self.gaps:
+            return
+        os.makedirs(self.output_directory('errors'), exist_ok=True)
+        with open(f"{self.output_directory('errors')}/failed_requests.ndjson", 'ab') as f:
+            for gap in self.gaps:
+                f.write(orjson.dumps(dict(gap, start_height=self.start_height, end_height=self.end_height)) + b'\n')
+        print(f"{len(self.gaps)} requests failed: " + ', '.join(
+            f"{sum(gap['failure'] == failure for gap in self.gaps)} {failure}" for failure in (RETRYABLE, SIZE, PERMANENT)))
+        self.gaps = []
+
+    def make_session(self):
+        """
+        Create the HTTP session, its connection pool sized to the concurrency budget.
+        """
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
 
-    async def fetch_all(self, urls):
+    async def fetch_all(self, urls, session=None, semaphore=None, decode=orjson.loads):
         """
         Fetch the data from all the URLs.
 
         Args:
             urls (list): The list of URLs to fetch the data from.
+            session (aiohttp.ClientSession): A session to share with other fetches, a new one is opened if not given.
+            semaphore (asyncio.Semaphore): A limiter to share with other fetches, a new one is made if not given.
+            decode (callable): The function to decode each body with, see fetch.
 
         Returns:
             list: The list of JSON data from the responses.
         """
-        semaphore = asyncio.Semaphore(self.semaphore)  # limit the number of simultaneous requests
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for url in urls:
-                task = self.bounded_fetch(semaphore, url, session)
-                tasks.append(task)
-            responses = await asyncio.gather(*tasks)
-            return responses
+        if session is None:
+            async with self.make_session() as session:
+                return await self.fetch_all(urls, session, semaphore, decode)
+
+        if semaphore is None:
+            semaphore = self.get_limiter()  # limit the number of simultaneous requests
+        tasks = []
+        for url in urls:
+            task = self.bounded_fetch(semaphore, url, session, decode)
+            tasks.append(task)
+        responses = await asyncio.gather(*tasks)
+        self.report_concurrency()
+        return responses
+
+    async def iter_fetch(self, urls, session=None, semaphore=None, decode=orjson.loads):
+        """
+        Fetch the data from all the URLs, yielding each response as soon as it completes.
+
+        Finished responses are handed over through a queue bounded by the semaphore, and a request
+        keeps its slot until its response has been taken, so at most 2 x semaphore pages are held in memory.
+
+        Args:
+            urls (list or asyncio.Queue): The list of URLs to fetch the data from, or a queue URLs are put
+                in as they become known, ended by None.
+            session (aiohttp.ClientSession): A session to share with other fetches, a new one is opened if not given.
+            semaphore (asyncio.Semaphore): A limiter to share with other fetches, a new one is made if not given.
+            decode (callable): The function to decode each body with, see fetch.
+
+        Yields:
+            tuple: The URL and the decoded data from its response, in completion order.
+        """
+        if session is None:
+            async with self.make_session() as session:
+                async for item in self.iter_fetch(urls, session, semaphore, decode):
+                    yield item
+            return
+
+        if semaphore is None:
+            semaphore = self.get_limiter()
+        results = asyncio.Queue(maxsize=self.max_concurrency)
+
+        async def produce(url):
+            async with semaphore:
+                response = await self.fetch(url, session, decode)
+                await results.put((url, response))
 
-    async def bounded_fetch(self, semaphore, url, session):
+        tasks = []
+
+        async def feed():
+            try:
+                if isinstance(urls, asyncio.Queue):
+                    while (url := await urls.get()) is not None:
+                        tasks.append(asyncio.create_task(produce(url)))
+                else:
+                    tasks.extend(asyncio.create_task(produce(url)) for url in urls)
+                await asyncio.gather(*tasks)
+            except Exception as e:
+                await results.put(e)
+                return
+            await results.put(None)
+
+        feeder = asyncio.create_task(feed())
+        try:
+            while (item := await results.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task in [feeder] + tasks:
+                task.cancel()
+            await asyncio.gather(feeder, *tasks, return_exceptions=True)
+        self.report_concurrency()
+
+    async def bounded_fetch(self, semaphore, url, session, decode=orjson.loads):
         """
         Fetch the data from the URL with rate limiting.
 
@@ -392,12 +1072,13 @@ class DataExtractor:
             semaphore (asyncio.Semaphore): The semaphore to limit the number of simultaneous requests.
             url (str): The URL to fetch the data from.
             session (aiohttp.ClientSession): The session to use for the request.
+            decode (callable): The function to decode the body with, see fetch.
 
         Returns:
             dict: The JSON data from the response.
         """
         async with semaphore:
-            return await self.fetch(url, session)
+            return await self.fetch(url, session, decode)
 
     async def process_responses(self, responses, data_key):
         """
@@ -418,52 +1099,395 @@ class DataExtractor:
         return data
 
 
-    async def async_extract(self):
+    def data_directory(self):
         """
-        Run the extract process.
+        The directory all raw data of the network is written under.
         """
+        return f"/app/data/{self.network}/{self.protocol}"
 
-        start = time.time()
+    def output_directory(self, prefix):
+        """
+        The directory raw data of the given kind is written to.
+
+        Args:
+            prefix (str): The kind of data, 'blocks' or 'txs'.
+        """
+        return f"{self.data_directory()}/{prefix}"
+
+    def get_journal(self, prefix):
+        """
+        Get the journal of the range for blocks or txs, loading what earlier runs extracted.
+
+        Args:
+            prefix (str): The prefix of the output directory.
+        """
+        if prefix not in self.journals:
+            plan = f'tx_ranges:{self.tx_pages_per_range}:{self.tx_plan_window}' if prefix == 'txs' else None
+            self.journals[prefix] = ExtractionJournal(self.output_directory(prefix), self.start_height, self.end_height, self.per_page, plan=plan)
+        return self.journals[prefix]
+
+    async def stream_to_segments(self, urls, data_key, prefix, session=None, semaphore=None, on_page=None):
+        """
+        Fetch the URLs and append every page to rolling NDJSON segments as it arrives.
+
+        Progress is journaled per range, so pages extracted by an earlier run that stopped part way
+        are skipped. Marking the range complete is left to async_stream_extract, after the gaps are repaired.
 
-        block_urls = self.generate_urls(
+        Args:
+            urls (list or asyncio.Queue): The list of URLs to fetch the data from, or a queue of URLs
+                still to be planned, see iter_fetch. Queued URLs are expected to skip journaled pages already.
+            data_key (str): The key in the response JSON where the data is stored.
+            prefix (str): The prefix of the output directory.
+            session (aiohttp.ClientSession): A session to share with other fetches.
+            semaphore (asyncio.Semaphore): A limiter to share with other fetches.
+            on_page (callable): Called with the URL, the number of txs per height, the total count of the
+                query and the size of the body of every page, see page_lines, or with the URL and three Nones
+                for a page that failed.
+
+        Returns:
+            int: The number of records written.
+        """
+        directory = self.output_directory(prefix)
+        journal = self.get_journal(prefix)
+        self.failed_pages[prefix] = []
+        if journal.complete:
+            print(f'{prefix} for {self.start_height}_{self.end_height} already extracted.')
+            return 0
+        remaining_urls = urls
+        if not isinstance(urls, asyncio.Queue):
+            remaining_urls = [url for url in urls if url not in journal.completed_pages]
+            if len(remaining_urls) < len(urls):
+                print(f'Resuming {prefix}: {len(urls) - len(remaining_urls)} of {len(urls)} pages already extracted.')
+
+        # pages are turned into segment lines in the decoder, the event loop only moves bytes
+        decode = partial(page_lines, data_key=data_key)
+        with SegmentWriter(directory, self.start_height, self.end_height, journal=journal, compression_level=self.compression_level) as writer:
+            async for url, page in self.iter_fetch(remaining_urls, session, semaphore, decode):
+                if page is not None:
+                    lines, count, tx_counts, total_count, num_bytes = page
+                    writer.write_lines(lines, count, page=url)
+                else:
+                    tx_counts = total_count = num_bytes = None
+                    self.failed_pages[prefix].append(url)
+                    print(f'No data for {url}')
+                if on_page is not None:
+                    on_page(url, tx_counts, total_count, num_bytes)
+
+        if self.failed_pages[prefix]:
+            print(f'{len(self.failed_pages[prefix])} {prefix} pages failed, their gaps will be backfilled.')
+        return writer.records
+
+    def get_block_urls(self):
+        """
+        Generate the block_search URLs covering the range.
+        """
+        return self.generate_urls(
             endpoint_format='{api_url}/block_search?query="block.height>={start} AND block.height<={end}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true'
         )
 
-        tx_total_count = int(requests.get(f'{self.api_url}/tx_search?query="tx.height>={self.start_init} AND tx.height<={self.end_init}"&page=1&per_page={self.per_page}&order_by="asc"&match_events=true').json()['result']['total_count'])
-        tx_total_pages = math.ceil(tx_total_count / self.per_page)
-        tx_urls = self.generate_urls(
-            endpoint_format='{api_url}/tx_search?query="tx.height>={start} AND tx.height<={end}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true', total_pages=tx_total_pages
-        )
+    def make_tx_planner(self):
+        """
+        Create the tx planner of the range, see TxPlanner.
+        """
+        self.tx_planner = TxPlanner(self.start_height, self.end_height, self.per_page, self.tx_pages_per_range, self.tx_plan_window)
+        self.tx_url_ranges = {}
+        self.tx_url_pages = {}
+        return self.tx_planner
+
+    def get_tx_urls(self, ranges):
+        """
+        Generate the tx_search URLs of height sub-ranges planned from the block headers.
+
+        tx_search gets slower with every page it has to skip, so instead of paging through the whole
+        range each sub-range is paged through on its own, with exactly as many pages as its txs fill.
+        The page size of a sub-range comes from the page sizer, so heights with heavy txs get pages small
+        enough to come back, unless an earlier run of the range already paged the sub-range with another.
+
+        Args:
+            ranges (list): (start_height, end_height, num_txs) tuples, see TxPlanner.
+
+        Returns:
+            list: A list of URLs.
+        """
+        urls = []
+        for start, end, num_txs in ranges:
+            per_page = self.tx_range_page_sizes.get((start, end)) or self.get_page_sizer('txs').per_page(start)
+            for page in range(1, math.ceil(num_txs / per_page) + 1):
+                url = f'/tx_search?query="tx.height>={start} AND tx.height<={end}"&page={page}&per_page={per_page}&order_by="asc"&match_events=true'
+                self.tx_url_ranges[url] = (start, end, num_txs)
+                self.tx_url_pages[url] = (start, per_page)
+                urls.append(url)
+        return urls
+
+    def record_tx_page(self, url, txs_per_height, total_count, num_bytes=None):
+        """
+        Count the txs of a tx_search page against the block headers, and teach the page sizer its size.
+        """
+        if txs_per_height is not None:
+            self.tx_planner.add_txs(txs_per_height)
+            if url in self.tx_url_ranges:
+                self.tx_planner.check_total(*self.tx_url_ranges[url], total_count)
+            if url in self.tx_url_pages and num_bytes is not None:
+                self.get_page_sizer('txs').record_success(*self.tx_url_pages[url], sum(txs_per_height.values()), num_bytes)
+
+    def record_tx_page_too_large(self, url):
+        """
+        Teach the page sizer that a tx_search page was too large to come back.
+        """
+        if url in self.tx_url_pages:
+            self.get_page_sizer('txs').record_too_large(*self.tx_url_pages[url])
+
+    def resume_tx_planner(self, block_urls):
+        """
+        Catch the tx planner up with the segments of an earlier run of the range.
 
-        # Fetch the data for each URLsema
-        block_responses = await self.fetch_all(block_urls)
-        print(f'block_responses complete in {time.time() - start} seconds.')
-        tx_responses = await self.fetch_all(tx_urls)
-        print(f'tx responses complete in {time.time() - start} seconds.')
+        The block pages journaled before are planned from their segments like they would have been from
+        their responses, and the txs already extracted are counted. The sub-ranges an earlier run paged
+        keep the page size it used, so their remaining pages line up with the journaled ones.
 
-        # Process the responses
-        self.blocks = await self.process_responses(block_responses, 'blocks')
-        print(f'block responses processed in {time.time() - start} seconds.')
-        self.txs = await self.process_responses(tx_responses, 'txs')
-        print(f'txs responses processed in {time.time() - start} seconds.')
+        Args:
+            block_urls (list): The block_search URLs of the range.
+
+        Returns:
+            list: The (start_height, end_height, num_txs) sub-ranges of the windows this completes.
+        """
+        blocks_journal = self.get_journal('blocks')
+        block_pages = {}
+        for segment in blocks_journal.segments:
+            tx_counts = self.txs_per_height(read_segment(f"{self.output_directory('blocks')}/{segment}"), 'blocks')
+            if any(page.startswith('backfill:') for page in blocks_journal.segment_pages[segment]):
+                # not planned from, the txs of backfilled blocks were backfilled with them
+                self.tx_planner.add_headers(tx_counts)
+                continue
+            for height, count in tx_counts.items():
+                block_pages.setdefault((height - self.start_height) // self.per_page, {})[height] = count
+
+        for url in self.get_journal('txs').completed_pages:
+            match = TX_PAGE_URL.search(url)
+            if match:
+                start, end, per_page = map(int, match.groups())
+                self.tx_range_page_sizes[(start, end)] = per_page
+
+        ranges = []
+        for block_page, url in enumerate(block_urls):
+            if url in blocks_journal.completed_pages:
+                ranges.extend(self.tx_planner.add_block_page(block_page, block_pages.get(block_page)))
+
+        for segment in self.get_journal('txs').segments:
+            self.tx_planner.add_txs(self.txs_per_height(read_segment(f"{self.output_directory('txs')}/{segment}"), 'txs'))
+        return ranges
+
+    async def async_stream_extract(self):
+        """
+        Run the extract process, flushing pages to disk as they arrive.
+
+        Blocks and txs are streamed at the same time over one connection pool and one concurrency budget.
+        The tx pages are planned from the block headers as they are written, see TxPlanner.
+        """
+
+        start = time.time()
+        # recorded before the first page is journaled, so a run that stops part way is resumed, see determine_height
+        get_height_index(self.data_directory()).start_range(self.start_height, self.end_height)
+        planner = self.make_tx_planner()
+        block_urls = self.get_block_urls()
+        block_pages = {url: block_page for block_page, url in enumerate(block_urls)}
+        tx_urls = asyncio.Queue()
+        tx_journal = self.get_journal('txs')
+
+        def plan_txs(ranges):
+            for url in self.get_tx_urls(ranges):
+                if url not in tx_journal.completed_pages:
+                    tx_urls.put_nowait(url)
+
+        def on_block_page(url, tx_counts, total_count, num_bytes):
+            plan_txs(planner.add_block_page(block_pages[url], tx_counts))
+
+        async def stream_blocks(session, semaphore):
+            try:
+                # the blocks of an earlier run are not fetched again, their txs are planned from disk
+                plan_txs(self.resume_tx_planner(block_urls))
+                num_blocks = await self.stream_to_segments(block_urls, 'blocks', 'blocks', session, semaphore, on_page=on_block_page)
+            finally:
+                tx_urls.put_nowait(None)
+            self.records['blocks'] = num_blocks
+            print(f'{num_blocks} blocks written in {time.time() - start} seconds.')
+
+        async def stream_txs(session, semaphore):
+            num_txs = await self.stream_to_segments(tx_urls, 'txs', 'txs', session, semaphore, on_page=self.record_tx_page)
+            self.records['txs'] = num_txs
+            print(f'{num_txs} txs written in {time.time() - start} seconds.')
+
+        async with self.make_session() as session:
+            semaphore = self.get_limiter()
+            await asyncio.gather(stream_blocks(session, semaphore), stream_txs(session, semaphore))
+            print(planner.report())
+
+            if not all(journal.complete for journal in self.journals.values()):
+                remaining = await self.backfill_segments(session, semaphore)
+                print(f'backfilling complete in {time.time() - start} seconds.')
+                complete = self.record_holes(remaining)
+                for prefix, journal in self.journals.items():
+                    # from here on the gaps of failed pages are the backfill's job, fetching the pages again would duplicate them
+                    if self.failed_pages[prefix]:
+                        journal.record_segment(None, self.failed_pages[prefix])
+                    if complete and not journal.complete:
+                        journal.mark_complete()
+            if all(journal.complete for journal in self.journals.values()):
+                self.mark_extracted()
+        self.get_page_sizer('txs').save()
+        self.save_gaps()
+
+        end = time.time()
+        print(f"process took {end - start} seconds.")
+
+        print("Done.")
+
+    async def fetch_range(self, session, semaphore):
+        """
+        Fetch the blocks and txs of the range into self.blocks and self.txs, and backfill their gaps.
+
+        Blocks and txs are fetched at the same time over one connection pool and one concurrency budget,
+        the tx pages being planned from the block headers as they come in, see TxPlanner.
+
+        Args:
+            session (aiohttp.ClientSession): The session to use for the requests.
+            semaphore (asyncio.Semaphore): The limiter bounding the number of simultaneous requests.
+
+        Returns:
+            set: The heights still missing blocks or transactions.
+        """
+        start = time.time()
+        planner = self.make_tx_planner()
+        block_urls = self.get_block_urls()
+        block_pages = {url: block_page for block_page, url in enumerate(block_urls)}
+        tx_urls = asyncio.Queue()
+
+        async def fetch_blocks():
+            blocks = []
+            try:
+                async for url, response in self.iter_fetch(block_urls, session, semaphore):
+                    page_blocks = await self.process_responses([response], 'blocks')
+                    blocks.extend(page_blocks)
+                    tx_counts = self.txs_per_height(page_blocks, 'blocks') if response is not None and 'result' in response else None
+                    for tx_url in self.get_tx_urls(planner.add_block_page(block_pages[url], tx_counts)):
+                        tx_urls.put_nowait(tx_url)
+            finally:
+                tx_urls.put_nowait(None)
+            print(f'block responses complete in {time.time() - start} seconds.')
+            return blocks
+
+        async def fetch_txs():
+            txs = []
+            async for url, page in self.iter_fetch(tx_urls, session, semaphore, sized_loads):
+                if page is not None:
+                    response, num_bytes = page
+                    page_txs = response['result']['txs']
+                    txs.extend(page_txs)
+                    self.record_tx_page(url, self.txs_per_height(page_txs, 'txs'), int(response['result']['total_count']), num_bytes)
+            print(f'tx responses complete in {time.time() - start} seconds.')
+            return txs
+
+        self.blocks, self.txs = await asyncio.gather(fetch_blocks(), fetch_txs())
+        print(planner.report())
+
+        remaining = await self.backfill_records(session, semaphore)
+        print(f'backfilling complete in {time.time() - start} seconds.')
+        return remaining
+
+    async def async_extract(self):
+        """
+        Run the extract process.
+        """
+
+        if self.stream:
+            return await self.async_stream_extract()
+
+        start = time.time()
+        # opened before the range is written, so a first index is not seeded with a range that has gaps
+        get_height_index(self.data_directory())
+
+        async with self.make_session() as session:
+            remaining = await self.fetch_range(session, self.get_limiter())
 
         self.blocks_df = pd.DataFrame(self.blocks)
         self.tx_df = pd.DataFrame(self.txs)
-        
-        #await self.backfill()
-        print(f'backfilling complete in {time.time() - start} seconds.')
 
         # download
-        self.save_json(self.blocks, 'blocks')
-        self.save_json(self.txs, 'txs')
+        self.save_range(remaining)
+        self.get_page_sizer('txs').save()
+        self.save_gaps()
 
         end = time.time()
         print(f"process took {end - start} seconds.")
 
         print("Done.")
 
-def get_min_height(api_url):
-    r = requests.get(f'{api_url}/block?height=1')
+def extract_shard(shard_kwargs):
+    """
+    Extract one shard in its own event loop. Runs inside a worker process of extract_sharded.
+
+    Args:
+        shard_kwargs (dict): The keyword arguments for the shard's DataExtractor.
+
+    Returns:
+        tuple: The shard's start height, end height and the number of records written per data type.
+    """
+    # a forked worker inherits the decoders of the parent, but not their threads or processes
+    _decoders.clear()
+    extractor = DataExtractor(**shard_kwargs)
+    try:
+        asyncio.run(extractor.async_extract())
+    finally:
+        shutdown_decoders()
+    return extractor.start_height, extractor.end_height, extractor.records
+
+def extract_sharded(start_height, end_height, shards, workers=None, **kwargs):
+    """
+    Split [start_height, end_height] into shards and extract them in a pool of worker processes.
+
+    Each shard streams into its own segments and journal, named after the shard's own range, so a shard
+    that fails is picked up again like any other unfinished range. Every worker runs its own event loop
+    and its own concurrency limit, so the load on the nodes grows with the number of workers.
+
+    Args:
+        start_height (int): The starting block height for the extraction.
+        end_height (int): The ending block height for the extraction.
+        shards (int): The number of shards to split the range into.
+        workers (int): The number of worker processes, defaults to one per shard up to the number of cores.
+        **kwargs: The remaining DataExtractor arguments, shared by every shard.
+
+    Returns:
+        dict: The number of records written per data type, summed over the shards.
+    """
+    start = time.time()
+    shard_size = math.ceil((end_height - start_height + 1) / shards)
+    shard_kwargs = [dict(kwargs, start_height=shard_start, end_height=min(shard_start + shard_size - 1, end_height), stream=True)
+                    for shard_start in range(start_height, end_height + 1, shard_size)]
+    workers = workers or min(len(shard_kwargs), os.cpu_count())
+
+    totals = {}
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract_shard, kwargs): kwargs for kwargs in shard_kwargs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            kwargs = futures[future]
+            try:
+                shard_start, shard_end, records = future.result()
+            except Exception as e:
+                failed.append((kwargs['start_height'], kwargs['end_height']))
+                print(f"Shard {kwargs['start_height']}_{kwargs['end_height']} failed: {e}")
+                continue
+            for data_type, count in records.items():
+                totals[data_type] = totals.get(data_type, 0) + count
+            print(f"Shard {shard_start}_{shard_end} done ({done}/{len(futures)}), {totals} records so far after {time.time() - start} seconds.")
+
+    if failed:
+        print(f"{len(failed)} shards failed and will be resumed on the next run: {failed}")
+    print(f"Sharded extraction took {time.time() - start} seconds.")
+    return totals
+
+def get_min_height(api_url, connect_timeout=10.0, read_timeout=30.0):
+    r = requests.get(f'{api_url}/block?height=1', timeout=(connect_timeout, read_timeout))
     json = r.json()
 
     if 'result' in json.keys():
@@ -473,26 +1497,51 @@ def get_min_height(api_url):
         min_block = int(json['error']['data'].split(' ')[-1])
     return min_block
 
-def get_max_height(api_url):
-    r = requests.get(f'{api_url}/abci_info?')
+def get_max_height(api_url, connect_timeout=10.0, read_timeout=30.0):
+    r = requests.get(f'{api_url}/abci_info?', timeout=(connect_timeout, read_timeout))
     json = r.json()
     max_block = int(json['result']['response']['last_block_height'])
 
     return max_block
 
+def get_file_range(file):
+    """
+    Read the (start_height, end_height) range a raw data file covers from its name.
+    """
+    start_height, end_height = file.split('/')[-1].split('.')[0].split('_')[:2]
+    return int(start_height), int(end_height)
+
+def get_complete_raw_files(directory):
+    """
+    List the raw data files of ranges whose extraction has finished.
+    """
+    files = list_raw_files(directory)
+    complete = {r for r in set(map(get_file_range, files)) if is_range_complete(directory, *r)}
+    return [file for file in files if get_file_range(file) in complete]
+
+def get_height_index(directory):
+    """
+    Open the height index of a raw data directory, building its extracted heights from the raw files and its
+    started ranges from the journals the first time.
+
+    Args:
+        directory (str): The raw data directory of the network, e.g. ./data/akash/rpc.
+
+    Returns:
+        HeightIndex: The index.
+    """
+    index = HeightIndex(directory)
+    if not index.has('extracted'):
+        index.seed('extracted', set(map(get_file_range, get_complete_raw_files(f"{directory}/blocks"))))
+    if index.started is None:
+        index.seed_started(set(get_incomplete_ranges(f"{directory}/blocks") + get_incomplete_ranges(f"{directory}/txs")))
+    return index
+
 def get_min_ingested_height(directory):
-    files = glob.glob(f"{directory}/*.json")
-    min_height = min(int(file.split('/')[-1].split('_')[0]) for file in files) if files else 0
-    return min_height
+    return get_height_index(os.path.dirname(directory.rstrip('/'))).heights('extracted').min or 0
 
 def get_max_ingested_height(directory):
-    files = glob.glob(f"{directory}/*.json")
-    if files:
-        max_height = max(int(file.split('/')[-1].split('_')[1].split('.')[0]) for file in files)
-    else:
-        max_height = 0  # or some other appropriate value
-        
-    return max_height
+    return get_height_index(os.path.dirname(directory.rstrip('/'))).heights('extracted').max or 0
 
 
 if __name__ == "__main__":
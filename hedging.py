@@ -0,0 +1,75 @@
+from collections import deque
+
+
+class Hedger:
+    """
+    Decide when a slow request gets a duplicate, from a rolling percentile of recent latencies.
+
+    A request still unanswered after the `percentile` latency of the last `window` responses is
+    probably stuck behind a slow node or a heavy page, and a duplicate sent now tends to come back
+    before it. Duplicates are capped at `budget` times the number of requests, so hedging adds at
+    most that share of load however slow the nodes get.
+    """
+
+    def __init__(self, percentile: float = 0.95, budget: float = 0.05, window: int = 1000, min_samples: int = 50) -> None:
+        """
+        Initialize the Hedger.
+
+        Args:
+            percentile (float): The latency percentile after which a request is hedged, between 0 and 1.
+            budget (float): The most hedges per request sent.
+            window (int): The number of recent latencies the percentile is taken over.
+            min_samples (int): Nothing is hedged until this many latencies were seen.
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.threshold = None
+        self.new_samples = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float) -> None:
+        """
+        Record the latency of a response.
+        """
+        self.latencies.append(latency)
+        self.new_samples += 1
+
+    def delay(self):
+        """
+        How long to wait for a new request before hedging it.
+
+        Returns:
+            float: The delay in seconds, or None while too few latencies were seen.
+        """
+        if len(self.latencies) < self.min_samples:
+            return None
+        # sorting the window on every request would cost more than the requests, refresh it now and then
+        if self.threshold is None or self.new_samples >= self.latencies.maxlen // 20:
+            ordered = sorted(self.latencies)
+            self.threshold = ordered[int(self.percentile * (len(ordered) - 1))]
+            self.new_samples = 0
+        return self.threshold
+
+    def start(self) -> None:
+        self.requests += 1
+
+    def allow(self) -> bool:
+        """
+        Take a hedge out of the budget, if there is one left.
+        """
+        if self.hedges + 1 > self.budget * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+    def record_win(self, hedged: bool) -> None:
+        if hedged:
+            self.hedge_wins += 1
+
+    def report(self) -> str:
+        return (f"hedging: {self.hedges} hedges for {self.requests} requests, {self.hedge_wins} won, "
+                f"threshold {self.threshold or 0:.3f}s")
@@ -0,0 +1,253 @@
+import bisect
+import fcntl
+import os
+from contextlib import contextmanager
+import orjson
+
+
+class HeightSet:
+    """
+    A set of heights kept as sorted, disjoint runs of consecutive heights.
+
+    Heights are ingested range by range, so a whole chain is a handful of runs however many heights it has,
+    and the holes between runs are exactly the ranges still missing. Looking up a height or the holes in an
+    interval only bisects the runs and walks the holes, it never visits heights one by one.
+    """
+
+    def __init__(self, runs=None) -> None:
+        """
+        Initialize the HeightSet.
+
+        Args:
+            runs (list): [start_height, end_height] pairs, inclusive, in any order and possibly overlapping.
+        """
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(runs or []):
+            self.add(start, end)
+
+    def add(self, start: int, end: int) -> None:
+        """
+        Add the heights from start to end, inclusive.
+        """
+        if end < start:
+            return
+        # the runs overlapping or touching [start, end] are merged into one
+        first = bisect.bisect_left(self.ends, start - 1)
+        last = bisect.bisect_right(self.starts, end + 1)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def remove(self, start: int, end: int) -> None:
+        """
+        Remove the heights from start to end, inclusive.
+        """
+        if end < start:
+            return
+        # the runs overlapping [start, end] are cut down to what lies outside of it
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        runs = []
+        if first < last:
+            if self.starts[first] < start:
+                runs.append((self.starts[first], start - 1))
+            if self.ends[last - 1] > end:
+                runs.append((end + 1, self.ends[last - 1]))
+        self.starts[first:last] = [run[0] for run in runs]
+        self.ends[first:last] = [run[1] for run in runs]
+
+    def update(self, other: 'HeightSet') -> None:
+        for start, end in other.runs():
+            self.add(start, end)
+
+    def __contains__(self, height: int) -> bool:
+        i = bisect.bisect_left(self.ends, height)
+        return i < len(self.starts) and self.starts[i] <= height
+
+    def __len__(self) -> int:
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def runs(self) -> list:
+        return list(zip(self.starts, self.ends))
+
+    def missing(self, start: int, end: int) -> list:
+        """
+        The intervals of [start, end] that are not in the set.
+
+        Args:
+            start (int): The first height of the interval.
+            end (int): The last height of the interval.
+
+        Returns:
+            list: (start_height, end_height) tuples, inclusive, in ascending order.
+        """
+        gaps = []
+        cursor = start
+        i = bisect.bisect_left(self.ends, start)
+        while i < len(self.starts) and self.starts[i] <= end:
+            if self.starts[i] > cursor:
+                gaps.append((cursor, self.starts[i] - 1))
+            cursor = max(cursor, self.ends[i] + 1)
+            i += 1
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def covered(self, start: int, end: int) -> list:
+        """
+        The intervals of [start, end] that are in the set, the counterpart of missing.
+        """
+        runs = []
+        i = bisect.bisect_left(self.ends, start)
+        while i < len(self.starts) and self.starts[i] <= end:
+            runs.append((max(start, self.starts[i]), min(end, self.ends[i])))
+            i += 1
+        return runs
+
+    @property
+    def min(self):
+        return self.starts[0] if self.starts else None
+
+    @property
+    def max(self):
+        return self.ends[-1] if self.ends else None
+
+
+class HeightIndex:
+    """
+    A persistent record of the heights of a network that have been extracted, parsed and loaded.
+
+    The index lives at `{directory}/heights.json`, one list of runs per stage, so reading it costs the same
+    however many raw files there are. Updates take a lock and re-read the file first, so the worker
+    processes of a sharded extraction and the stages of a pipeline can all record what they finished.
+    A stage missing from the file has not been recorded yet and can be seeded, see seed.
+    The heights the node could never serve are kept apart as holes, their ranges count as extracted.
+
+    Next to the stages, the index lists the ranges whose journaled extraction was started and not finished
+    yet, range by range, so finding the one to resume does not read the journal of every range ever extracted.
+    """
+
+    STAGES = ('extracted', 'parsed', 'loaded', 'holes')
+
+    def __init__(self, directory: str) -> None:
+        """
+        Initialize the HeightIndex, loading it if it exists.
+
+        Args:
+            directory (str): The raw data directory of the network, e.g. ./data/akash/rpc.
+        """
+        self.directory = directory
+        self.path = f"{directory}/heights.json"
+        self.stages = {}
+        self.started = None  # (start_height, end_height) ranges, None until recorded
+        self.load()
+
+    def load(self) -> None:
+        self.stages = {}
+        self.started = None
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                content = orjson.loads(f.read())
+            started = content.pop('started', None)
+            self.started = [tuple(r) for r in started] if started is not None else None
+            self.stages = {stage: HeightSet(runs) for stage, runs in content.items()}
+
+    def save(self) -> None:
+        content = {stage: heights.runs() for stage, heights in self.stages.items()}
+        if self.started is not None:
+            content['started'] = self.started
+        with open(f"{self.path}.tmp", 'wb') as f:
+            f.write(orjson.dumps(content))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+
+    @contextmanager
+    def update(self):
+        """
+        Hold the index lock, with the index freshly loaded, and save it afterwards.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.load()
+            yield
+            self.save()
+
+    def heights(self, stage: str) -> HeightSet:
+        return self.stages.get(stage, HeightSet())
+
+    def has(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def add(self, stage: str, start_height: int, end_height: int) -> None:
+        """
+        Record that the heights from start_height to end_height, inclusive, went through a stage.
+        """
+        with self.update():
+            self.stages.setdefault(stage, HeightSet()).add(start_height, end_height)
+
+    def add_set(self, stage: str, heights: HeightSet) -> None:
+        with self.update():
+            self.stages.setdefault(stage, HeightSet()).update(heights)
+
+    def seed(self, stage: str, ranges) -> None:
+        """
+        Record the ranges that went through a stage before the stage was indexed, if it is not indexed yet.
+
+        Args:
+            stage (str): The stage.
+            ranges (iterable): (start_height, end_height) tuples, inclusive.
+        """
+        with self.update():
+            if stage not in self.stages:
+                self.stages[stage] = HeightSet(ranges)
+
+    def discard(self, stage: str, start_height: int, end_height: int) -> None:
+        """
+        Record that the heights from start_height to end_height, inclusive, have to go through a stage again.
+        """
+        with self.update():
+            if stage in self.stages:
+                self.stages[stage].remove(start_height, end_height)
+
+    def start_range(self, start_height: int, end_height: int) -> None:
+        """
+        Record that the extraction of a range was started, until finish_range is called for it.
+        """
+        with self.update():
+            self.started = self.started or []
+            if (start_height, end_height) not in self.started:
+                self.started.append((start_height, end_height))
+
+    def finish_range(self, start_height: int, end_height: int) -> None:
+        with self.update():
+            if self.started is not None and (start_height, end_height) in self.started:
+                self.started.remove((start_height, end_height))
+
+    def seed_started(self, ranges) -> None:
+        """
+        Record the ranges started before they were indexed, if none are indexed yet, see seed.
+        """
+        with self.update():
+            if self.started is None:
+                self.started = sorted(ranges)
+
+    def started_ranges(self) -> list:
+        """
+        The ranges whose extraction was started and not finished, in height order.
+        """
+        return sorted(self.started or [])
+
+    def missing(self, stage: str, start_height: int, end_height: int) -> list:
+        """
+        The intervals of [start_height, end_height] that did not go through a stage yet, see HeightSet.missing.
+        """
+        return self.heights(stage).missing(start_height, end_height)
+
+    def report(self) -> str:
+        return ', '.join(f"{stage}: {len(self.heights(stage))} heights in {len(self.heights(stage).runs())} runs"
+                         for stage in self.STAGES)
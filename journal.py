@@ -0,0 +1,156 @@
+import glob
+import os
+import orjson
+
+
+class ExtractionJournal:
+    """
+    A durable record of which pages of a height range have been extracted.
+
+    The journal lives next to the segments as `{start_height}_{end_height}.journal`, one JSON object per line.
+    A segment and its pages are only journaled after the segment has been fsynced and renamed into place,
+    so every page in the journal is safely on disk, and any segment the journal does not know about is
+    left over from a crash and can be thrown away.
+    """
+
+    def __init__(self, directory: str, start_height: int, end_height: int, per_page: int, plan: str = None) -> None:
+        """
+        Initialize the ExtractionJournal, loading its previous state if there is one.
+
+        Args:
+            directory (str): The directory holding the segments of the range.
+            start_height (int): The first height of the range.
+            end_height (int): The last height of the range.
+            per_page (int): The page size, pages of another size can not be resumed.
+            plan (str): How the range is split into pages, pages of another plan can not be resumed either.
+        """
+        self.directory = directory
+        self.start_height = start_height
+        self.end_height = end_height
+        self.per_page = per_page
+        self.plan = plan
+        self.path = f"{directory}/{start_height}_{end_height}.journal"
+        self.completed_pages = set()
+        self.segments = []
+        self.segment_pages = {}  # segment -> the pages it holds
+        self.complete = False
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self) -> None:
+        """
+        Replay the journal and remove segments it does not account for.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                content = f.read()
+            if not content.endswith(b'\n'):
+                # a torn last line never happened, cut it off before appending behind it
+                content = content[:content.rfind(b'\n') + 1]
+                with open(self.path, 'wb') as f:
+                    f.write(content)
+            entries = [orjson.loads(line) for line in content.splitlines()]
+            header = entries[0] if entries else {}
+            if header.get('per_page') != self.per_page or header.get('plan') != self.plan:
+                print(f"Journal {self.path} was written with per_page={header.get('per_page')} and plan={header.get('plan')}, starting the range over.")
+                for segment in self.range_segments():
+                    os.remove(segment)
+                os.remove(self.path)
+            else:
+                for entry in entries[1:]:
+                    if 'segment' in entry:
+                        if entry['segment'] is not None:
+                            self.segments.append(entry['segment'])
+                            self.segment_pages[entry['segment']] = entry['pages']
+                        self.completed_pages.update(entry['pages'])
+                    elif entry.get('complete'):
+                        self.complete = True
+
+        if not os.path.exists(self.path):
+            header = {'start_height': self.start_height, 'end_height': self.end_height, 'per_page': self.per_page}
+            if self.plan is not None:
+                header['plan'] = self.plan
+            self._append(header)
+
+        for segment in self.range_segments():
+            if os.path.basename(segment) not in self.segments:
+                print(f"Removing {segment}, it was not journaled before the last run stopped.")
+                os.remove(segment)
+
+    def range_segments(self) -> list:
+        prefix = f"{self.directory}/{self.start_height}_{self.end_height}_"
+        return glob.glob(f"{prefix}*.ndjson*")  # plain or compressed, finished or not
+
+    @property
+    def next_seq(self) -> int:
+        """
+        The sequence number the next segment of the range should use.
+        """
+        return max((int(segment.split('_')[2].split('.')[0]) for segment in self.segments), default=-1) + 1
+
+    def _append(self, entry: dict) -> None:
+        with open(self.path, 'ab') as f:
+            f.write(orjson.dumps(entry) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_segment(self, segment: str, pages: list) -> None:
+        """
+        Record that a segment is on disk, together with the pages it holds.
+
+        Args:
+            segment (str): The path of the segment, or None if the pages had no records.
+            pages (list): The pages whose records are in the segment.
+        """
+        name = os.path.basename(segment) if segment is not None else None
+        self._append({'segment': name, 'pages': pages})
+        if name is not None:
+            self.segments.append(name)
+            self.segment_pages[name] = pages
+        self.completed_pages.update(pages)
+
+    def mark_complete(self) -> None:
+        """
+        Record that every page of the range has been extracted.
+        """
+        self._append({'complete': True})
+        self.complete = True
+
+
+def is_range_complete(directory: str, start_height: int, end_height: int) -> bool:
+    """
+    Check whether a range is finished, i.e. it has no journal or its journal is marked complete.
+
+    Ranges written before journaling existed have no journal and are complete.
+    """
+    path = f"{directory}/{start_height}_{end_height}.journal"
+    if not os.path.exists(path):
+        return True
+    with open(path, 'rb') as f:
+        return any(orjson.loads(line).get('complete') for line in f if line.endswith(b'\n'))
+
+
+def get_incomplete_ranges(directory: str) -> list:
+    """
+    List the ranges in a directory whose extraction was started but never finished.
+
+    Windows of the live tail are journaled per height without a page size and are finished by the tail
+    itself, they are left out so a batch extraction never resumes them with its own pages.
+
+    Args:
+        directory (str): The directory holding the segments and journals.
+
+    Returns:
+        list: (start_height, end_height) tuples, in height order.
+    """
+    ranges = []
+    for path in glob.glob(f"{directory}/*.journal"):
+        start_height, end_height = (int(x) for x in os.path.basename(path).split('.')[0].split('_'))
+        with open(path, 'rb') as f:
+            line = f.readline()
+        header = orjson.loads(line) if line.endswith(b'\n') else {}
+        if header.get('per_page') is None:
+            continue
+        if not is_range_complete(directory, start_height, end_height):
+            ranges.append((start_height, end_height))
+    return sorted(ranges)
@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+
+class AdaptiveLimiter:
+    """
+    An AIMD (additive increase, multiplicative decrease) concurrency limiter.
+
+    Works as a drop-in replacement for asyncio.Semaphore. Every healthy response grows the limit
+    by `increase / limit`, i.e. by `increase` per round trip of requests. A 429, a 5xx, a failed
+    request or a latency spike cuts the limit by `decrease`, at most once per round trip, so a burst
+    of errors from one window only counts once.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64, increase: float = 1.0,
+                 decrease: float = 0.5, latency_factor: float = 2.0, alpha: float = 0.1) -> None:
+        """
+        Initialize the AdaptiveLimiter.
+
+        Args:
+            initial (int): The starting number of in-flight requests.
+            min_limit (int): The limit never drops below this.
+            max_limit (int): The limit never grows above this.
+            increase (float): How much the limit grows per round trip while healthy.
+            decrease (float): The factor the limit is multiplied by on congestion.
+            latency_factor (float): A response slower than this multiple of the baseline latency is a spike.
+            alpha (float): The smoothing factor of the latency and limit moving averages.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.alpha = alpha
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.average_limit = float(initial)
+        self.successes = 0
+        self.failures = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # created lazily so the limiter can be built outside of a running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def record(self, latency: float, status) -> None:
+        """
+        Record the outcome of a request and adjust the limit.
+
+        Args:
+            latency (float): How long the request took, in seconds.
+            status (int): The HTTP status of the response, or None if the request failed.
+        """
+        failed = status is None or status == 429 or status >= 500
+        spiked = not failed and self.baseline_latency is not None and latency > self.baseline_latency * self.latency_factor
+        previous_limit = int(self.limit)
+
+        if failed or spiked:
+            self.failures += 1
+            now = time.monotonic()
+            # only back off once per round trip, the requests already in flight saw the same congestion
+            if now - self._last_decrease > (self.baseline_latency or latency):
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+        else:
+            self.successes += 1
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+
+        # slow responses still feed the baseline, so a node that is slower overall is not punished forever
+        if not failed:
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                self.baseline_latency += self.alpha * (latency - self.baseline_latency)
+
+        self.average_limit += self.alpha * (self.limit - self.average_limit)
+        # a raised limit lets waiting requests through
+        if int(self.limit) > previous_limit and self._condition is not None:
+            asyncio.get_running_loop().create_task(self._wake())
+
+    async def _wake(self) -> None:
+        async with self.condition:
+            self.condition.notify_all()
+
+    @property
+    def converged(self) -> int:
+        """
+        The concurrency the limiter has settled on, a moving average of the limit.
+        """
+        return round(self.average_limit)
+
+    def report(self) -> str:
+        return (f"concurrency converged on {self.converged} "
+                f"(current limit {int(self.limit)}, {self.successes} healthy / {self.failures} congested responses, "
+                f"baseline latency {self.baseline_latency or 0:.3f}s)")
@@ -0,0 +1,277 @@
+import fcntl
+import math
+import os
+import orjson
+
+
+class PageSizer:
+    """
+    Choose page sizes for tx_search so responses stay under a byte budget.
+
+    The sizer learns how many bytes an item takes from the responses it sees, and remembers the page size
+    that last worked for each region of heights. Both are saved to disk, so heavy heights that needed small
+    pages once get small pages straight away on the next page and on the next run. Saving takes a lock and
+    merges into what is on disk, so the shards of a sharded extraction keep what each other learned.
+    """
+
+    def __init__(self, max_per_page: int, byte_budget: int = 800_000, region_size: int = 1000, path: str = None,
+                 alpha: float = 0.3) -> None:
+        """
+        Initialize the PageSizer, loading what it learned before if `path` exists.
+
+        Args:
+            max_per_page (int): The largest page size to ask for.
+            byte_budget (int): The response size to aim for. Tendermint's default max_body_bytes is 1MB.
+            region_size (int): The number of heights that share what is learned about them.
+            path (str): The file to persist the model to, or None to keep it in memory only.
+            alpha (float): The smoothing factor of the bytes per item moving average.
+        """
+        self.max_per_page = max_per_page
+        self.byte_budget = byte_budget
+        self.region_size = region_size
+        self.path = path
+        self.alpha = alpha
+        self.regions = {}  # region -> {'per_page': int, 'bytes_per_item': float}
+        self.bytes_per_item = None
+        self.learned = set()  # the regions learned about since the model was loaded
+        self.load()
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            model = orjson.loads(f.read())
+        return model if model.get('region_size') == self.region_size else None
+
+    def load(self) -> None:
+        model = self.read()
+        if model is not None:
+            self.regions = {int(region): stats for region, stats in model['regions'].items()}
+            self.bytes_per_item = model['bytes_per_item']
+
+    def save(self) -> None:
+        """
+        Save the model, keeping what other processes saved about the regions this one did not learn about.
+        """
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            model = self.read()
+            if model is not None:
+                regions = {int(region): stats for region, stats in model['regions'].items()}
+                regions.update({region: self.regions[region] for region in self.learned})
+                self.regions = regions
+                if not self.learned:
+                    self.bytes_per_item = model['bytes_per_item']
+            model = {'region_size': self.region_size, 'bytes_per_item': self.bytes_per_item,
+                     'regions': {str(region): stats for region, stats in self.regions.items()}}
+            with open(f"{self.path}.{os.getpid()}.tmp", 'wb') as f:
+                f.write(orjson.dumps(model))
+            os.replace(f"{self.path}.{os.getpid()}.tmp", self.path)
+
+    def region(self, height: int) -> int:
+        return height // self.region_size
+
+    def per_page(self, height: int) -> int:
+        """
+        The page size to start a query at the given height with.
+
+        Args:
+            height (int): The first height of the query.
+
+        Returns:
+            int: The page size.
+        """
+        stats = self.regions.get(self.region(height))
+        bytes_per_item = stats['bytes_per_item'] if stats else self.bytes_per_item
+        per_page = self.max_per_page
+        if bytes_per_item:
+            per_page = min(per_page, int(self.byte_budget // bytes_per_item))
+        if stats:
+            # grow back slowly from the size that last worked rather than jumping to the estimate
+            per_page = min(per_page, stats['per_page'] * 2)
+        return max(1, per_page)
+
+    def record_success(self, height: int, per_page: int, items: int, num_bytes: int) -> None:
+        """
+        Learn from a page that came back fine.
+
+        Args:
+            height (int): The first height of the query.
+            per_page (int): The page size that was asked for.
+            items (int): The number of items in the response.
+            num_bytes (int): The size of the response body.
+        """
+        if items == 0:
+            return
+        bytes_per_item = num_bytes / items
+        self.learned.add(self.region(height))
+        stats = self.regions.setdefault(self.region(height), {'per_page': per_page, 'bytes_per_item': bytes_per_item})
+        stats['bytes_per_item'] += self.alpha * (bytes_per_item - stats['bytes_per_item'])
+        stats['per_page'] = max(stats['per_page'], per_page) if items == per_page else stats['per_page']
+        if self.bytes_per_item is None:
+            self.bytes_per_item = bytes_per_item
+        else:
+            self.bytes_per_item += self.alpha * (bytes_per_item - self.bytes_per_item)
+
+    def record_too_large(self, height: int, per_page: int) -> None:
+        """
+        Learn from a page that was too large to come back.
+
+        Args:
+            height (int): The first height of the query.
+            per_page (int): The page size that failed.
+        """
+        self.learned.add(self.region(height))
+        stats = self.regions.setdefault(self.region(height), {'per_page': per_page, 'bytes_per_item': self.bytes_per_item or 0})
+        stats['per_page'] = max(1, min(stats['per_page'], per_page // 2))
+        # the items here are at least big enough to blow the budget at this page size
+        stats['bytes_per_item'] = max(stats['bytes_per_item'] or 0, self.byte_budget / per_page)
+
+
+def plan_tx_ranges(tx_counts: dict, per_page: int, pages_per_range: int = 1) -> list:
+    """
+    Split heights into sub-ranges of about `pages_per_range` pages of txs each, by the tx counts of their blocks.
+
+    tx_search re-scans its index up to the requested page, so a page deep into a large height range costs
+    more than the first pages of a small one. Paging through many small sub-ranges instead keeps every
+    request near the front of its query. Sub-ranges start and end at heights with txs, so empty heights
+    are never queried on their own, and they never span a height without a known count.
+
+    Args:
+        tx_counts (dict): Heights mapped to the number of txs in their block.
+        per_page (int): The page size the sub-ranges are queried with.
+        pages_per_range (int): The number of pages to aim for per sub-range. A single height with more
+            txs than that is a sub-range of its own.
+
+    Returns:
+        list: (start_height, end_height, num_txs) tuples, in ascending height order.
+    """
+    target = per_page * pages_per_range
+    ranges = []
+    start = previous = last = None
+    total = 0
+    for height in sorted(tx_counts):
+        count = tx_counts[height]
+        if start is not None and (height != previous + 1 or total + count > target):
+            ranges.append((start, last, total))
+            start = None
+        previous = height
+        if not count:
+            continue
+        if start is None:
+            start, total = height, 0
+        total += count
+        last = height
+    if start is not None:
+        ranges.append((start, last, total))
+    return ranges
+
+
+class TxPlanner:
+    """
+    Plan the tx_search pages of a range from its block headers, and check the txs extracted against them.
+
+    Every block header lists the txs of its height, so the headers give the exact number of txs to expect
+    per height. Empty heights are never queried, the sub-ranges that are come to a known number of pages,
+    and once the txs are in, the heights that came up short are known without asking the node again.
+
+    Block pages are planned together in windows of `window` pages, so the sparse stretches of a chain share
+    their tx pages rather than paying for one per block page. A window is planned once all of its block
+    pages are in, the failed ones included, so its plan does not depend on the order pages arrive in or on
+    the run that fetched them.
+    """
+
+    def __init__(self, start_height: int, end_height: int, per_page: int, pages_per_range: int = 1, window: int = 10) -> None:
+        """
+        Initialize the TxPlanner.
+
+        Args:
+            start_height (int): The first height of the range.
+            end_height (int): The last height of the range.
+            per_page (int): The page size of both the block_search and the tx_search pages.
+            pages_per_range (int): The number of tx pages to aim for per sub-range, see plan_tx_ranges.
+            window (int): The number of block pages planned together.
+        """
+        self.start_height = start_height
+        self.end_height = end_height
+        self.per_page = per_page
+        self.pages_per_range = pages_per_range
+        self.window = window
+        self.num_block_pages = (end_height - start_height) // per_page + 1
+        self.tx_counts = {}  # height -> txs listed in its block header
+        self.extracted = {}  # height -> txs extracted
+        self.windows = {}  # window -> (block pages in so far, tx counts of their heights)
+        self.planned_ranges = 0
+        self.planned_pages = 0
+        self.mismatches = 0
+
+    def add_headers(self, tx_counts: dict) -> None:
+        """
+        Record block headers that are not planned from, e.g. backfilled ones.
+        """
+        self.tx_counts.update(tx_counts)
+
+    def add_block_page(self, block_page: int, tx_counts) -> list:
+        """
+        Record a block page, and plan its window if it was the last one missing.
+
+        Args:
+            block_page (int): The index of the page among the block pages of the range, from 0.
+            tx_counts (dict): The number of txs per height of the page, or None if the page failed.
+
+        Returns:
+            list: The (start_height, end_height, num_txs) sub-ranges to query, if the window is complete.
+        """
+        window = block_page // self.window
+        pages, counts = self.windows.setdefault(window, (0, {}))
+        if tx_counts:
+            self.add_headers(tx_counts)
+            counts.update(tx_counts)
+        pages += 1
+        if pages < min(self.window, self.num_block_pages - window * self.window):
+            self.windows[window] = (pages, counts)
+            return []
+        del self.windows[window]
+        ranges = plan_tx_ranges(counts, self.per_page, self.pages_per_range)
+        self.planned_ranges += len(ranges)
+        self.planned_pages += sum(math.ceil(num_txs / self.per_page) for _, _, num_txs in ranges)
+        return ranges
+
+    def add_txs(self, txs_per_height: dict) -> None:
+        """
+        Record extracted txs.
+
+        Args:
+            txs_per_height (dict): The number of txs extracted per height.
+        """
+        for height, count in txs_per_height.items():
+            self.extracted[height] = self.extracted.get(height, 0) + count
+
+    def check_total(self, start_height: int, end_height: int, num_txs: int, total_count: int) -> None:
+        """
+        Compare the number of txs tx_search counted in a sub-range with the number its block headers list.
+        """
+        if total_count != num_txs:
+            self.mismatches += 1
+            print(f"tx_search counted {total_count} txs in {start_height}-{end_height}, the block headers list {num_txs}.")
+
+    def short_heights(self) -> dict:
+        """
+        The heights with fewer txs extracted than their block header lists, mapped to the number listed.
+        """
+        return {height: count for height, count in self.tx_counts.items() if self.extracted.get(height, 0) < count}
+
+    def missing_blocks(self) -> set:
+        """
+        The heights of the range whose block header is not in.
+        """
+        return set(range(self.start_height, self.end_height + 1)) - set(self.tx_counts)
+
+    def report(self) -> str:
+        heights_with_txs = sum(1 for count in self.tx_counts.values() if count)
+        return (f"tx planner: {self.planned_pages} tx pages over {self.planned_ranges} sub-ranges for "
+                f"{sum(self.tx_counts.values())} txs in {heights_with_txs} of {len(self.tx_counts)} heights, "
+                f"{self.mismatches} count mismatches")
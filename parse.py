@@ -1,16 +1,42 @@
 
 import base64
-import glob
+import binascii
+import itertools
 import os
-import datetime
+import multiprocessing
 import orjson
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 #import modin.pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
 from typing import Tuple
 
+from heights import HeightIndex, HeightSet
+from journal import is_range_complete
+from segments import list_raw_files, read_segment_bytes
+
+# the memory parsing takes per byte of raw JSON, measured on synthetic and recorded ranges
+PARSE_MEMORY_FACTOR = 12
+# the usual compression ratio of raw JSON segments, to size compressed segments without decompressing them
+ZSTD_RATIO = 5
+
+# the columns of the wide table of common event types, see DataParser.pivot_events
+EVENT_TABLES = {
+    'transfer': ['recipient', 'sender', 'amount'],
+    'message': ['action', 'sender', 'module'],
+    'coin_spent': ['spender', 'amount'],
+    'coin_received': ['receiver', 'amount'],
+    'ibc_transfer': ['sender', 'receiver'],
+    'send_packet': ['packet_src_port', 'packet_src_channel', 'packet_dst_port', 'packet_dst_channel', 'packet_sequence', 'packet_data'],
+    'recv_packet': ['packet_src_port', 'packet_src_channel', 'packet_dst_port', 'packet_dst_channel', 'packet_sequence', 'packet_data'],
+    'wasm': ['_contract_address', 'action'],
+}
+
 class DataParser:
-    def __init__(self, blocks_path:str, txs_path: str, output_path: str):
+    def __init__(self, blocks_path:str, txs_path: str, output_path: str, memory_budget: int = None, workers: int = 1,
+                 event_tables: dict = None):
         """
         Initialize DataParser with paths to the blocks and transactions data.
         
@@ -18,16 +44,26 @@ class DataParser:
             blocks_path (str): Path to the blocks data.
             txs_path (str): Path to the transactions data.
             output_path (str): Path to output the parsed data.
+            memory_budget (int): Parse the new files in chunks expected to take at most this many bytes of memory,
+                see plan_chunks. None parses them all at once. With several workers, the budget is per worker.
+            workers (int): Parse the new files on this many processes, see run_parallel.
+            event_tables (dict): The event types to build a wide table of, besides the long events table, each with
+                the attribute keys that become its columns, e.g. {'transfer': ['recipient', 'sender', 'amount']}.
         """
 
         self.blocks_path = blocks_path
         self.txs_path = txs_path
         self.output_path = output_path
+        self.memory_budget = memory_budget
+        self.workers = workers
+        self.event_tables = event_tables or {}
         self.blocks_df = None
         self.txs_df = None
         self.df_log_attributes = None
-        self.events_df_wide = None
+        self.events_df = None
+        self.event_type_dfs = {}
         self.df_tx_result = None
+        self.key_cache = {}  # event attribute key -> decoded key, None for plain text keys
 
     @staticmethod
     def safe_orjson_loads(data: str):
@@ -63,6 +99,59 @@ class DataParser:
             return None
         return str(base64.b64decode(data), 'utf-8')
 
+    def decode_key(self, key: str):
+        """
+        Decode an event attribute key if it is base64, memoized in key_cache.
+
+        A key counts as encoded when it is strict base64 of printable UTF-8 text. Plain text keys such as 'sender'
+        or 'amount' are not, their length or their decoded bytes give them away.
+
+        Returns:
+            str: The decoded key, or None if the key is plain text.
+        """
+        if key not in self.key_cache:
+            try:
+                text = base64.b64decode(key, validate=True).decode('utf-8')
+                self.key_cache[key] = text if text and text.isprintable() else None
+            except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+                self.key_cache[key] = None
+        return self.key_cache[key]
+
+    def decode_attributes(self, keys: pd.Series, values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+        """
+        Decode the keys and values of event attributes, a whole column at a time.
+
+        Chains before CometBFT 0.37 base64 encode their event attributes, later ones emit plain text, and a chain
+        that upgraded has both. An attribute is decoded when its key is encoded, see decode_key, so plain text
+        events are left alone. Keys come from a small vocabulary and values repeat a lot, so only the distinct
+        keys and values are decoded and the results are gathered back by index. A value that is not base64 of
+        UTF-8 text is kept as it is.
+
+        Args:
+            keys (pd.Series): The attribute keys.
+            values (pd.Series): The attribute values.
+
+        Returns:
+            tuple: The decoded keys and values, as Series with the index of keys.
+        """
+        key_codes, unique_keys = pd.factorize(keys)
+        decoded_keys = [self.decode_key(key) for key in unique_keys]
+        # None for missing keys, at code -1
+        key_text = np.array([key if decoded is None else decoded for key, decoded in zip(unique_keys, decoded_keys)] + [None], dtype=object)
+        encoded = np.array([decoded is not None for decoded in decoded_keys] + [False])
+
+        values = np.array(values, dtype=object)
+        rows = np.flatnonzero(encoded[key_codes])
+        value_codes, unique_values = pd.factorize(values[rows])
+        decoded_values = []
+        for value in unique_values:
+            try:
+                decoded_values.append(self.decode_base64(value))
+            except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+                decoded_values.append(value)
+        values[rows] = np.array(decoded_values + [None], dtype=object)[value_codes]
+        return pd.Series(key_text[key_codes], index=keys.index), pd.Series(values, index=keys.index)
+
     def get_parsed_files(self):
         # Check if the directory exists and create it if necessary
         directory = os.path.dirname(f'{self.output_path}/parsed_files.json')
@@ -89,26 +178,213 @@ class DataParser:
             os.makedirs(directory)
             
         parsed_files = self.get_parsed_files()
-        parsed_files[data_type].extend(new_files)
+        # a range written again is parsed again under the same file names
+        known = set(parsed_files[data_type])
+        parsed_files[data_type].extend(file for file in new_files if file not in known)
 
         with open(f'{self.output_path}/parsed_files.json', 'w') as file:
             file.write(orjson.dumps(parsed_files).decode('utf-8'))
 
-    def load_new_json(self, directory: str, data_type: str) -> pd.DataFrame:
+    def list_new_files(self, directory: str, data_type: str, start_height: int = None, end_height: int = None) -> list:
+        """
+        List the raw data files of a directory that were not parsed yet, in height order.
+
+        Args:
+            directory (str): The raw data directory.
+            data_type (str): 'blocks' or 'txs'.
+            start_height (int): With end_height, only list the files within this height range.
+            end_height (int): The last height of the range.
+        """
         parsed_files = self.get_parsed_files()
+        rewritten = self.rewritten_ranges(parsed_files)
 
-        json_files = glob.glob(f"{directory}/*.json")
+        json_files = list_raw_files(directory)
         json_files = [file for file in json_files 
-                    if file.split('/')[-1] not in parsed_files]  # Only new files
+                    if file.split('/')[-1] not in parsed_files[data_type] or self.file_range(file) in rewritten]  # Only new files
+        if start_height is not None:
+            # only the files of the range
+            json_files = [file for file in json_files
+                          if start_height <= self.file_range(file)[0] and self.file_range(file)[1] <= end_height]
+        # a range that is still being extracted is left alone, a resume or backfill may still add to it
+        complete = {r for r in set(map(self.file_range, json_files)) if self.is_range_complete(*r)}
+        json_files = [file for file in json_files if self.file_range(file) in complete]
+        return sorted(json_files, key=lambda file: (self.file_range(file), file))
 
-        dfs = [pd.read_json(file) for file in json_files]
-        df = pd.concat(dfs, ignore_index=True)
+    def rewritten_ranges(self, parsed_files: dict) -> set:
+        """
+        The ranges whose blocks were parsed, but that were extracted and written again since, see DataExtractor.save_range.
 
-        if not df.empty:
-            new_files = [file.split('/')[-1] for file in json_files]
-            self.update_parsed_files(new_files, data_type)
+        A range written again is taken out of the parsed heights, while its file names stay in parsed_files.json.
+        """
+        parsed = self.get_height_index().heights('parsed')
+        return {r for r in map(self.file_range, parsed_files['blocks']) if parsed.missing(*r) == [r]}
 
-        return df
+    def is_range_complete(self, start_height: int, end_height: int) -> bool:
+        """
+        Check whether both the blocks and the txs of a range are extracted, see journal.is_range_complete.
+        """
+        return is_range_complete(self.blocks_path, start_height, end_height) and is_range_complete(self.txs_path, start_height, end_height)
+
+    def read_files(self, files: list) -> pd.DataFrame:
+        dfs = [self.read_raw_file(file) for file in files]
+        return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+    @staticmethod
+    def estimate_memory(file: str) -> int:
+        """
+        Estimate the memory it takes to parse a raw data file, from its size on disk.
+        """
+        size = os.path.getsize(file)
+        if file.endswith('.zst'):
+            size *= ZSTD_RATIO
+        return size * PARSE_MEMORY_FACTOR
+
+    def group_by_budget(self, items: list, cost) -> list:
+        """
+        Split items into consecutive groups whose cost fits the memory budget, an item costing more than the budget
+        getting a group of its own.
+
+        Args:
+            items (list): The items to group, in order.
+            cost (callable): The memory an item takes.
+
+        Returns:
+            list: The groups, lists of items.
+        """
+        groups = []
+        total = 0
+        for item in items:
+            item_cost = cost(item)
+            if groups and (self.memory_budget is None or total + item_cost <= self.memory_budget):
+                groups[-1].append(item)
+                total += item_cost
+            else:
+                groups.append([item])
+                total = item_cost
+        return groups
+
+    def group_by_range(self, block_files: list, tx_files: list) -> list:
+        """
+        Group the new files by the extraction range they belong to, the block and tx files of a range sharing the
+        range in their names.
+
+        New tx files of a range whose blocks were parsed before, by a run interrupted before its txs were done,
+        are joined with those blocks again, they are read but not saved a second time.
+
+        Args:
+            block_files (list): The new block files, in height order.
+            tx_files (list): The new tx files, in height order.
+
+        Returns:
+            list: (range, block_files, tx_files, parsed_block_files) tuples, one per range with new files, in height
+                order, parsed_block_files being the block files of the range that were parsed before.
+        """
+        ranges = {}
+        for file in block_files:
+            ranges.setdefault(self.file_range(file), ([], [], []))[0].append(file)
+        for file in tx_files:
+            ranges.setdefault(self.file_range(file), ([], [], []))[1].append(file)
+        new_block_files = set(block_files)
+        for file in sorted(list_raw_files(self.blocks_path)):
+            files = ranges.get(self.file_range(file))
+            if files is not None and files[1] and file not in new_block_files:
+                files[2].append(file)
+        return [(r, *ranges[r]) for r in sorted(ranges)]
+
+    def plan_chunks(self, block_files: list, tx_files: list) -> list:
+        """
+        Group the new files into chunks parsed one after the other.
+
+        A chunk holds whole extraction ranges, so the txs of a chunk are always joined with the blocks they belong to.
+        Ranges are added to a chunk while it fits the memory budget. The tx files of a chunk are then parsed in
+        batches within the budget too, see run_chunk, so a range too large for the budget is still parsed.
+
+        Args:
+            block_files (list): The new block files, in height order.
+            tx_files (list): The new tx files, in height order.
+
+        Returns:
+            list: The chunks, lists of range tuples as returned by group_by_range.
+        """
+        return self.group_by_budget(self.group_by_range(block_files, tx_files),
+                                    lambda files: sum(self.estimate_memory(file) for file in files[1] + files[2] + files[3]))
+
+    def plan_units(self, block_files: list, tx_files: list) -> list:
+        """
+        Split the new files into units of work for the parse workers.
+
+        A unit is one batch of the tx files of a range, a single file or as many as fit the memory budget, with the
+        block files of the range to join them with. The first unit of a range also saves its new blocks.
+
+        Args:
+            block_files (list): The new block files, in height order.
+            tx_files (list): The new tx files, in height order.
+
+        Returns:
+            list: (range, block_files, join_block_files, tx_files) tuples, block_files being saved and
+                join_block_files only read to join the txs with.
+        """
+        units = []
+        for r, range_block_files, range_tx_files, parsed_block_files in self.group_by_range(block_files, tx_files):
+            if self.memory_budget is None:
+                batches = [[file] for file in range_tx_files]
+            else:
+                batches = self.group_by_budget(range_tx_files, self.estimate_memory)
+            for i, batch in enumerate(batches or [[]]):
+                if i == 0:
+                    units.append((r, range_block_files, parsed_block_files, batch))
+                else:
+                    units.append((r, [], parsed_block_files + range_block_files, batch))
+        return units
+
+    def get_height_index(self) -> HeightIndex:
+        """
+        Open the height index of the raw data, seeding its parsed heights from the parsed files the first time.
+        """
+        index = HeightIndex(os.path.dirname(self.blocks_path.rstrip('/')))
+        if not index.has('parsed'):
+            index.seed('parsed', {self.file_range(file) for file in self.get_parsed_files()['blocks']})
+        return index
+
+    def mark_parsed(self, ranges: list) -> None:
+        """
+        Record ranges whose files were just parsed in the height index. Only complete ranges are parsed, see list_new_files.
+
+        A range is named after its whole extraction range, but a window of the live tail only holds the heights from where
+        the tail started, so only the heights of a range that were extracted are recorded. Without extracted heights in
+        the index, from before it existed, the whole ranges are.
+        """
+        index = self.get_height_index()
+        if not index.has('extracted'):
+            index.add_set('parsed', HeightSet(ranges))
+            return
+        extracted = index.heights('extracted')
+        index.add_set('parsed', HeightSet([run for r in ranges for run in extracted.covered(*r)]))
+
+    @staticmethod
+    def file_range(file: str) -> Tuple[int, int]:
+        """
+        Read the (start_height, end_height) range a raw data file covers from its name.
+        """
+        start_height, end_height = os.path.basename(file).split('.')[0].split('_')[:2]
+        return int(start_height), int(end_height)
+
+    @staticmethod
+    def read_raw_file(file: str) -> pd.DataFrame:
+        """
+        Read a raw data file, either a whole-range JSON array or a plain or compressed NDJSON segment.
+
+        Args:
+            file (str): The path of the file.
+
+        Returns:
+            pd.DataFrame: A DataFrame with one row per record.
+        """
+        if file.endswith('.ndjson.zst'):
+            return pd.read_json(BytesIO(read_segment_bytes(file)), lines=True)
+        if file.endswith('.ndjson'):
+            return pd.read_json(file, lines=True)
+        return pd.read_json(file)
 
     @staticmethod
     def load_all_json(directory: str) -> pd.DataFrame:
@@ -122,21 +398,43 @@ class DataParser:
             pd.DataFrame: A DataFrame containing all the loaded data.
         """
 
-        json_files = glob.glob(f"{directory}/*.json")
-        dfs = [pd.read_json(file) for file in json_files]
+        json_files = list_raw_files(directory)
+        dfs = [DataParser.read_raw_file(file) for file in json_files]
         df = pd.concat(dfs, ignore_index=True)
         return df
 
+    @staticmethod
+    def partition_keys(time: np.ndarray) -> dict:
+        """
+        Derive the day, month and year partition keys of RFC3339 block times.
+
+        The times are parsed once, by Arrow, into a datetime64 array. Blocks of a range share a handful of days,
+        so only the distinct days are formatted and the keys are gathered back by index.
+
+        Args:
+            time (np.ndarray): The block times, e.g. '2023-06-01T12:00:05.123456789Z'.
+
+        Returns:
+            dict: The 'day', 'month' and 'year' arrays, e.g. '2023-06-01', '2023-06' and '2023'.
+        """
+        timestamps = pa.array(time, type=pa.string()).cast(pa.timestamp('ns', tz='UTC')).cast(pa.timestamp('ns')).to_numpy()
+        days, index = np.unique(timestamps.astype('datetime64[D]'), return_inverse=True)
+        return {unit: np.datetime_as_string(days, unit=code).astype(object)[index]
+                for unit, code in (('day', 'D'), ('month', 'M'), ('year', 'Y'))}
+
     def parse_blocks(self) -> None:
         """
         Parse the 'block' information from a DataFrame containing block data.
         """
-        self.blocks_df[['height', 'chain_id', 'time', 'proposer_address']] = self.blocks_df['block'].apply(lambda x: pd.Series([x['header']['height'], x['header']['chain_id'], x['header']['time'], x['header']['proposer_address']]))
-        self.blocks_df['height'] = self.blocks_df['height'].astype(int)
-        self.blocks_df['day'] = pd.to_datetime(self.blocks_df['time']).dt.to_period('D').astype(str)
-        self.blocks_df['month'] = pd.to_datetime(self.blocks_df['time']).dt.to_period('M').astype(str)
-        self.blocks_df['year'] = pd.to_datetime(self.blocks_df['time']).dt.to_period('Y').astype(str)
-        self.blocks_df = self.blocks_df[['height', 'chain_id', 'time', 'proposer_address', 'day', 'month', 'year']]
+        headers = [block['header'] for block in self.blocks_df['block']]
+        time = np.array([header['time'] for header in headers], dtype=object)
+        self.blocks_df = pd.DataFrame({
+            'height': np.array([header['height'] for header in headers]).astype(int),
+            'chain_id': np.array([header['chain_id'] for header in headers], dtype=object),
+            'time': time,
+            'proposer_address': np.array([header['proposer_address'] for header in headers], dtype=object),
+            **self.partition_keys(time),
+        })
 
     def parse_txs(self) -> None:
         """
@@ -152,40 +450,77 @@ class DataParser:
         self.df_tx_result['log'] = self.df_tx_result['log'].apply(self.safe_orjson_loads)
         df_logs = self.df_tx_result[['hash', 'height', 'log']].explode('log').reset_index()
         expanded_logs = pd.json_normalize(df_logs['log']).fillna(0)
-        df_logs[['events', 'msg_index']] = expanded_logs
+        df_logs[['events', 'msg_index']] = expanded_logs.reindex(columns=['events', 'msg_index'], fill_value=0)
         df_log_events = df_logs[['hash', 'height', 'msg_index', 'events']].explode('events').reset_index(drop=True)
         df_log_events_normalized = pd.json_normalize(df_log_events['events'])
-        df_log_events[['type', 'attributes']] = df_log_events_normalized
+        df_log_events[['type', 'attributes']] = df_log_events_normalized.reindex(columns=['type', 'attributes'])
         df_log_attributes = df_log_events[['hash', 'height', 'msg_index', 'type', 'attributes']].explode('attributes').reset_index(drop=True)
         df_log_attributes_normalized = pd.json_normalize(df_log_attributes['attributes'])
-        df_log_attributes[['key', 'value']] = df_log_attributes_normalized
+        df_log_attributes[['key', 'value']] = df_log_attributes_normalized.reindex(columns=['key', 'value'])
         self.df_log_attributes = df_log_attributes[['hash', 'height', 'msg_index', 'type', 'key', 'value']]
 
-    def parse_events_wide(self) -> None:
+    def parse_events(self) -> None:
         """
-        Parse the events from the logs and transform the DataFrame into a wide format.
+        Parse the events of the txs into a long table, one row per event attribute, and the wide tables of the
+        configured event types, see pivot_events.
+
+        The long table has the same columns whatever events the chain emits: hash, height, event_index (the
+        position of the event among the events of its tx), type, key and value.
+        """
+        tx_events = self.txs_df['tx_result'].apply(lambda x: x['events'])
+        num_events = tx_events.apply(len).values
+        event_list = [event for events in tx_events for event in events]
+        attributes = [event.get('attributes') or [] for event in event_list]
+        num_attributes = np.array([len(event_attributes) for event_attributes in attributes], dtype=int)
+        attribute_list = [attribute for event_attributes in attributes for attribute in event_attributes]
+
+        # the position of every event in its tx, counting from the first event of the tx
+        event_index = np.arange(len(event_list)) - np.repeat(np.cumsum(num_events) - num_events, num_events)
+        event_df = pd.DataFrame({
+            'hash': np.repeat(np.repeat(self.txs_df['hash'].values, num_events), num_attributes),
+            'height': np.repeat(np.repeat(self.txs_df['height'].values, num_events), num_attributes),
+            'event_index': np.repeat(event_index, num_attributes),
+            'type': np.repeat(np.array([event.get('type') for event in event_list], dtype=object), num_attributes),
+            'key': np.array([attribute.get('key') for attribute in attribute_list], dtype=object),
+            'value': np.array([attribute.get('value') for attribute in attribute_list], dtype=object),
+        })
+        event_df['key'], event_df['value'] = self.decode_attributes(event_df['key'], event_df['value'])
+        self.events_df = event_df
+        self.event_type_dfs = {event_type: self.pivot_events(event_type, keys) for event_type, keys in self.event_tables.items()}
+
+    def pivot_events(self, event_type: str, keys: list):
+        """
+        Build the wide table of one event type, one row per event and one column per attribute key.
+
+        The columns are the configured keys whatever the events of the batch hold, so the table keeps the same
+        schema from one run to the next. Other keys are only in the long table, as are the later values of a key
+        repeated within an event.
+
+        Args:
+            event_type (str): The event type, e.g. 'transfer'.
+            keys (list): The attribute keys that become columns.
+
+        Returns:
+            pd.DataFrame: The table, with hash, height and event_index followed by the keys, or None if the batch
+                has no event of the type.
         """
-        event_list = [event for events in self.txs_df['tx_result'].apply(lambda x: x['events']) for event in events]
-        event_df = pd.DataFrame(event_list)
-        attr_df = pd.concat([pd.DataFrame(x) for x in event_df['attributes']], ignore_index=True)
-        attr_df['key'] = attr_df['key'].apply(self.decode_base64)
-        attr_df['value'] = attr_df['value'].apply(self.decode_base64)
-        event_df = event_df.drop('attributes', axis=1).join(attr_df)
-        event_df['hash'] = np.repeat(self.txs_df['hash'].values, self.txs_df['tx_result'].apply(lambda x: len(x['events'])))
-        event_df['height'] = np.repeat(self.txs_df['height'].values, self.txs_df['tx_result'].apply(lambda x: len(x['events'])))
-        event_df.reset_index(drop=True, inplace=True)
-        event_df['combined_key'] = event_df['type'] + '_' + event_df['key']
-        event_df['occurrence'] = event_df.groupby(['hash', 'height', 'combined_key']).cumcount()
-        self.events_df_wide = event_df.pivot(index=['hash', 'height', 'occurrence'], columns='combined_key', values='value')
-        self.events_df_wide.reset_index(inplace=True)
+        events = self.events_df[self.events_df['type'] == event_type]
+        if events.empty:
+            return None
+        events = events.drop_duplicates(['hash', 'height', 'event_index', 'key'])
+        wide = events.pivot(index=['hash', 'height', 'event_index'], columns='key', values='value').reindex(columns=keys)
+        wide.columns.name = None
+        return wide.astype('string').reset_index()
 
-    def save_as_partitioned_parquet(self, df: pd.DataFrame, name: str) -> None:
+    def save_as_partitioned_parquet(self, df: pd.DataFrame, name: str, fragment: str = None) -> None:
         """
         This function saves a DataFrame as a partitioned Parquet file.
         
         Args:
             df (pd.DataFrame): The DataFrame to save.
             name (str): The name of the table (used for creating a directory).
+            fragment (str): Name the Parquet files after this, e.g. the raw file they come from, so parsing the same
+                files again overwrites them rather than adding duplicates. Random names if not given.
 
         Returns:
             None
@@ -197,38 +532,182 @@ class DataParser:
         table_dir = os.path.join(self.output_path, name)
         os.makedirs(table_dir, exist_ok=True)
 
-        df.to_parquet(table_dir, engine='pyarrow', partition_cols=['year', 'month', 'day'], index=False)
+        kwargs = {'basename_template': f'{fragment}-{{i}}.parquet'} if fragment else {}
+        df.to_parquet(table_dir, engine='pyarrow', partition_cols=['year', 'month', 'day'], index=False, **kwargs)
 
-    def run(self):
+    def run(self, start_height: int = None, end_height: int = None):
         """
         Run the DataParser.
         
         This method loads the blocks and transactions data, parses them, and saves the parsed data as partitioned Parquet files.
+        The new files are parsed chunk by chunk, see plan_chunks, so with a memory budget the memory used is set by the
+        budget rather than by the number of files waiting to be parsed. With several workers, they are parsed in
+        parallel instead, see run_parallel.
+
+        Args:
+            start_height (int): With end_height, only parse the new files within this height range.
+            end_height (int): The last height of the range.
         """
-        #self.blocks_df = self.load_all_json(self.blocks_path)
-        self.blocks_df = self.load_new_json(self.blocks_path, 'blocks')
-        self.parse_blocks()
-        self.save_as_partitioned_parquet(df=self.blocks_df, name='blocks')
-
-        self.txs_df = self.load_new_json(self.txs_path, 'txs')
-        self.parse_txs()
-        self.parse_logs()
-        self.parse_events_wide()
-
-        # Join the 'time' column from blocks_df into df_log_attributes and events_df_wide
-        self.df_tx_result = self.df_tx_result.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
-        self.df_log_attributes = self.df_log_attributes.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
-        self.events_df_wide = self.events_df_wide.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
-
-        #self.df_tx_result['time'] = pd.to_datetime(self.df_tx_result['time'], utc=True, unit='ns')
-        #self.df_log_attributes['time'] = pd.to_datetime(self.df_log_attributes['time'], utc=True, unit='ns')
-        #self.events_df_wide['time'] = pd.to_datetime(self.events_df_wide['time'], utc=True, unit='ns')
-        #self.blocks_df['time'] = pd.to_datetime(self.blocks_df['time'], utc=True, unit='ns')
-
-        # Save dataframes as partitioned parquet files
-        self.save_as_partitioned_parquet(df=self.df_tx_result[['hash', 'height', 'time', 'day', 'month', 'year', 'gas_wanted', 'gas_used', 'code', 'codespace', 'info']], name='tx_result')
-        self.save_as_partitioned_parquet(df=self.df_log_attributes, name='log_attributes')
-        self.save_as_partitioned_parquet(df=self.events_df_wide, name='events')
+        block_files = self.list_new_files(self.blocks_path, 'blocks', start_height, end_height)
+        tx_files = self.list_new_files(self.txs_path, 'txs', start_height, end_height)
+        if not block_files and not tx_files:
+            print('No new blocks to parse.')
+            return
+
+        if self.workers > 1:
+            self.run_parallel(block_files, tx_files)
+            return
+
+        chunks = self.plan_chunks(block_files, tx_files)
+        for i, chunk in enumerate(chunks):
+            if len(chunks) > 1:
+                print(f'parsing chunk {i + 1} of {len(chunks)}: {len(chunk)} ranges')
+            self.run_chunk(chunk)
+
+    def run_chunk(self, ranges: list) -> None:
+        """
+        Parse and save the blocks of a chunk, then its txs batch by batch, and release them.
+
+        Tx files are recorded as parsed once their tables are saved, and block files only once all the txs of the chunk
+        are, so a run interrupted in between parses the blocks again next time, to join the rest of the txs with.
+        Fragments are named after the raw files, see save_as_partitioned_parquet, so saving them again does not
+        add duplicates.
+
+        Args:
+            ranges (list): The ranges of the chunk, as returned by group_by_range.
+        """
+        block_files = [file for _, files, _, _ in ranges for file in files]
+        tx_files = [file for _, _, files, _ in ranges for file in files]
+        self.parse_block_files(block_files, parsed_block_files=[file for _, _, _, files in ranges for file in files])
+
+        if not tx_files:
+            print('No new txs to parse.')
+        for batch in self.group_by_budget(tx_files, self.estimate_memory):
+            self.parse_tx_files(batch)
+            self.update_parsed_files([file.split('/')[-1] for file in batch], 'txs')
+
+        self.update_parsed_files([file.split('/')[-1] for file in block_files], 'blocks')
+        self.mark_parsed([r for r, _, _, _ in ranges])
+        self.blocks_df = None
+
+    def run_parallel(self, block_files: list, tx_files: list) -> None:
+        """
+        Parse the new files on a pool of worker processes, one unit of work at a time each, see plan_units.
+
+        Workers only write Parquet fragments named after the files they parse. Tx files are recorded as parsed
+        here, as their units complete, and the block files of a range once all of its units have, so a unit that
+        failed or was interrupted is parsed again next time, with its blocks, and overwrites whatever fragments it left.
+
+        Args:
+            block_files (list): The new block files, in height order.
+            tx_files (list): The new tx files, in height order.
+        """
+        units = self.plan_units(block_files, tx_files)
+        print(f'parsing {len(block_files)} block files and {len(tx_files)} tx files in {len(units)} units on {self.workers} workers')
+        pending = {}  # range -> units of the range not done yet
+        range_block_files = {}  # range -> the new block files of the range
+        for r, unit_block_files, _, _ in units:
+            pending[r] = pending.get(r, 0) + 1
+            range_block_files.setdefault(r, []).extend(unit_block_files)
+
+        failed = None
+        parsed = []
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(units)), mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(parse_unit, self.blocks_path, self.txs_path, self.output_path, self.memory_budget, self.event_tables, *unit[1:]): unit
+                       for unit in units}
+            for future in as_completed(futures):
+                r, unit_block_files, _, unit_tx_files = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'failed to parse {unit_tx_files or unit_block_files}: {e}')
+                    failed = failed or e
+                    continue
+                self.update_parsed_files([file.split('/')[-1] for file in unit_tx_files], 'txs')
+                pending[r] -= 1
+                if pending[r] == 0:
+                    # blocks are recorded last, a failed unit parses them again next time to join its txs with
+                    self.update_parsed_files([file.split('/')[-1] for file in range_block_files[r]], 'blocks')
+                    parsed.append(r)
+
+        # a range is parsed once all of its units are
+        self.mark_parsed(parsed)
+        if failed is not None:
+            raise failed
+
+    def parse_block_files(self, block_files: list, save: bool = True, parsed_block_files: list = ()) -> None:
+        """
+        Read and parse block files into blocks_df, and save them unless they are only needed to join txs with.
+        The parsed_block_files, blocks saved before, are read into blocks_df as well but not saved again.
+
+        Blocks are saved range by range, so their fragments are named the same however the ranges are chunked.
+        """
+        frames = []
+        for files, save_files in ((parsed_block_files, False), (block_files, save)):
+            for range_files in self.split_by_range(files):
+                self.blocks_df = self.read_files(range_files)
+                if not self.blocks_df.empty:
+                    self.parse_blocks()
+                    if save_files:
+                        self.save_as_partitioned_parquet(df=self.blocks_df, name='blocks', fragment=self.fragment_name(range_files))
+                    frames.append(self.blocks_df)
+        self.blocks_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def parse_tx_files(self, tx_files: list) -> None:
+        """
+        Read and parse tx files, join them with blocks_df, save their tables and release them.
+        """
+        self.txs_df = self.read_files(tx_files)
+        if not self.txs_df.empty and not self.blocks_df.empty:
+            self.parse_txs()
+            self.parse_logs()
+            self.parse_events()
+
+            # Join the 'time' column from blocks_df into df_log_attributes and the events tables
+            self.df_tx_result = self.df_tx_result.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
+            self.df_log_attributes = self.df_log_attributes.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
+            self.events_df = self.events_df.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
+            self.event_type_dfs = {event_type: df.merge(self.blocks_df[['height', 'time', 'day', 'month', 'year']], on=['height'])
+                                   for event_type, df in self.event_type_dfs.items() if df is not None}
+
+            #self.df_tx_result['time'] = pd.to_datetime(self.df_tx_result['time'], utc=True, unit='ns')
+            #self.df_log_attributes['time'] = pd.to_datetime(self.df_log_attributes['time'], utc=True, unit='ns')
+            #self.events_df['time'] = pd.to_datetime(self.events_df['time'], utc=True, unit='ns')
+            #self.blocks_df['time'] = pd.to_datetime(self.blocks_df['time'], utc=True, unit='ns')
+
+            # Save dataframes as partitioned parquet files
+            fragment = self.fragment_name(tx_files)
+            self.save_as_partitioned_parquet(df=self.df_tx_result[['hash', 'height', 'time', 'day', 'month', 'year', 'gas_wanted', 'gas_used', 'code', 'codespace', 'info']], name='tx_result', fragment=fragment)
+            self.save_as_partitioned_parquet(df=self.df_log_attributes, name='log_attributes', fragment=fragment)
+            self.save_as_partitioned_parquet(df=self.events_df, name='events', fragment=fragment)
+            for event_type, df in self.event_type_dfs.items():
+                self.save_as_partitioned_parquet(df=df, name=f'events_{event_type}', fragment=fragment)
+        self.txs_df = self.df_tx_result = self.df_log_attributes = self.events_df = None
+        self.event_type_dfs = {}
+
+    @staticmethod
+    def split_by_range(files: list) -> list:
+        """
+        Split files in height order into lists of files of the same range.
+        """
+        return [list(range_files) for _, range_files in itertools.groupby(files, DataParser.file_range)]
+
+    @staticmethod
+    def fragment_name(files: list) -> str:
+        """
+        Name the Parquet fragments of a group of raw files after the first one, e.g. 1_10000_00003.
+        """
+        return os.path.basename(files[0]).split('.')[0]
+
+
+def parse_unit(blocks_path: str, txs_path: str, output_path: str, memory_budget: int, event_tables: dict,
+               block_files: list, join_block_files: list, tx_files: list) -> None:
+    """
+    Parse one unit of work of DataParser.run_parallel, see DataParser.plan_units. Runs in a worker process.
+    """
+    parser = DataParser(blocks_path, txs_path, output_path, memory_budget=memory_budget, event_tables=event_tables)
+    parser.parse_block_files(block_files, parsed_block_files=join_block_files)
+    parser.parse_tx_files(tx_files)
 
 if __name__ == "__main__":
     parser = DataParser(blocks_path='path/to/blocks', txs_path='path/to/txs', output_path='path/to/output')
@@ -1,10 +1,17 @@
 import argparse
+import multiprocessing
 import prefect
 import asyncio
-from extract import DataExtractor, get_min_height, get_max_height, get_min_ingested_height, get_max_ingested_height
-from parse import DataParser
+from extract import DataExtractor, extract_sharded, get_height_index, get_min_height, get_max_height, get_max_ingested_height
+from journal import is_range_complete
+from parse import EVENT_TABLES, DataParser
+from tail import LiveTail
 import os
+import queue
 import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 @prefect.task(
@@ -17,25 +24,61 @@ def determine_height(data_path: str) -> tuple[int, int]:
         print("API_URL environment variable is not set.")
         return (0, 0)  # return a default value
 
-    min_node_height = get_min_height(api_url)
-    max_node_height = get_max_height(api_url)
+    raw_path = f"{data_path}/{os.getenv('NETWORK')}/rpc"
 
-    min_ingested_height = get_min_ingested_height(data_path)
-    max_ingested_height = get_max_ingested_height(data_path)
+    # finish a range an earlier run started before moving on, only its missing pages are fetched
+    index = get_height_index(raw_path)
+    for start_height, end_height in index.started_ranges():
+        if is_range_complete(f"{raw_path}/blocks", start_height, end_height) and is_range_complete(f"{raw_path}/txs", start_height, end_height):
+            index.finish_range(start_height, end_height)  # stopped between completing its journals and the index
+            continue
+        print(f"Resuming extraction of {start_height}_{end_height}.")
+        return (start_height, end_height + 1)  # extract_data stops one short of the end height
+
+    api_url = api_url.split(',')[0]  # API_URL may list several endpoints
+    timeouts = (float(os.getenv("CONNECT_TIMEOUT", 10)), float(os.getenv("READ_TIMEOUT", 30)))
+    min_node_height = get_min_height(api_url, *timeouts)
+    max_node_height = get_max_height(api_url, *timeouts)
+
+    # the lowest hole in what the node has, the head height itself is left for the next run
+    gaps = index.missing('extracted', min_node_height, max_node_height - 1)
+    if not gaps:
+        return (max_node_height, max_node_height)
+    start_height, end_height = gaps[0]
+    return (start_height, min(end_height, start_height + 9999) + 1)  # extract_data stops one short of the end height
 
-    if min_ingested_height == 0 or min_ingested_height > min_node_height:
-        start_height = min_node_height
-    else:
-        start_height = max_ingested_height + 1
 
-    if max_node_height - start_height > 10000:
-        end_height = start_height + 9999
-    else:
-        end_height = max_node_height
 
-    return (start_height, end_height)
+def parse_quota(value: str):
+    """
+    Read a rate limit setting: one quota for every endpoint, or comma-separated `endpoint=quota` pairs.
+    """
+    if not value:
+        return None
+    if '=' not in value:
+        return float(value)
+    return {api_url: float(quota) for api_url, quota in (pair.rsplit('=', 1) for pair in value.split(','))}
 
 
+def parse_event_tables(value: str):
+    """
+    Read the event types to build wide tables of, comma-separated. A type is either one of parse.EVENT_TABLES,
+    with its columns, or `type:key1|key2` to pick the attribute keys that become its columns.
+    """
+    if not value:
+        return None
+    event_tables = {}
+    for item in value.split(','):
+        event_type, _, keys = item.strip().partition(':')
+        if keys:
+            event_tables[event_type] = keys.split('|')
+        elif event_type in EVENT_TABLES:
+            event_tables[event_type] = EVENT_TABLES[event_type]
+        else:
+            raise ValueError(f"EVENT_TABLES: no columns known for the event type '{event_type}', give them as "
+                             f"'{event_type}:key1|key2' or use one of {', '.join(EVENT_TABLES)}.")
+    return event_tables
+
 
 @prefect.task(
     name="extract_data",
@@ -44,14 +87,33 @@ def determine_height(data_path: str) -> tuple[int, int]:
 def extract_data(heights: tuple[int, int], data_path: str) -> str:
     api_url = os.getenv("API_URL")
     network = os.getenv("NETWORK")
-    extractor = DataExtractor(api_url=api_url,
-                              start_height=heights[0],
-                              end_height=heights[1] - 1,
-                              per_page=int(os.getenv("PER_PAGE", 100)),
-                              protocol="rpc",
-                              network=network,
-                              semaphore=10)
-    asyncio.run(extractor.async_extract())
+    semaphore = os.getenv("SEMAPHORE", "auto")
+    extractor_kwargs = dict(api_url=api_url,
+                            per_page=int(os.getenv("PER_PAGE", 100)),
+                            protocol="rpc",
+                            network=network,
+                            semaphore=semaphore if semaphore == "auto" else int(semaphore),
+                            max_semaphore=int(os.getenv("MAX_SEMAPHORE", 64)),
+                            stream=os.getenv("STREAM", "false").upper() == "TRUE",
+                            compression_level=int(os.getenv("COMPRESSION_LEVEL", 0)),
+                            decode_workers=int(os.getenv("DECODE_WORKERS", 0)),
+                            cache_max_bytes=int(os.getenv("CACHE_MAX_BYTES", 0)),
+                            requests_per_second=parse_quota(os.getenv("RATE_LIMIT_RPS")),
+                            bytes_per_second=parse_quota(os.getenv("RATE_LIMIT_BPS")),
+                            tx_pages_per_range=int(os.getenv("TX_PAGES_PER_RANGE", 1)),
+                            tx_plan_window=int(os.getenv("TX_PLAN_WINDOW", 10)),
+                            hedge_percentile=float(os.getenv("HEDGE_PERCENTILE", 0)) or None,
+                            hedge_budget=float(os.getenv("HEDGE_BUDGET", 0.05)),
+                            connect_timeout=float(os.getenv("CONNECT_TIMEOUT", 10)),
+                            read_timeout=float(os.getenv("READ_TIMEOUT", 30)),
+                            total_timeout=float(os.getenv("TOTAL_TIMEOUT", 120)),
+                            max_retries=int(os.getenv("MAX_RETRIES", 5)))
+    shards = int(os.getenv("SHARDS", 1))
+    if shards > 1:
+        extract_sharded(start_height=heights[0], end_height=heights[1] - 1, shards=shards, **extractor_kwargs)
+    else:
+        extractor = DataExtractor(start_height=heights[0], end_height=heights[1] - 1, **extractor_kwargs)
+        asyncio.run(extractor.async_extract())
     return data_path
 
 
@@ -63,11 +125,39 @@ def parse_data(data_path: str) -> str:
     network = os.getenv("NETWORK")
     parser = DataParser(blocks_path=f"./data/{network}/rpc/blocks",
                         txs_path=f"./data/{network}/rpc/txs",
-                        output_path=f"./data/{network}/parsed")
+                        output_path=f"./data/{network}/parsed",
+                        memory_budget=int(os.getenv("PARSE_MEMORY_BUDGET", 0)) or None,
+                        workers=int(os.getenv("PARSE_WORKERS", 1)),
+                        event_tables=parse_event_tables(os.getenv("EVENT_TABLES")))
     parser.run()
     return f"./data/{network}/parsed"
 
 
+@prefect.task(
+    name="load_data",
+    description="Load the parsed data with dbt.",
+)
+def load_data(data_path: str) -> None:
+    # dbt loads whatever is parsed by the time it starts
+    index = get_height_index(f"{data_path}/{os.getenv('NETWORK')}/rpc")
+    parsed = index.heights('parsed')
+    subprocess.run('make dbt-run', shell=True, check=True)
+    index.add_set('loaded', parsed)
+
+
+def parse_range(network: str, start_height: int, end_height: int) -> None:
+    """
+    Parse the raw files of one height range. Runs in a worker process of data_pipelined.
+    """
+    parser = DataParser(blocks_path=f"./data/{network}/rpc/blocks",
+                        txs_path=f"./data/{network}/rpc/txs",
+                        output_path=f"./data/{network}/parsed",
+                        memory_budget=int(os.getenv("PARSE_MEMORY_BUDGET", 0)) or None,
+                        workers=int(os.getenv("PARSE_WORKERS", 1)),
+                        event_tables=parse_event_tables(os.getenv("EVENT_TABLES")))
+    parser.run(start_height, end_height)
+
+
 @prefect.flow(
     name="data_pull",
     description="A pipeline to just pull data from the RPC endpoints.",
@@ -92,18 +182,135 @@ def data_pipeline():
     heights = determine_height(data_path)
     raw_data = extract_data(heights, data_path)
     parsed_data = parse_data(raw_data)
-    run_makefile('make dbt-run')
+    load_data(data_path)
+
+
+def run_stage(name: str, work, inbox: queue.Queue, outbox: queue.Queue, stop: threading.Event, batch: bool = False) -> None:
+    """
+    Run one stage of data_pipelined: take ranges from inbox, work on them and pass them on to outbox.
+
+    A None in inbox ends the stage, and is passed on so the next stage ends once it is done too.
+    After a failure the stage stops working but keeps emptying inbox, so the stages before it never block.
+
+    Args:
+        name (str): The name of the stage, for logging.
+        work (callable): The function to call with a range, or with the list of ranges when batch is set.
+        inbox (queue.Queue): The ranges to work on.
+        outbox (queue.Queue): The queue to pass finished ranges to, or None for the last stage.
+        stop (threading.Event): Set when any stage fails.
+        batch (bool): Work on every range that is waiting at once, e.g. to load them in one go.
+    """
+    done = False
+    while not done:
+        items = [inbox.get()]
+        while batch and items[-1] is not None and not inbox.empty():
+            items.append(inbox.get())
+        done = items[-1] is None
+        heights = [item for item in items if item is not None]
+        if not heights or stop.is_set():
+            continue
+        start = time.time()
+        try:
+            if batch:
+                work(heights)
+            else:
+                work(heights[0])
+        except Exception as e:
+            print(f"{name} failed on {heights}: {e}")
+            stop.set()
+            continue
+        print(f"{name} of {heights} took {time.time() - start:.1f} seconds.")
+        if outbox is not None:
+            for item in heights:
+                outbox.put(item)
+    if outbox is not None:
+        outbox.put(None)
+
+
+@prefect.flow(
+    name="data_pipelined",
+    description="A pipeline to extract, parse, and load data, with the stages overlapping across height ranges.",
+)
+def data_pipelined():
+    """
+    Extract, parse and load range after range, each stage working on its own range at the same time.
+
+    While range N+1 is extracted, range N is parsed in a worker process and range N-1 is loaded.
+    The queues between the stages hold at most PIPELINE_DEPTH ranges, so when parsing falls behind
+    extraction waits for it instead of piling up raw data. Loading runs once for every range waiting.
+    """
+    data_path = "./data"
+    network = os.getenv("NETWORK")
+    depth = int(os.getenv("PIPELINE_DEPTH", 1))
+    parse_queue = queue.Queue(maxsize=depth)
+    load_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    # spawned rather than forked, the stage threads are running by the time the worker starts
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as parse_executor:
+        def parse(heights):
+            # extracted ranges end one short of the end height
+            parse_executor.submit(parse_range, network, heights[0], heights[1] - 1).result()
+
+        def load(heights):
+            load_data.fn(data_path)
+
+        stages = [threading.Thread(target=run_stage, args=('parse', parse, parse_queue, load_queue, stop)),
+                  threading.Thread(target=run_stage, args=('load', load, load_queue, None, stop), kwargs={'batch': True})]
+        for stage in stages:
+            stage.start()
+        try:
+            last_heights = None
+            while not stop.is_set():
+                heights = determine_height.fn(data_path)
+                if heights[1] - 1 < heights[0]:
+                    print(f"Caught up with the chain at height {heights[0] - 1}.")
+                    break
+                if heights == last_heights:
+                    print(f"Could not finish extracting {heights}, it is resumed on the next run.")
+                    break
+                last_heights = heights
+                start = time.time()
+                extract_data.fn(heights, data_path)
+                print(f"extract of {heights} took {time.time() - start:.1f} seconds.")
+                parse_queue.put(heights)  # blocks while parsing is behind
+        finally:
+            parse_queue.put(None)
+            for stage in stages:
+                stage.join()
+    if stop.is_set():
+        raise RuntimeError("The pipeline stopped after a stage failed.")
+
+
+def data_tail():
+    """
+    Follow the head of the chain and ingest blocks and txs as they are committed, until interrupted.
+    """
+    network = os.getenv("NETWORK")
+    max_ingested_height = get_max_ingested_height(f"./data/{network}/rpc/blocks")
+    semaphore = os.getenv("SEMAPHORE", "auto")
+    tail = LiveTail(api_url=os.getenv("API_URL"),
+                    network=network,
+                    start_height=max_ingested_height + 1 if max_ingested_height else None,
+                    per_page=int(os.getenv("PER_PAGE", 100)),
+                    semaphore=semaphore if semaphore == "auto" else int(semaphore),
+                    compression_level=int(os.getenv("COMPRESSION_LEVEL", 0)))
+    asyncio.run(tail.run())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run a pipeline.')
     parser.add_argument('--pipeline', type=str, default='full',
-                        help='Which pipeline to run: "full" or "pull". Default is "full".')
+                        help='Which pipeline to run: "full", "pipelined", "pull" or "tail". Default is "full".')
     args = parser.parse_args()
 
     if args.pipeline == 'full':
         result = data_pipeline._run()
+    elif args.pipeline == 'pipelined':
+        result = data_pipelined._run()
     elif args.pipeline == 'pull':
         result = data_pull._run()
+    elif args.pipeline == 'tail':
+        data_tail()
     else:
-        print(f'Invalid pipeline: {args.pipeline}. Choose "full" or "pull".')
\ No newline at end of file
+        print(f'Invalid pipeline: {args.pipeline}. Choose "full", "pipelined", "pull" or "tail".')
\ No newline at end of file
@@ -0,0 +1,208 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens.
+
+    Tokens are reserved rather than waited for: a reservation always succeeds, may leave the bucket
+    in debt, and tells the caller how long to wait before going ahead. Reservations are therefore
+    served in the order they were made, without a lock.
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        """
+        Initialize the TokenBucket, full.
+
+        Args:
+            rate (float): The tokens added per second.
+            capacity (float): The most tokens the bucket holds, i.e. the largest burst. Defaults to one second worth.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Take tokens out of the bucket. A negative amount gives tokens back.
+
+        Args:
+            amount (float): The number of tokens to take.
+
+        Returns:
+            float: How long to wait until the tokens are actually available, in seconds.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Per-endpoint request and byte quotas, and backoff after the endpoint rate limits us.
+
+    Every endpoint gets a bucket of requests per second and one of bytes per second. The size of a
+    response is only known once it is in, so a request reserves the typical response size of its
+    endpoint up front and settles the difference afterwards.
+
+    After a 429 the endpoint is paused for as long as its Retry-After header asks, or else for a
+    jittered exponential backoff. The pause is shared by every request to the endpoint and grows at
+    most once per pause, so a burst of 429s from requests that were already in flight does not pile up.
+    """
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, jitter: float = 0.1, alpha: float = 0.2) -> None:
+        """
+        Initialize the RateLimiter.
+
+        Args:
+            requests_per_second (float or dict): The request quota of each endpoint, or a dict of quotas by endpoint.
+                None means no quota.
+            bytes_per_second (float or dict): The download quota of each endpoint, like requests_per_second.
+            backoff_base (float): The first backoff after a 429 without a Retry-After header, in seconds.
+            backoff_max (float): The longest backoff, in seconds.
+            jitter (float): Requests held by a pause resume spread over this fraction of the pause.
+            alpha (float): The smoothing factor of the response size moving average.
+        """
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.alpha = alpha
+        self.request_buckets = {}
+        self.byte_buckets = {}
+        self.response_bytes = {}  # api -> moving average of the response size
+        self.paused_at = {}
+        self.paused_until = {}
+        self.backoffs = {}  # api -> pauses in a row
+        self.rate_limited = 0
+        self.waited = 0.0
+
+    @staticmethod
+    def quota(setting, api: str):
+        return setting.get(api) if isinstance(setting, dict) else setting
+
+    def bucket(self, buckets: dict, setting, api: str):
+        if api not in buckets:
+            rate = self.quota(setting, api)
+            buckets[api] = TokenBucket(rate) if rate else None
+        return buckets[api]
+
+    def reserve(self, api: str):
+        """
+        Reserve a request and its expected bytes on an endpoint.
+
+        Returns:
+            tuple: How long to wait before sending the request, and the bytes reserved for it.
+        """
+        now = time.time()
+        wait = 0.0
+        if self.paused_until.get(api, 0.0) > now:
+            pause = self.paused_until[api] - self.paused_at[api]
+            wait = self.paused_until[api] - now + random.uniform(0, self.jitter * pause)
+
+        requests = self.bucket(self.request_buckets, self.requests_per_second, api)
+        if requests is not None:
+            wait = max(wait, requests.reserve(1))
+
+        reserved = 0
+        downloads = self.bucket(self.byte_buckets, self.bytes_per_second, api)
+        if downloads is not None:
+            reserved = self.response_bytes.get(api, 0)
+            wait = max(wait, downloads.reserve(reserved))
+        return wait, reserved
+
+    async def acquire(self, api: str) -> int:
+        """
+        Wait until a request to the endpoint fits its quotas and no pause holds it.
+
+        Returns:
+            int: The bytes reserved for the response, to pass to record_response.
+        """
+        wait, reserved = self.reserve(api)
+        if wait > 0:
+            self.waited += wait
+            await asyncio.sleep(wait)
+        return reserved
+
+    def acquire_sync(self, api: str) -> int:
+        """
+        The blocking version of acquire, for requests sent outside of an event loop.
+        """
+        wait, reserved = self.reserve(api)
+        if wait > 0:
+            self.waited += wait
+            time.sleep(wait)
+        return reserved
+
+    def record_response(self, api: str, reserved: int, num_bytes: int) -> None:
+        """
+        Settle the bytes of a response that came back, and end the backoff of its endpoint.
+
+        Args:
+            api (str): The endpoint.
+            reserved (int): The bytes reserved for the response by acquire.
+            num_bytes (int): The size of the response.
+        """
+        self.backoffs[api] = 0
+        average = self.response_bytes.get(api)
+        self.response_bytes[api] = num_bytes if average is None else average + self.alpha * (num_bytes - average)
+        downloads = self.bucket(self.byte_buckets, self.bytes_per_second, api)
+        if downloads is not None:
+            downloads.reserve(num_bytes - reserved)
+
+    def record_rate_limited(self, api: str, request_start: float, retry_after: str = None) -> float:
+        """
+        Pause an endpoint that answered with a 429.
+
+        Args:
+            api (str): The endpoint.
+            request_start (float): When the rate limited request was sent.
+            retry_after (str): The Retry-After header of the response, if it had one.
+
+        Returns:
+            float: How long the endpoint is paused for from now, in seconds.
+        """
+        self.rate_limited += 1
+        now = time.time()
+        if request_start < self.paused_at.get(api, 0.0):
+            # sent before the current pause started, the pause already accounts for it
+            return max(0.0, self.paused_until[api] - now)
+
+        delay = self.parse_retry_after(retry_after)
+        if delay is None:
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** self.backoffs.get(api, 0))
+            delay = random.uniform(backoff / 2, backoff)
+        self.backoffs[api] = self.backoffs.get(api, 0) + 1
+        self.paused_at[api] = now
+        self.paused_until[api] = max(self.paused_until.get(api, 0.0), now + delay)
+        return self.paused_until[api] - now
+
+    @staticmethod
+    def parse_retry_after(value: str):
+        """
+        Read a Retry-After header, either a number of seconds or an HTTP date.
+
+        Returns:
+            float: The seconds to wait, or None if there is no usable header.
+        """
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def report(self) -> str:
+        return f"rate limiter: {self.rate_limited} rate limited responses, {self.waited:.1f} seconds waited for quotas and pauses"
@@ -0,0 +1,239 @@
+import glob
+import os
+import struct
+import zlib
+import orjson
+import zstandard
+
+# Compressed segments start with a fixed size header followed by one zstd frame holding the NDJSON lines.
+# The header is written last, once the record count and the checksum of the uncompressed lines are known.
+SEGMENT_MAGIC = b'BREADSEG'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<8sHqqqI')  # magic, version, start height, end height, records, crc32
+
+
+class SegmentError(Exception):
+    pass
+
+
+class SegmentWriter:
+    """
+    Append records to rolling NDJSON segment files as they arrive.
+
+    Segments are written under a temporary name and renamed into place once they are rolled,
+    so a finished segment on disk is always complete. Files are named
+    `{start_height}_{end_height}_{seq}.ndjson` so the height range can still be read from the filename,
+    or `.ndjson.zst` when they are compressed.
+    With a journal, the pages in a segment are journaled once the segment is in place.
+    """
+
+    def __init__(self, directory: str, start_height: int, end_height: int, max_bytes: int = 64 * 1024 * 1024,
+                 max_pages: int = 50, journal=None, compression_level: int = 0) -> None:
+        """
+        Initialize the SegmentWriter.
+
+        Args:
+            directory (str): The directory to write the segments to.
+            start_height (int): The first height of the range being extracted.
+            end_height (int): The last height of the range being extracted.
+            max_bytes (int): Roll over to a new segment once the current one reaches this size, before compression.
+            max_pages (int): Roll over to a new segment after this many pages, bounding the work lost to a crash.
+            journal (ExtractionJournal): The journal to record finished segments in.
+            compression_level (int): The zstd level to compress segments with, 0 writes plain NDJSON.
+        """
+        self.directory = directory
+        self.start_height = start_height
+        self.end_height = end_height
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.journal = journal
+        self.compression_level = compression_level
+        self.seq = journal.next_seq if journal is not None else 0
+        self.records = 0
+        self.segments = []
+        self.pages = []
+        self._file = None
+        self._writer = None
+        self._path = None
+        self._bytes = 0
+        self._segment_records = 0
+        self._crc = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self) -> None:
+        extension = 'ndjson.zst' if self.compression_level else 'ndjson'
+        self._path = f"{self.directory}/{self.start_height}_{self.end_height}_{self.seq:05d}.{extension}"
+        self._file = open(f"{self._path}.tmp", 'wb')
+        self._bytes = 0
+        self._segment_records = 0
+        self._crc = 0
+        if self.compression_level:
+            self._file.write(b'\0' * SEGMENT_HEADER.size)
+            self._writer = zstandard.ZstdCompressor(level=self.compression_level).stream_writer(self._file, closefd=False)
+        else:
+            self._writer = self._file
+
+    def write(self, records: list, page: str = None) -> None:
+        """
+        Append the records of one page to the current segment, rolling over when it is full.
+
+        Args:
+            records (list): The records to write. Each record is written as one line.
+            page (str): The page the records came from, for the journal.
+        """
+        # serialize first so a page is never half written
+        self.write_lines(encode_lines(records), len(records), page=page)
+
+    def write_lines(self, lines: bytes, count: int, page: str = None) -> None:
+        """
+        Append the already serialized records of one page to the current segment, rolling over when it is full.
+
+        Args:
+            lines (bytes): The NDJSON lines of the records.
+            count (int): The number of records in the lines.
+            page (str): The page the records came from, for the journal.
+        """
+        if lines:
+            if self._file is None:
+                self._open()
+            self._writer.write(lines)
+            self._bytes += len(lines)
+            self._segment_records += count
+            self._crc = zlib.crc32(lines, self._crc)
+            self.records += count
+        if page is not None:
+            self.pages.append(page)
+        if self._bytes >= self.max_bytes or len(self.pages) >= self.max_pages:
+            self.roll()
+
+    def roll(self) -> None:
+        """
+        Close the current segment and move it into place.
+        """
+        path = None
+        if self._file is not None:
+            if self.compression_level:
+                self._writer.close()  # ends the zstd frame, leaves the file open
+                self._file.seek(0)
+                self._file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.start_height, self.end_height,
+                                                     self._segment_records, self._crc))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(f"{self._path}.tmp", self._path)
+            path = self._path
+            self.segments.append(path)
+            self._file = None
+            self._writer = None
+            self._bytes = 0
+            self.seq += 1
+        if self.journal is not None and self.pages:
+            self.journal.record_segment(path, self.pages)
+        self.pages = []
+
+    def close(self) -> None:
+        """
+        Roll the last segment, if any.
+        """
+        self.roll()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def encode_lines(records: list) -> bytes:
+    """
+    Serialize records to NDJSON, one record per line.
+    """
+    return b''.join(orjson.dumps(record) + b'\n' for record in records)
+
+
+def write_segment(path: str, records: list, start_height: int, end_height: int, compression_level: int) -> None:
+    """
+    Write records to a single compressed segment file.
+
+    Args:
+        path (str): The path of the segment.
+        records (list): The records to write.
+        start_height (int): The first height the records cover.
+        end_height (int): The last height the records cover.
+        compression_level (int): The zstd level to compress with.
+    """
+    lines = encode_lines(records)
+    header = SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, start_height, end_height, len(records), zlib.crc32(lines))
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(header + zstandard.ZstdCompressor(level=compression_level).compress(lines))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_segment_header(path: str) -> dict:
+    """
+    Read the header of a compressed segment without decompressing it.
+
+    Args:
+        path (str): The path of the segment.
+
+    Returns:
+        dict: The height range, record count and checksum of the segment.
+    """
+    with open(path, 'rb') as f:
+        return _unpack_header(f.read(SEGMENT_HEADER.size), path)
+
+
+def _unpack_header(data: bytes, path: str) -> dict:
+    if len(data) < SEGMENT_HEADER.size:
+        raise SegmentError(f"{path} is too short to be a segment")
+    magic, version, start_height, end_height, records, crc = SEGMENT_HEADER.unpack(data[:SEGMENT_HEADER.size])
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise SegmentError(f"{path} is not a version {SEGMENT_VERSION} segment")
+    return {'start_height': start_height, 'end_height': end_height, 'records': records, 'crc32': crc}
+
+
+def read_segment_bytes(path: str) -> bytes:
+    """
+    Read the NDJSON lines of a segment, decompressing and verifying them if it is compressed.
+
+    Args:
+        path (str): The path of the segment.
+
+    Returns:
+        bytes: The NDJSON lines stored in the segment.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not path.endswith('.zst'):
+        return data
+    header = _unpack_header(data, path)
+    lines = zstandard.ZstdDecompressor().decompressobj().decompress(data[SEGMENT_HEADER.size:])
+    if zlib.crc32(lines) != header['crc32']:
+        raise SegmentError(f"{path} failed its checksum")
+    return lines
+
+
+def read_segment(path: str) -> list:
+    """
+    Read every record from a NDJSON segment file.
+
+    Args:
+        path (str): The path of the segment.
+
+    Returns:
+        list: The records stored in the segment.
+    """
+    return [orjson.loads(line) for line in read_segment_bytes(path).splitlines() if line.strip()]
+
+
+def list_raw_files(directory: str) -> list:
+    """
+    List the raw data files in a directory, whole-range JSON files as well as plain and compressed NDJSON segments.
+
+    Args:
+        directory (str): The directory to look in.
+
+    Returns:
+        list: The paths of the raw data files.
+    """
+    return glob.glob(f"{directory}/*.json") + glob.glob(f"{directory}/*.ndjson") + glob.glob(f"{directory}/*.ndjson.zst")
@@ -0,0 +1,277 @@
+import asyncio
+import time
+import orjson
+
+import aiohttp
+
+from extract import DataExtractor, get_height_index
+from heights import HeightSet
+from journal import ExtractionJournal
+from segments import SegmentWriter
+
+
+class LiveTail:
+    """
+    Follow the head of the chain through the node's websocket and append blocks and txs to the raw store as they are committed.
+
+    The tail subscribes to NewBlock and Tx events. A height is written once its block and as many txs as
+    its header lists have arrived. Heights whose events were missed are fetched over RPC, and after a
+    disconnect the heights committed in the meantime are caught up by range before following events again.
+
+    Data is written to segments of fixed height windows, `window` heights each, journaled per height
+    like any other range, so the parser picks it up unchanged. The heights written are recorded in the height index
+    as their window closes. Tail journals have no page size, so the batch extraction never resumes them as its own.
+    """
+
+    def __init__(self, api_url, network, protocol='rpc', start_height=None, window=1000, flush_blocks=1,
+                 per_page=100, semaphore=4, compression_level=0) -> None:
+        """
+        Initialize the LiveTail.
+
+        Args:
+            api_url (str or list): The base URL for the RPC API, the websocket is opened on the first one.
+            network (str): The name of the blockchain.
+            protocol (str): The protocol the raw data is stored under.
+            start_height (int): The first height to ingest, heights before it are caught up by range.
+                Defaults to following from the current head.
+            window (int): The number of heights per segment range.
+            flush_blocks (int): Move a segment into place after this many heights. 1 makes every block
+                visible as soon as it is committed.
+            per_page (int): The page size used when catching up by range.
+            semaphore (int or str): The number of simultaneous requests when catching up.
+            compression_level (int): The zstd level raw data is written with, 0 writes it uncompressed.
+        """
+        self.extractor = DataExtractor(api_url=api_url, start_height=0, end_height=0, per_page=per_page,
+                                       protocol=protocol, network=network, semaphore=semaphore,
+                                       compression_level=compression_level)
+        self.api_url = self.extractor.api_url
+        self.window = window
+        self.flush_blocks = flush_blocks
+        self.last_height = start_height - 1 if start_height else None
+        self.pending = {}  # height -> {'block': dict, 'txs': list}
+        self.current_window = None
+        self.journals = {}
+        self.writers = {}
+
+    @property
+    def websocket_url(self):
+        return self.api_url.replace('https://', 'wss://').replace('http://', 'ws://') + '/websocket'
+
+    def open_window(self, height):
+        """
+        Open the segment writers of the window holding the given height.
+        """
+        window_start = (height - 1) // self.window * self.window + 1
+        window_end = window_start + self.window - 1
+        self.current_window = (window_start, window_end)
+        for prefix in ('blocks', 'txs'):
+            journal = ExtractionJournal(self.extractor.output_directory(prefix), window_start, window_end, per_page=None)
+            self.journals[prefix] = journal
+            self.writers[prefix] = SegmentWriter(self.extractor.output_directory(prefix), window_start, window_end,
+                                                 max_pages=self.flush_blocks, journal=journal,
+                                                 compression_level=self.extractor.compression_level)
+
+    def close_window(self, complete=False):
+        """
+        Close the segment writers of the current window and record the heights written to it in the height index.
+
+        A tail that started mid-window never wrote the heights before its start, so only the heights
+        journaled for both blocks and txs are recorded, the others stay missing for the batch extraction.
+        """
+        # opened before the window is marked complete, so a first index is not seeded with the whole window
+        index = get_height_index(self.extractor.data_directory())
+        for prefix, writer in self.writers.items():
+            writer.close()
+            if complete:
+                self.journals[prefix].mark_complete()
+        pages = self.journals['blocks'].completed_pages & self.journals['txs'].completed_pages
+        heights = HeightSet([(height, height) for height in (int(page.split(':')[1]) for page in pages)])
+        if len(heights):
+            index.add_set('extracted', heights)
+        self.current_window = None
+        self.journals = {}
+        self.writers = {}
+
+    def commit(self, height, block, txs):
+        """
+        Write a height's block and txs, in height order.
+        """
+        if self.current_window is None or height > self.current_window[1]:
+            if self.current_window is not None:
+                self.close_window()
+            self.open_window(height)
+        page = f'height:{height}'
+        if page in self.journals['blocks'].completed_pages:
+            # written by an earlier run of the tail
+            self.last_height = height
+            return
+        self.writers['txs'].write(sorted(txs, key=DataExtractor.tx_key), page=page)
+        self.writers['blocks'].write([block], page=page)
+        self.last_height = height
+        if height == self.current_window[1]:
+            self.close_window(complete=True)
+
+    def handle_event(self, message):
+        """
+        Buffer a NewBlock or Tx event under its height.
+
+        Returns:
+            int: The height of a NewBlock event, None for anything else.
+        """
+        result = message.get('result') or {}
+        data = result.get('data')
+        if data is None:
+            return None  # subscription confirmations
+
+        value = data['value']
+        if data['type'] == 'tendermint/event/NewBlock':
+            height = int(value['block']['header']['height'])
+            self.pending.setdefault(height, {'block': None, 'txs': []})['block'] = {'block_id': value.get('block_id'), 'block': value['block']}
+            return height
+
+        if data['type'] == 'tendermint/event/Tx':
+            tx_result = value['TxResult']
+            height = int(tx_result['height'])
+            # shaped like the tx_search results
+            tx = {
+                'hash': result['events']['tx.hash'][0],
+                'height': str(height),
+                'index': tx_result.get('index', 0),
+                'tx_result': tx_result['result'],
+                'tx': tx_result['tx'],
+            }
+            self.pending.setdefault(height, {'block': None, 'txs': []})['txs'].append(tx)
+        return None
+
+    async def commit_ready(self, session, semaphore, new_block_height=None):
+        """
+        Write every pending height that is complete, in order.
+
+        All events of the heights below a new block have been sent by the node, so any of those heights
+        still incomplete missed some events and are fetched over RPC instead.
+        """
+        for height in [height for height in self.pending if height <= self.last_height]:
+            del self.pending[height]
+
+        while True:
+            height = self.last_height + 1
+            entry = self.pending.get(height)
+            complete = (entry is not None and entry['block'] is not None
+                        and len(entry['txs']) >= DataExtractor.block_tx_count(entry['block']))
+            if not complete:
+                if new_block_height is None or height >= new_block_height:
+                    return
+                print(f'Events for height {height} were missed, fetching it over RPC.')
+                entry = await self.fetch_height(session, semaphore, height, entry)
+                if entry is None:
+                    return
+            self.commit(height, entry['block'], entry['txs'])
+            self.pending.pop(height, None)
+
+    async def fetch_height(self, session, semaphore, height, entry):
+        entry = entry or {'block': None, 'txs': []}
+        if entry['block'] is None:
+            blocks = await self.extractor.async_query_blocks({height}, session, semaphore)
+            if not blocks:
+                return None
+            entry['block'] = blocks[0]
+        num_txs = DataExtractor.block_tx_count(entry['block'])
+        if len(entry['txs']) < num_txs:
+            entry['txs'] = await self.extractor.async_query_txs({height: num_txs}, session, semaphore)
+            if len(entry['txs']) < num_txs:
+                return None
+        return entry
+
+    def skip_written_heights(self):
+        """
+        Move past the heights an earlier run of the tail already wrote.
+        """
+        while True:
+            height = self.last_height + 1
+            if self.current_window is None or height > self.current_window[1]:
+                if self.current_window is not None:
+                    self.close_window()
+                self.open_window(height)
+            if f'height:{height}' not in self.journals['blocks'].completed_pages:
+                return
+            self.last_height = height
+
+    async def get_head_height(self, session, semaphore):
+        response = await self.extractor.bounded_fetch(semaphore, '/abci_info?', session)
+        return int(response['result']['response']['last_block_height'])
+
+    async def catch_up(self, session, semaphore, end_height):
+        """
+        Extract the heights between the last one written and end_height by range.
+
+        Returns:
+            bool: Whether every height came back.
+        """
+        while self.last_height < end_height:
+            chunk_start = self.last_height + 1
+            chunk_end = min(chunk_start + self.window - 1, end_height)
+            print(f'Catching up {chunk_start}-{chunk_end}.')
+            extractor = DataExtractor(api_url=self.extractor.api_urls, start_height=chunk_start, end_height=chunk_end,
+                                      per_page=self.extractor.per_page_init, protocol=self.extractor.protocol,
+                                      network=self.extractor.network)
+            await extractor.fetch_range(session, semaphore)
+            blocks = {DataExtractor.item_height(block): block for block in extractor.blocks}
+            txs = {}
+            for tx in extractor.txs:
+                txs.setdefault(int(tx['height']), []).append(tx)
+            for height in range(chunk_start, chunk_end + 1):
+                # the gaps the backfill could not close are left out, a height is only written whole
+                if height not in blocks or len(txs.get(height, [])) < DataExtractor.block_tx_count(blocks[height]):
+                    print(f'Could not catch up height {height}, retrying.')
+                    return False
+                self.commit(height, blocks[height], txs.get(height, []))
+        return True
+
+    async def follow(self, session, semaphore):
+        """
+        Subscribe to the node, catch up what was committed since the last height written, then follow new events.
+        """
+        async with session.ws_connect(self.websocket_url, heartbeat=30) as ws:
+            # subscribe before catching up, events for new heights queue up on the socket meanwhile
+            for request_id, query in enumerate(("tm.event='NewBlock'", "tm.event='Tx'"), start=1):
+                await ws.send_str(orjson.dumps({'jsonrpc': '2.0', 'method': 'subscribe', 'id': request_id, 'params': {'query': query}}).decode('utf-8'))
+
+            head_height = await self.get_head_height(session, semaphore)
+            if self.last_height is None:
+                self.last_height = head_height
+            self.skip_written_heights()
+            if not await self.catch_up(session, semaphore, head_height):
+                return
+            print(f'Following the chain from height {self.last_height + 1}.')
+
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                received = time.time()
+                new_block_height = self.handle_event(orjson.loads(msg.data))
+                last_height = self.last_height
+                await self.commit_ready(session, semaphore, new_block_height)
+                if self.last_height > last_height:
+                    print(f'Ingested up to height {self.last_height} in {time.time() - received:.3f} seconds.')
+
+    async def run(self):
+        """
+        Tail the chain until cancelled, reconnecting with backoff when the connection drops.
+        """
+        failures = 0
+        async with self.extractor.make_session() as session:
+            semaphore = self.extractor.get_limiter()
+            try:
+                while True:
+                    last_height = self.last_height
+                    try:
+                        await self.follow(session, semaphore)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        print(f'Websocket connection failed: {e}')
+                    failures = 0 if self.last_height != last_height else failures + 1
+                    delay = min(2 ** failures, 30)
+                    print(f'Disconnected at height {self.last_height}, reconnecting in {delay} seconds.')
+                    await asyncio.sleep(delay)
+            finally:
+                if self.current_window is not None:
+                    self.close_window()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+import pytest
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import extract  # noqa: E402
+
+
+@pytest.fixture
+def raw_dir(tmp_path, monkeypatch):
+    """
+    Write the raw data of every extractor to a temporary directory.
+    """
+    monkeypatch.setattr(extract.DataExtractor, 'data_directory', lambda self: str(tmp_path))
+    return tmp_path
+
+
+@asynccontextmanager
+async def serve(mock):
+    """
+    Serve a MockRPC on a free local port, yielding its URL.
+    """
+    runner = web.AppRunner(mock.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        yield f'http://127.0.0.1:{runner.addresses[0][1]}'
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture
+def rpc():
+    return serve
+
+
+@contextmanager
+def serve_in_thread(mock):
+    """
+    Serve a MockRPC from a thread of its own, for code that runs its own event loops or processes, yielding its URL.
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    runner = web.AppRunner(mock.make_app())
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    try:
+        yield f'http://127.0.0.1:{runner.addresses[0][1]}'
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+@pytest.fixture
+def rpc_thread():
+    return serve_in_thread
@@ -0,0 +1,35 @@
+from cache import ResponseCache
+
+
+def test_normalize_ignores_query_spelling():
+    a = ResponseCache.normalize('/tx_search?query="tx.height>=1 AND tx.height<=100"&page=2&per_page=50')
+    b = ResponseCache.normalize('/tx_search?per_page=50&page=2&query=tx.height <= 100  AND  tx.height >= 1')
+
+    assert a == b
+    assert ResponseCache.normalize('/tx_search?query="tx.height>=1"&page=3&per_page=50') != a
+    assert ResponseCache.normalize('/abci_info') is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=250)
+    for height in (1, 2):
+        cache.put(f'/block?height={height}', b'x' * 100)
+    assert cache.get('/block?height=1') == b'x' * 100  # now the most recently used
+
+    cache.put('/block?height=3', b'x' * 100)
+
+    assert cache.get('/block?height=2') is None
+    assert cache.get('/block?height=1') is not None
+    assert cache.size == 200
+    # the eviction order is kept in modification times, so a new process evicts the same entries
+    reloaded = ResponseCache(str(tmp_path), max_bytes=100)
+    assert list(reloaded.entries) == [cache.key('/block?height=1')]
+
+
+def test_uncacheable_responses_are_not_stored(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=100)
+    cache.put('/abci_info', b'{}')
+    cache.put('/block?height=1', b'x' * 101)
+
+    assert cache.entries == {}
+    assert cache.get('/abci_info') is None
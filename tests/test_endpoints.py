@@ -0,0 +1,59 @@
+import time
+
+from endpoints import EndpointPool
+
+
+def test_pool_routes_to_the_fastest_endpoint():
+    pool = EndpointPool(['http://a/', 'http://b'])
+    for api, latency in (('http://a', 0.5), ('http://b', 0.05)):
+        pool.start(api)
+        pool.finish(api, time.time() - latency, ok=True)
+
+    assert {pool.choose() for _ in range(20)} == {'http://b'}
+
+
+def test_pool_spreads_requests_by_queue_length():
+    pool = EndpointPool(['http://a', 'http://b'])
+    for api in ('http://a', 'http://b'):
+        pool.start(api)
+        pool.finish(api, time.time() - 0.1, ok=True)
+
+    chosen = []
+    for _ in range(4):
+        chosen.append(pool.choose())
+        pool.start(chosen[-1])
+
+    assert sorted(chosen) == ['http://a', 'http://a', 'http://b', 'http://b']
+
+
+def test_pool_benches_failing_endpoint():
+    pool = EndpointPool(['http://a', 'http://b'], max_consecutive_failures=3, bench_seconds=60)
+    for _ in range(3):
+        pool.start('http://a')
+        pool.finish('http://a', time.time(), ok=False)
+
+    assert pool.apis['http://a'].benched_until > time.time()
+    assert {pool.choose() for _ in range(20)} == {'http://b'}
+
+
+def test_pool_falls_back_to_the_endpoint_back_first():
+    pool = EndpointPool(['http://a', 'http://b'])
+    pool.bench('http://a', 10)
+    pool.bench('http://b', 60)
+
+    assert pool.choose() == 'http://a'
+
+
+def test_pool_usage():
+    pool = EndpointPool(['http://a', 'http://b'])
+    pool.start('http://a')
+    pool.finish('http://a', time.time(), ok=True)
+    pool.start('http://a')
+    pool.finish('http://a', time.time(), ok=False)
+    pool.start('http://b')
+    pool.cancel('http://b')
+
+    usage = pool.get_api_usage()
+
+    assert [(u['api'], u['total_calls'], u['hit_rate']) for u in usage] == [('http://a', 2, 0.5)]
+    assert pool.apis['http://b'].in_flight == 0
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from extract import DataExtractor, extract_sharded, get_height_index
+from journal import get_incomplete_ranges
+from mock_rpc import MockRPC
+
+
+def extract_range(rpc, mock, start_height, end_height, **kwargs):
+    async def run():
+        async with rpc(mock) as url:
+            extractor = DataExtractor(api_url=url, start_height=start_height, end_height=end_height, per_page=50,
+                                      protocol='rpc', network='mock', semaphore=4, retry_base_delay=0, **kwargs)
+            await extractor.async_extract()
+            return extractor
+    return asyncio.run(run())
+
+
+def test_extract_marks_complete_range(raw_dir, rpc):
+    extract_range(rpc, MockRPC(end_height=1000, latency=0), 1, 500)
+
+    assert get_height_index(str(raw_dir)).missing('extracted', 1, 500) == []
+
+
+def test_extract_leaves_range_with_gaps_missing(raw_dir, rpc):
+    mock = MockRPC(end_height=1000, latency=0, failure_rate=0.5, seed=1)
+    extractor = extract_range(rpc, mock, 1, 500, max_retries=0)
+
+    assert len(extractor.blocks) < 500
+    # the next run extracts the range again
+    assert get_height_index(str(raw_dir)).missing('extracted', 1, 500) == [(1, 500)]
+    assert (raw_dir / 'errors' / 'failed_requests.ndjson').exists()
+    # a whole-range file has no journal to tell it is incomplete, so none is written
+    assert not (raw_dir / 'blocks' / '1_500.json').exists()
+    assert not (raw_dir / 'txs' / '1_500.json').exists()
+
+
+def test_stream_range_with_gaps_stays_started(raw_dir, rpc):
+    mock = MockRPC(end_height=1000, latency=0, failure_rate=0.5, seed=1)
+    extract_range(rpc, mock, 1, 500, max_retries=0, stream=True)
+
+    # found again without reading the journals
+    assert get_height_index(str(raw_dir)).started_ranges() == [(1, 500)]
+
+    mock.failure_rate = 0
+    extract_range(rpc, mock, 1, 500, stream=True)
+    index = get_height_index(str(raw_dir))
+    assert index.started_ranges() == []
+    assert index.missing('extracted', 1, 500) == []
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_tx_pages_shrink_to_what_the_node_returns(raw_dir, rpc, stream):
+    # the node cuts off responses over 60KB, its indented JSON puts a tx page of 50 txs at about 100KB.
+    # Sized from the txs serialized again, compactly, the pages would come out too large to fit.
+    mock = MockRPC(end_height=1000, latency=0, max_response_bytes=60_000, pretty=True)
+    extract_range(rpc, mock, 1, 200, page_byte_budget=50_000, stream=stream)
+    truncated = mock.stats['truncated']
+    assert truncated > 0
+    assert get_height_index(str(raw_dir)).missing('extracted', 1, 200) == []
+
+    # what the sizer learned is saved, the next range of the region is paged to fit straight away
+    extractor = extract_range(rpc, mock, 201, 400, page_byte_budget=50_000, stream=stream)
+    assert mock.stats['truncated'] == truncated
+    assert (extractor.records['txs'] if stream else len(extractor.txs)) == 400
+    assert get_height_index(str(raw_dir)).missing('extracted', 1, 400) == []
+
+
+class HeavyTxRPC(MockRPC):
+    """
+    A MockRPC with one tx too large for the node to ever send back.
+    """
+
+    def __init__(self, heavy_height, **kwargs) -> None:
+        super().__init__(latency=0, max_response_bytes=100_000, **kwargs)
+        self.heavy_height = heavy_height
+
+    def tx(self, height, index):
+        tx = super().tx(height, index)
+        if height == self.heavy_height and index == 0:
+            tx['tx'] *= 200
+        return tx
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_permanent_gap_is_recorded_as_hole(raw_dir, rpc, stream):
+    mock = HeavyTxRPC(heavy_height=50, end_height=1000)
+    extract_range(rpc, mock, 1, 100, stream=stream)
+
+    index = get_height_index(str(raw_dir))
+    assert index.missing('extracted', 1, 100) == []
+    assert index.heights('holes').runs() == [(50, 50)]
+    assert index.started_ranges() == []
+
+
+def hedged_fetch(results):
+    """
+    Fetch a URL with a hedge sent straight away, the copies answering with the given fetch_direct results in turn.
+    """
+    extractor = DataExtractor(api_url='http://127.0.0.1:1', start_height=1, end_height=10, per_page=50, protocol='rpc',
+                              network='mock', hedge_percentile=0.5, hedge_budget=1.0)
+    extractor.hedger.min_samples = 1
+    extractor.hedger.record(0.01)
+    results = iter(results)
+
+    async def fetch_direct(url, session, decode):
+        delay, result = next(results)
+        await asyncio.sleep(delay)
+        return result
+
+    extractor.fetch_direct = fetch_direct
+    return asyncio.run(extractor.fetch('/block?height=1', None)), extractor
+
+
+def test_hedge_that_wins_leaves_no_gap():
+    gap = {'url': '/block?height=1', 'failure': 'retryable', 'error': 'status code 500'}
+    data, extractor = hedged_fetch([(0.05, (None, gap)), (0.1, ({'result': {}}, None))])
+
+    assert data == {'result': {}}
+    assert extractor.gaps == []
+
+
+def test_hedge_that_fails_too_leaves_one_gap():
+    gap = {'url': '/block?height=1', 'failure': 'retryable', 'error': 'status code 500'}
+    data, extractor = hedged_fetch([(0.05, (None, gap)), (0.01, (None, dict(gap, error='timeout')))])
+
+    assert data is None
+    assert extractor.gaps == [gap]
+
+
+def test_extract_sharded(raw_dir, rpc_thread):
+    with rpc_thread(MockRPC(end_height=1000, latency=0)) as url:
+        totals = extract_sharded(1, 400, shards=4, workers=2, api_url=url, per_page=50, protocol='rpc',
+                                 network='mock', semaphore=4)
+
+    assert totals == {'blocks': 400, 'txs': 800}
+    assert get_height_index(str(raw_dir)).missing('extracted', 1, 400) == []
+    # each shard is a range of its own, finished
+    assert sorted(path.name for path in (raw_dir / 'blocks').glob('*.journal')) == [
+        '101_200.journal', '1_100.journal', '201_300.journal', '301_400.journal']
+    assert get_incomplete_ranges(str(raw_dir / 'blocks')) == get_incomplete_ranges(str(raw_dir / 'txs')) == []
+    assert get_height_index(str(raw_dir)).started_ranges() == []
@@ -0,0 +1,56 @@
+from heights import HeightIndex, HeightSet
+
+
+def test_height_set_merges_runs():
+    heights = HeightSet([(10, 20), (1, 5), (6, 8), (15, 30)])
+
+    assert heights.runs() == [(1, 8), (10, 30)]
+    assert len(heights) == 29
+    assert 8 in heights and 9 not in heights and 30 in heights
+    assert (heights.min, heights.max) == (1, 30)
+
+
+def test_height_set_missing():
+    heights = HeightSet([(1, 8), (10, 30), (40, 40)])
+
+    assert heights.missing(1, 50) == [(9, 9), (31, 39), (41, 50)]
+    assert heights.missing(12, 25) == []
+    assert heights.missing(0, 3) == [(0, 0)]
+    assert HeightSet().missing(5, 7) == [(5, 7)]
+    assert heights.covered(5, 35) == [(5, 8), (10, 30)]
+    assert heights.covered(31, 39) == []
+
+
+def test_height_set_remove():
+    heights = HeightSet([(1, 8), (10, 30), (40, 40)])
+    heights.remove(5, 12)
+    heights.remove(40, 50)
+    heights.remove(20, 20)
+
+    assert heights.runs() == [(1, 4), (13, 19), (21, 30)]
+
+
+def test_height_index_persists_stages(tmp_path):
+    index = HeightIndex(str(tmp_path))
+    index.add('extracted', 1, 100)
+    index.add_set('extracted', HeightSet([(201, 300)]))
+    index.add('parsed', 1, 100)
+
+    reloaded = HeightIndex(str(tmp_path))
+
+    assert reloaded.missing('extracted', 1, 300) == [(101, 200)]
+    assert reloaded.missing('parsed', 1, 300) == [(101, 300)]
+    assert reloaded.missing('loaded', 1, 10) == [(1, 10)]
+
+
+def test_height_index_started_ranges(tmp_path):
+    index = HeightIndex(str(tmp_path))
+    index.seed_started([(101, 200)])
+    index.start_range(1, 100)
+    index.start_range(201, 300)
+    index.finish_range(101, 200)
+    # seeding only ever happens once
+    index.seed_started([(301, 400)])
+
+    # adjacent ranges stay apart, unlike the heights of a stage
+    assert HeightIndex(str(tmp_path)).started_ranges() == [(1, 100), (201, 300)]
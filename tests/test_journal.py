@@ -0,0 +1,68 @@
+from journal import ExtractionJournal, get_incomplete_ranges, is_range_complete
+from segments import SegmentWriter
+
+
+def write_pages(directory, journal, pages):
+    with SegmentWriter(str(directory), 1, 100, max_pages=1, journal=journal) as writer:
+        for page in pages:
+            writer.write([{'height': page}], page=page)
+
+
+def test_journal_resumes_completed_pages(tmp_path):
+    journal = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+    write_pages(tmp_path, journal, ['page:1', 'page:2'])
+
+    resumed = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+
+    assert resumed.completed_pages == {'page:1', 'page:2'}
+    assert len(resumed.segments) == 2
+    assert resumed.next_seq == 2
+    assert not resumed.complete
+
+
+def test_journal_removes_segments_it_does_not_know(tmp_path):
+    journal = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+    write_pages(tmp_path, journal, ['page:1'])
+    # written by a run that stopped before journaling it
+    (tmp_path / '1_100_00001.ndjson').write_bytes(b'{"height": 2}\n')
+
+    resumed = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+
+    assert not (tmp_path / '1_100_00001.ndjson').exists()
+    assert resumed.completed_pages == {'page:1'}
+
+
+def test_journal_cuts_off_torn_last_line(tmp_path):
+    journal = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+    write_pages(tmp_path, journal, ['page:1'])
+    with open(journal.path, 'ab') as f:
+        f.write(b'{"segment": "1_100_00001.ndjson", "pa')
+
+    resumed = ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+
+    assert resumed.completed_pages == {'page:1'}
+    assert open(journal.path, 'rb').read().endswith(b'\n')
+
+
+def test_journal_header_mismatch_starts_over(tmp_path):
+    journal = ExtractionJournal(str(tmp_path), 1, 100, per_page=50, plan='tx_ranges:1:10')
+    write_pages(tmp_path, journal, ['page:1', 'page:2'])
+
+    for per_page, plan in ((25, 'tx_ranges:1:10'), (25, 'tx_ranges:2:10')):
+        restarted = ExtractionJournal(str(tmp_path), 1, 100, per_page=per_page, plan=plan)
+        assert restarted.completed_pages == set()
+        assert restarted.segments == []
+        assert list(tmp_path.glob('1_100_*')) == []
+
+
+def test_incomplete_ranges(tmp_path):
+    ExtractionJournal(str(tmp_path), 1, 100, per_page=50)
+    ExtractionJournal(str(tmp_path), 101, 200, per_page=50).mark_complete()
+    # a window of the live tail, journaled per height
+    ExtractionJournal(str(tmp_path), 201, 300, per_page=None)
+
+    assert get_incomplete_ranges(str(tmp_path)) == [(1, 100)]
+    assert not is_range_complete(str(tmp_path), 1, 100)
+    assert is_range_complete(str(tmp_path), 101, 200)
+    # ranges extracted before journaling existed
+    assert is_range_complete(str(tmp_path), 301, 400)
@@ -0,0 +1,65 @@
+import asyncio
+
+from limiter import AdaptiveLimiter
+
+
+def test_limiter_grows_by_one_per_round_trip():
+    limiter = AdaptiveLimiter(initial=4, max_limit=64)
+
+    for _ in range(4):
+        limiter.record(0.1, 200)
+
+    assert 4.9 < limiter.limit < 5.0
+    assert limiter.successes == 4
+
+
+def test_limiter_backs_off_once_per_round_trip():
+    limiter = AdaptiveLimiter(initial=16)
+    limiter.record(10.0, 200)  # sets the baseline, a round trip lasts longer than the test
+
+    for status in (429, 503, None):
+        limiter.record(0.1, status)
+
+    assert int(limiter.limit) == 8
+    assert limiter.failures == 3
+
+
+def test_limiter_treats_latency_spikes_as_congestion():
+    limiter = AdaptiveLimiter(initial=16, latency_factor=2.0)
+    limiter.record(0.001, 200)
+
+    limiter.record(0.01, 200)
+
+    assert limiter.limit < 16
+    assert limiter.failures == 1
+
+
+def test_limiter_stays_within_bounds():
+    limiter = AdaptiveLimiter(initial=2, min_limit=1, max_limit=3)
+    for _ in range(100):
+        limiter.record(0.1, 200)
+    assert limiter.limit == 3
+
+    limiter = AdaptiveLimiter(initial=2, min_limit=1)
+    for _ in range(10):
+        limiter._last_decrease = 0.0
+        limiter.record(0.1, 500)
+    assert limiter.limit == 1
+
+
+def test_limiter_bounds_requests_in_flight():
+    limiter = AdaptiveLimiter(initial=3, max_limit=3)
+    in_flight = []
+
+    async def request():
+        async with limiter:
+            in_flight.append(limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(10)))
+
+    asyncio.run(run())
+
+    assert max(in_flight) == 3
+    assert limiter.in_flight == 0
@@ -0,0 +1,66 @@
+from paging import PageSizer, TxPlanner, plan_tx_ranges
+
+
+def test_plan_tx_ranges_skips_empty_heights():
+    assert plan_tx_ranges({1: 0, 2: 3, 3: 0, 4: 2, 5: 0}, per_page=10) == [(2, 4, 5)]
+    assert plan_tx_ranges({1: 0, 2: 0}, per_page=10) == []
+
+
+def test_plan_tx_ranges_splits_at_page_target():
+    tx_counts = {height: 4 for height in range(1, 8)}
+
+    assert plan_tx_ranges(tx_counts, per_page=10) == [(1, 2, 8), (3, 4, 8), (5, 6, 8), (7, 7, 4)]
+    assert plan_tx_ranges(tx_counts, per_page=10, pages_per_range=2) == [(1, 5, 20), (6, 7, 8)]
+
+
+def test_plan_tx_ranges_heavy_height_is_its_own_range():
+    assert plan_tx_ranges({1: 2, 2: 25, 3: 2}, per_page=10) == [(1, 1, 2), (2, 2, 25), (3, 3, 2)]
+
+
+def test_plan_tx_ranges_never_spans_unknown_heights():
+    assert plan_tx_ranges({1: 1, 2: 1, 5: 1}, per_page=10) == [(1, 2, 2), (5, 5, 1)]
+
+
+def test_tx_planner_plans_whole_windows():
+    planner = TxPlanner(1, 40, per_page=10, window=2)
+
+    assert planner.add_block_page(1, {height: 1 for height in range(11, 21)}) == []
+    assert planner.add_block_page(0, {height: 1 for height in range(1, 11)}) == [(1, 10, 10), (11, 20, 10)]
+    # a failed page still completes its window
+    assert planner.add_block_page(2, None) == []
+    assert planner.add_block_page(3, {height: 0 for height in range(31, 41)}) == []
+
+    planner.add_txs({height: 1 for height in range(1, 20)})
+    assert planner.short_heights() == {20: 1}
+    assert planner.missing_blocks() == set(range(21, 31))
+
+
+def test_page_sizer_learns_from_responses(tmp_path):
+    sizer = PageSizer(max_per_page=100, byte_budget=10_000, path=str(tmp_path / 'sizes.json'))
+    assert sizer.per_page(1) == 100
+
+    sizer.record_too_large(1, 100)
+    assert sizer.per_page(1) == 100  # grows back to twice the size that last worked
+    sizer.record_success(1, 50, 50, 50 * 400)
+    assert sizer.per_page(1) < 100
+    sizer.save()
+
+    reloaded = PageSizer(max_per_page=100, byte_budget=10_000, path=str(tmp_path / 'sizes.json'))
+    assert reloaded.per_page(1) == sizer.per_page(1)
+    # another region starts from the bytes per tx of every response
+    assert reloaded.per_page(5000) == 10_000 // 400
+
+
+def test_page_sizer_save_keeps_other_shards_regions(tmp_path):
+    path = str(tmp_path / 'sizes.json')
+    first = PageSizer(max_per_page=100, byte_budget=10_000, path=path)
+    second = PageSizer(max_per_page=100, byte_budget=10_000, path=path)
+    first.record_success(1, 50, 50, 50 * 400)
+    second.record_success(5000, 50, 50, 50 * 1000)
+    first.save()
+    second.save()
+
+    merged = PageSizer(max_per_page=100, byte_budget=10_000, path=path)
+    assert merged.per_page(1) == 10_000 // 400
+    assert merged.per_page(5000) == 10_000 // 1000
+    assert list(tmp_path.glob('*.tmp')) == []
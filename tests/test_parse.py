@@ -0,0 +1,201 @@
+import base64
+
+import orjson
+import pandas as pd
+import pytest
+
+from heights import HeightIndex
+from journal import ExtractionJournal
+from mock_rpc import MockRPC
+from parse import DataParser
+from segments import write_segment
+
+
+def b64(text):
+    return base64.b64encode(text.encode()).decode()
+
+
+def make_parser(tmp_path, **kwargs):
+    return DataParser(str(tmp_path / 'rpc' / 'blocks'), str(tmp_path / 'rpc' / 'txs'), str(tmp_path / 'parsed'), **kwargs)
+
+
+def write_range(tmp_path, start_height, end_height, tx_segments=3):
+    """
+    Write the blocks of a range to one segment and its txs, 2 per height, to tx_segments segments.
+    """
+    mock = MockRPC(start_height=start_height, end_height=end_height, tx_bytes=16)
+    heights = range(start_height, end_height + 1)
+    for prefix in ('blocks', 'txs'):
+        (tmp_path / 'rpc' / prefix).mkdir(parents=True, exist_ok=True)
+    write_segment(str(tmp_path / 'rpc' / 'blocks' / f'{start_height}_{end_height}_00000.ndjson.zst'),
+                  [mock.block(height) for height in heights], start_height, end_height, 0)
+    txs = [mock.tx(height, index) for height in heights for index in range(2)]
+    size = -(-len(txs) // tx_segments)
+    for seq in range(tx_segments):
+        write_tx_segment(tmp_path, start_height, end_height, seq, txs[seq * size:(seq + 1) * size])
+
+
+def write_tx_segment(tmp_path, start_height, end_height, seq, txs):
+    path = tmp_path / 'rpc' / 'txs' / f'{start_height}_{end_height}_{seq:05d}.ndjson.zst'
+    write_segment(str(path), txs, start_height, end_height, 0)
+    return path
+
+
+def parsed_table(tmp_path, name):
+    return pd.read_parquet(tmp_path / 'parsed' / name)
+
+
+def parsed_files(tmp_path):
+    return orjson.loads((tmp_path / 'parsed' / 'parsed_files.json').read_bytes())
+
+
+def assert_parsed(tmp_path, start_height, end_height):
+    tx_result = parsed_table(tmp_path, 'tx_result')
+    blocks = parsed_table(tmp_path, 'blocks')
+    assert len(tx_result) == tx_result['hash'].nunique() == 2 * (end_height - start_height + 1)
+    assert tx_result['time'].notna().all()
+    assert len(blocks) == blocks['height'].nunique() == end_height - start_height + 1
+    assert HeightIndex(str(tmp_path / 'rpc')).missing('parsed', start_height, end_height) == []
+
+
+def test_parse_blocks_headers_and_partitions(tmp_path):
+    parser = make_parser(tmp_path)
+    parser.blocks_df = pd.DataFrame([MockRPC().block(height) for height in (3599, 3600, 90000)])
+
+    parser.parse_blocks()
+
+    assert parser.blocks_df['height'].tolist() == [3599, 3600, 90000]
+    assert parser.blocks_df['time'].tolist() == ['2023-07-01T00:59:59.123456789Z', '2023-07-01T01:00:00.123456789Z',
+                                                 '2023-07-01T01:00:00.123456789Z']
+    assert parser.blocks_df['day'].tolist() == ['2023-07-01'] * 3
+    assert parser.blocks_df['month'].tolist() == ['2023-07'] * 3
+    assert parser.blocks_df['year'].tolist() == ['2023'] * 3
+    assert parser.blocks_df['chain_id'].tolist() == ['mock-1'] * 3
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'memory_budget': 1}, {'workers': 2}])
+def test_parse_range(tmp_path, kwargs):
+    write_range(tmp_path, 1, 100)
+
+    make_parser(tmp_path, **kwargs).run()
+
+    assert_parsed(tmp_path, 1, 100)
+    assert make_parser(tmp_path, **kwargs).list_new_files(str(tmp_path / 'rpc' / 'txs'), 'txs') == []
+
+
+@pytest.mark.parametrize('kwargs', [{'memory_budget': 1}, {'workers': 2}])
+def test_parse_resumes_after_interruption(tmp_path, kwargs):
+    write_range(tmp_path, 1, 100)
+    segment = tmp_path / 'rpc' / 'txs' / '1_100_00001.ndjson.zst'
+    content = segment.read_bytes()
+    segment.write_bytes(content[:-10])  # fails its checksum
+
+    with pytest.raises(Exception):
+        make_parser(tmp_path, **kwargs).run()
+    # the txs saved are recorded, the blocks are kept for the txs left
+    assert parsed_files(tmp_path)['blocks'] == []
+    assert '1_100_00001.ndjson.zst' not in parsed_files(tmp_path)['txs']
+    assert HeightIndex(str(tmp_path / 'rpc')).missing('parsed', 1, 100) == [(1, 100)]
+
+    segment.write_bytes(content)
+    make_parser(tmp_path, **kwargs).run()
+
+    assert_parsed(tmp_path, 1, 100)
+    assert sorted(parsed_files(tmp_path)['txs']) == [f'1_100_{seq:05d}.ndjson.zst' for seq in range(3)]
+
+
+def test_parse_skips_range_still_extracting(tmp_path):
+    journal = ExtractionJournal(str(tmp_path / 'rpc' / 'txs'), 1, 100, per_page=50)
+    write_range(tmp_path, 1, 100)
+
+    make_parser(tmp_path).run()
+    assert not (tmp_path / 'parsed' / 'tx_result').exists()
+
+    journal.mark_complete()
+    make_parser(tmp_path).run()
+    assert_parsed(tmp_path, 1, 100)
+
+
+def test_parse_joins_late_tx_files_with_parsed_blocks(tmp_path):
+    write_range(tmp_path, 1, 100)
+    make_parser(tmp_path).run()
+
+    # the txs of the second half are backfilled after the range was parsed
+    txs = [MockRPC(tx_bytes=16).tx(height, 2) for height in range(51, 101)]
+    write_tx_segment(tmp_path, 1, 100, 3, txs)
+    make_parser(tmp_path).run()
+
+    tx_result = parsed_table(tmp_path, 'tx_result')
+    assert len(tx_result) == tx_result['hash'].nunique() == 250
+    assert tx_result['time'].notna().all()
+    assert len(parsed_table(tmp_path, 'blocks')) == 100
+
+
+def test_parse_range_written_again(tmp_path):
+    write_range(tmp_path, 1, 100)
+    make_parser(tmp_path).run()
+
+    # extracted and written again under the same names, see DataExtractor.save_range
+    HeightIndex(str(tmp_path / 'rpc')).discard('parsed', 1, 100)
+    mock = MockRPC(tx_bytes=16)
+    txs = [mock.tx(height, index) for height in range(1, 101) for index in range(2)][:67]  # the first segment, see write_range
+    write_tx_segment(tmp_path, 1, 100, 0, txs + [mock.tx(height, 2) for height in range(1, 101)])
+    make_parser(tmp_path).run()
+
+    tx_result = parsed_table(tmp_path, 'tx_result')
+    assert len(tx_result) == tx_result['hash'].nunique() == 300
+    assert len(parsed_table(tmp_path, 'blocks')) == 100
+    assert HeightIndex(str(tmp_path / 'rpc')).missing('parsed', 1, 100) == []
+    parsed_files = make_parser(tmp_path).get_parsed_files()
+    assert len(parsed_files['blocks']) == 1 and len(parsed_files['txs']) == 3
+
+
+def test_parse_tail_window_marks_extracted_heights(tmp_path):
+    # a window of the live tail named 1001_2000 that started at 1996
+    write_range(tmp_path, 1996, 2000, tx_segments=1)
+    for prefix in ('blocks', 'txs'):
+        for path in (tmp_path / 'rpc' / prefix).iterdir():
+            path.rename(path.with_name(path.name.replace('1996_2000', '1001_2000')))
+    HeightIndex(str(tmp_path / 'rpc')).add('extracted', 1996, 2000)
+
+    make_parser(tmp_path).run()
+
+    assert HeightIndex(str(tmp_path / 'rpc')).heights('parsed').runs() == [(1996, 2000)]
+    assert len(parsed_table(tmp_path, 'blocks')) == 5
+
+
+def test_decode_key(tmp_path):
+    parser = make_parser(tmp_path)
+
+    assert parser.decode_key(b64('recipient')) == 'recipient'
+    # plain text keys, some of them valid base64 of bytes that are not text
+    for key in ('sender', 'amount', 'code', 'data', ''):
+        assert parser.decode_key(key) is None
+    assert parser.key_cache[b64('recipient')] == 'recipient'
+
+
+def test_decode_attributes_mixed_encodings(tmp_path):
+    parser = make_parser(tmp_path)
+    keys = pd.Series([b64('recipient'), 'sender', b64('amount'), None, b64('amount')], index=[10, 11, 12, 13, 14])
+    values = pd.Series([b64('addr1'), 'addr2', b64('5uakt'), 'x', 'not base64!'], index=[10, 11, 12, 13, 14])
+
+    decoded_keys, decoded_values = parser.decode_attributes(keys, values)
+
+    assert decoded_keys.tolist() == ['recipient', 'sender', 'amount', None, 'amount']
+    # plain text events are left alone, values that do not decode are kept as they are
+    assert decoded_values.tolist() == ['addr1', 'addr2', '5uakt', 'x', 'not base64!']
+    assert decoded_keys.index.tolist() == [10, 11, 12, 13, 14]
+
+
+def test_parse_event_tables(tmp_path):
+    write_range(tmp_path, 1, 10, tx_segments=1)
+
+    make_parser(tmp_path, event_tables={'transfer': ['recipient', 'amount']}).run()
+
+    events = parsed_table(tmp_path, 'events')
+    assert set(events['type']) == {'message', 'transfer'}
+    transfer = parsed_table(tmp_path, 'events_transfer').sort_values(['height', 'recipient'])
+    assert len(transfer) == 20
+    assert transfer['amount'].tolist()[:2] == ['1uakt', '1uakt']
+    assert transfer['recipient'].tolist()[:2] == ['addr1', 'addr1']
+    assert not (tmp_path / 'parsed' / 'events_message').exists()
@@ -0,0 +1,47 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from ratelimit import RateLimiter
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('5', 5.0),
+    ('-3', 0.0),
+    (None, None),
+    ('', None),
+    ('soon', None),
+])
+def test_parse_retry_after_seconds(value, expected):
+    assert RateLimiter.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    assert 25 < RateLimiter.parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+    assert RateLimiter.parse_retry_after(formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+
+def test_rate_limited_burst_pauses_once():
+    limiter = RateLimiter(backoff_base=10, jitter=0)
+    sent = time.time()
+
+    first = limiter.record_rate_limited('rpc', sent)
+    # answers to requests that were in flight when the pause started
+    later = [limiter.record_rate_limited('rpc', sent) for _ in range(5)]
+
+    assert 5 <= first <= 10
+    assert all(pause <= first for pause in later)
+    assert limiter.backoffs['rpc'] == 1
+    assert limiter.rate_limited == 6
+    wait, _ = limiter.reserve('rpc')
+    assert wait == pytest.approx(first, abs=0.5)
+
+
+def test_rate_limited_after_pause_backs_off_further():
+    limiter = RateLimiter(backoff_base=10, jitter=0)
+    limiter.record_rate_limited('rpc', time.time(), retry_after='1')
+    assert limiter.record_rate_limited('rpc', time.time() + 1) >= 10
+    assert limiter.backoffs['rpc'] == 2
+    # other endpoints are not held
+    assert limiter.reserve('lcd') == (0.0, 0)
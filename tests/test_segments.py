@@ -0,0 +1,38 @@
+import pytest
+
+from segments import SEGMENT_HEADER, SegmentError, SegmentWriter, read_segment, read_segment_header, write_segment
+
+RECORDS = [{'height': height, 'txs': []} for height in range(1, 101)]
+
+
+def test_compressed_segment_round_trips(tmp_path):
+    with SegmentWriter(str(tmp_path), 1, 100, max_pages=1, compression_level=3) as writer:
+        writer.write(RECORDS[:50], page='page:1')
+        writer.write(RECORDS[50:], page='page:2')
+
+    assert [path.rsplit('/', 1)[1] for path in writer.segments] == ['1_100_00000.ndjson.zst', '1_100_00001.ndjson.zst']
+    header = read_segment_header(writer.segments[1])
+    assert (header['start_height'], header['end_height'], header['records']) == (1, 100, 50)
+    assert read_segment(writer.segments[0]) + read_segment(writer.segments[1]) == RECORDS
+
+
+def test_corrupt_segment_fails_its_checksum(tmp_path):
+    path = str(tmp_path / '1_100_00000.ndjson.zst')
+    write_segment(path, RECORDS, 1, 100, compression_level=3)
+    data = bytearray(open(path, 'rb').read())
+    data[SEGMENT_HEADER.size - 1] ^= 0xff  # flip the stored crc32
+    open(path, 'wb').write(bytes(data))
+
+    with pytest.raises(SegmentError, match='checksum'):
+        read_segment(path)
+
+
+def test_segment_without_header_is_rejected(tmp_path):
+    path = tmp_path / '1_100_00000.ndjson.zst'
+    path.write_bytes(b'not a segment')
+    with pytest.raises(SegmentError, match='too short'):
+        read_segment_header(str(path))
+
+    path.write_bytes(b'\0' * SEGMENT_HEADER.size)
+    with pytest.raises(SegmentError, match='not a version'):
+        read_segment(str(path))
@@ -0,0 +1,113 @@
+import asyncio
+
+import orjson
+from aiohttp import web
+
+from extract import get_height_index
+from journal import get_incomplete_ranges
+from mock_rpc import MockRPC
+from tail import LiveTail
+
+
+class WebsocketRPC(MockRPC):
+    """
+    A MockRPC that also serves the websocket, sending the NewBlock and Tx events of the heights after its head.
+    """
+
+    def __init__(self, event_heights, **kwargs) -> None:
+        super().__init__(latency=0, **kwargs)
+        self.event_heights = event_heights
+
+    def events(self, height):
+        yield {'type': 'tendermint/event/NewBlock', 'value': self.block(height)}, {}
+        for index in range(self.txs_per_block):
+            tx = self.tx(height, index)
+            value = {'TxResult': {'height': str(height), 'index': index, 'tx': tx['tx'], 'result': tx['tx_result']}}
+            yield {'type': 'tendermint/event/Tx', 'value': value}, {'tx.hash': [tx['hash']]}
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        for _ in range(2):
+            await ws.receive()  # the NewBlock and Tx subscriptions
+        for height in self.event_heights:
+            for data, events in self.events(height):
+                await ws.send_str(orjson.dumps({'jsonrpc': '2.0', 'id': 1, 'result': {'data': data, 'events': events}}).decode('utf-8'))
+        await ws.close()
+        return ws
+
+    def make_app(self):
+        app = super().make_app()
+        app.router.add_get('/websocket', self.websocket)
+        return app
+
+
+async def tail_once(serve, mock, **kwargs):
+    async with serve(mock) as url:
+        tail = LiveTail(url, network='mock', window=1000, **kwargs)
+        async with tail.extractor.make_session() as session:
+            await tail.follow(session, tail.extractor.get_limiter())
+        if tail.current_window is not None:
+            tail.close_window()
+        return tail
+
+
+def test_tail_from_head_indexes_only_committed_heights(raw_dir, rpc):
+    mock = WebsocketRPC(range(1996, 2004), start_height=1, end_height=1995)
+
+    tail = asyncio.run(tail_once(rpc, mock))
+
+    assert tail.last_height == 2003
+    # the tail started at the head, the heights of the window before it were never fetched
+    assert get_height_index(str(raw_dir)).heights('extracted').runs() == [(1996, 2003)]
+    assert get_height_index(str(raw_dir)).missing('extracted', 1001, 2003) == [(1001, 1995)]
+
+
+def test_tail_windows_are_not_resumed_by_batch(raw_dir, rpc):
+    mock = WebsocketRPC(range(1996, 2004), start_height=1, end_height=1995)
+
+    asyncio.run(tail_once(rpc, mock))
+
+    # the window 2001-3000 is still open, but it belongs to the tail
+    assert (raw_dir / 'blocks' / '2001_3000.journal').exists()
+    assert get_incomplete_ranges(str(raw_dir / 'blocks')) == []
+    assert get_incomplete_ranges(str(raw_dir / 'txs')) == []
+    assert get_height_index(str(raw_dir)).started_ranges() == []
+
+
+def test_tail_resumes_after_written_heights(raw_dir, rpc):
+    asyncio.run(tail_once(rpc, WebsocketRPC(range(1996, 2004), start_height=1, end_height=1995)))
+
+    # the node moved on while the tail was away, 2004-2010 are caught up over RPC
+    tail = asyncio.run(tail_once(rpc, WebsocketRPC(range(2011, 2013), start_height=1, end_height=2010),
+                                 start_height=1996))
+
+    assert tail.last_height == 2012
+    assert get_height_index(str(raw_dir)).heights('extracted').runs() == [(1996, 2012)]
+
+
+class MissingTxsRPC(WebsocketRPC):
+    """
+    A WebsocketRPC that never answers the tx_search queries covering one height.
+    """
+
+    def __init__(self, missing_height, event_heights, **kwargs) -> None:
+        super().__init__(event_heights, **kwargs)
+        self.missing_height = missing_height
+
+    def search(self, request, kind):
+        low, high = self.parse_heights(request.query.get('query', '').strip('"'), 'tx.height')
+        if kind == 'txs' and low <= self.missing_height <= high:
+            return web.Response(status=400)
+        return super().search(request, kind)
+
+
+def test_catch_up_stops_at_height_missing_txs(raw_dir, rpc):
+    asyncio.run(tail_once(rpc, WebsocketRPC(range(1996, 2004), start_height=1, end_height=1995)))
+
+    tail = asyncio.run(tail_once(rpc, MissingTxsRPC(2006, range(2011, 2013), start_height=1, end_height=2010),
+                                 start_height=1996))
+
+    # the block of 2006 came back but not its txs, the tail stops before it rather than writing it without them
+    assert tail.last_height == 2005
+    assert get_height_index(str(raw_dir)).heights('extracted').runs() == [(1996, 2005)]